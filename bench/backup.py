@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# End-to-end backup benchmark. For each geometry in the sweep, this makes a
+# scratch directory as darbrrb dar would, then runs darbrrb's real dar
+# method and hook path against the fake dar, parchive and growisofs in
+# bench/fakes, and reports:
+#
+# * per-slice hook latency (dar waits for the hook, so their sum is the
+#   time dar spends blocked);
+# * bytes read and written by the hook processes;
+# * parchive runs, bytes burned, discs burned and files on them;
+# * total wall time.
+#
+# With --staging-dir, the discs are put together in a directory made there,
+# as with the staging_dir setting, so that a fast scratch directory (in
+# --workdir) can be compared with a slow one.
+#
+# Results are appended to a JSONL file (see benchlib) so that versions can
+# be compared.
+#
+# Usage: python3 bench/backup.py [-o results.jsonl] [--slices-per-disc 5,50,500]
+#            [--data-discs 3] [--parity-discs 2] [--group-slices-per-disc 1]
+#            [--slice-KiB 64] [--sets 1.2] [--dar-rate 0] [--parchive-rate 0]
+#            [--burn-rate 0] [--workdir DIR] [--staging-dir DIR] [--keep]
+
+import argparse
+import itertools
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+
+import benchlib
+import darbrrb
+
+def settings_for(scratch_dir, staging_dir, slices_per_disc, data_discs,
+                 parity_discs, k, slice_KiB, slices):
+    s = darbrrb.Settings()
+    # measured settings are written into the copy of darbrrb.py that the
+    # fake dar runs, so the hooks see them too
+    s.measure('scratch_dir', scratch_dir)
+    s.measure('state_dir', os.path.join(scratch_dir, '..', 'state'))
+    s.measure('burner_device', '/dev/null')
+    if staging_dir is not None:
+        s.measure('staging_dir', staging_dir)
+    s.measure('data_discs', data_discs)
+    s.measure('parity_discs', parity_discs)
+    s.measure('slices_per_disc', slices_per_disc)
+    s.measure('group_slices_per_disc', k)
+    s.measure('expected_data_size_GiB', slices * slice_KiB / 1048576)
+    disc_size_MiB = math.ceil((s.reserve_space_KiB +
+                               slices_per_disc * slice_KiB) / 1024)
+    # the par overhead is taken out of each slice; make room for it
+    while True:
+        s.measure('disc_size_MiB', disc_size_MiB)
+        if s.slice_size_KiB >= slice_KiB:
+            break
+        disc_size_MiB += 1
+    return s
+
+def run_point(workdir, staging_workdir, slices_per_disc, data_discs,
+              parity_discs, k, slice_KiB, sets, rates):
+    point_dir = tempfile.mkdtemp(prefix='point', dir=workdir)
+    scratch_dir = os.path.join(point_dir, 'scratch')
+    staging_dir = None
+    if staging_workdir is not None:
+        staging_dir = tempfile.mkdtemp(prefix='staging', dir=staging_workdir)
+    report_dir = os.path.join(point_dir, 'reports')
+    root = os.path.join(point_dir, 'root')
+    os.mkdir(report_dir)
+    os.mkdir(root)
+    slices = max(1, int(slices_per_disc * data_discs * sets))
+    s = settings_for(scratch_dir, staging_dir, slices_per_disc, data_discs,
+                     parity_discs, k, slice_KiB, slices)
+    d = darbrrb.Darbrrb(s, benchlib.darbrrb_path)
+    d.ensure_scratch()
+    env = {
+        'PATH': benchlib.fakes_dir + os.pathsep + os.environ['PATH'],
+        'PYTHONPATH': benchlib.shim_dir,
+        'FAKE_REPORT_DIR': report_dir,
+        'FAKE_DAR_SLICES': str(slices),
+        'FAKE_DAR_MiB_PER_S': str(rates['dar']),
+        'FAKE_PARCHIVE_MiB_PER_S': str(rates['parchive']),
+        'FAKE_BURN_MiB_PER_S': str(rates['burn']),
+    }
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        began = time.monotonic()
+        d.dar('-c', 'bench', '-R', root)
+        wall_seconds = time.monotonic() - began
+        if staging_dir is not None:
+            # the last mover may still be on its way out
+            with d._scratch_lock('mover.lock'):
+                pass
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+    def report(name):
+        return benchlib.read_jsonl(os.path.join(report_dir, name))
+    dar = report('dar.jsonl')[0]
+    hooks = report('hooks.jsonl')
+    parchive = report('parchive.jsonl')
+    burns = report('growisofs.jsonl')
+    return point_dir, {
+        'benchmark': 'backup',
+        'slices_per_disc': slices_per_disc,
+        'data_discs': data_discs,
+        'parity_discs': parity_discs,
+        'group_slices_per_disc': k,
+        'tiered': staging_dir is not None,
+        'slice_KiB': slice_KiB,
+        'slices': slices,
+        'rates_MiB_per_s': rates,
+        'wall_seconds': wall_seconds,
+        'hook_latency_seconds': benchlib.summarize(dar['hook_seconds']),
+        'dar_blocked_seconds': sum(dar['hook_seconds']),
+        'dar_writing_seconds': dar['writing_seconds'],
+        'hook_bytes_read': sum(h['bytes_read'] for h in hooks),
+        'hook_bytes_written': sum(h['bytes_written'] for h in hooks),
+        'parchive_runs': len(parchive),
+        'parchive_seconds': sum(p['seconds'] for p in parchive),
+        'discs_burned': len(burns),
+        'files_burned': sum(b['files'] for b in burns),
+        'bytes_burned': sum(b['bytes'] for b in burns),
+        'burn_seconds': sum(b['seconds'] for b in burns),
+    }
+
+def int_list(text):
+    return [int(x) for x in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='darbrrb backup benchmark')
+    parser.add_argument('-o', '--output', default='bench_results.jsonl')
+    parser.add_argument('--slices-per-disc', type=int_list,
+                        default=[5, 50, 500])
+    parser.add_argument('--data-discs', type=int_list, default=[3])
+    parser.add_argument('--parity-discs', type=int_list, default=[2])
+    parser.add_argument('--group-slices-per-disc', type=int_list,
+                        default=[1])
+    parser.add_argument('--slice-KiB', type=int, default=64)
+    parser.add_argument('--sets', type=float, default=1.2,
+                        help='how many sets of slices dar should make')
+    parser.add_argument('--dar-rate', type=float, default=0)
+    parser.add_argument('--parchive-rate', type=float, default=0)
+    parser.add_argument('--burn-rate', type=float, default=0)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--staging-dir', default=None)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep scratch directories and reports')
+    args = parser.parse_args()
+    rates = {'dar': args.dar_rate, 'parchive': args.parchive_rate,
+             'burn': args.burn_rate}
+    workdir = tempfile.mkdtemp(prefix='darbrrb_bench', dir=args.workdir)
+    staging_workdir = None
+    if args.staging_dir is not None:
+        staging_workdir = tempfile.mkdtemp(prefix='darbrrb_bench',
+                                           dir=args.staging_dir)
+    results = []
+    try:
+        for spd, dd, pd, k in itertools.product(args.slices_per_disc,
+                                                args.data_discs,
+                                                args.parity_discs,
+                                                args.group_slices_per_disc):
+            if spd % k:
+                continue
+            point_dir, r = run_point(workdir, staging_workdir, spd, dd, pd,
+                                     k, args.slice_KiB, args.sets, rates)
+            results.append(r)
+            print('{spd:5d} slices/disc {dd:2d}+{pd:<2d} k {k:3d}: {slices:6d} '
+                  'slices, hook {mean:6.3f}s mean {p95:6.3f}s p95, dar '
+                  'blocked {blocked:8.1f}s, hooks wrote {written:8.1f} MiB, '
+                  '{runs:5d} parchive runs, {discs} discs, {files:6d} files, '
+                  '{wall:8.1f}s wall'.format(
+                      spd=spd, dd=dd, pd=pd, k=k, slices=r['slices'],
+                      runs=r['parchive_runs'], files=r['files_burned'],
+                      mean=r['hook_latency_seconds']['mean'],
+                      p95=r['hook_latency_seconds']['p95'],
+                      blocked=r['dar_blocked_seconds'],
+                      written=r['hook_bytes_written'] / 1048576,
+                      discs=r['discs_burned'], wall=r['wall_seconds']),
+                  flush=True)
+            if not args.keep:
+                shutil.rmtree(point_dir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+            if staging_workdir is not None:
+                shutil.rmtree(staging_workdir, ignore_errors=True)
+    benchlib.append_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# Things the benchmarks have in common: finding darbrrb.py, and writing
+# results in a form that can be compared between versions.
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+darbrrb_path = os.path.join(bench_dir, '..', 'darbrrb.py')
+fakes_dir = os.path.join(bench_dir, 'fakes')
+shim_dir = os.path.join(bench_dir, 'shim')
+
+sys.path.insert(0, os.path.dirname(darbrrb_path))
+
+# which darbrrb.py was measured
+def version():
+    with open(darbrrb_path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    try:
+        described = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=bench_dir, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        described = None
+    return {'darbrrb_sha256': digest, 'git': described}
+
+# One JSON object per line, each stamped with the version and time, so
+# that results from several versions can go in one file and be compared.
+def append_results(filename, records):
+    stamp = dict(version(), when=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with open(filename, 'at') as f:
+        for r in records:
+            print(json.dumps(dict(stamp, **r), sort_keys=True), file=f)
+
+def read_jsonl(filename):
+    try:
+        with open(filename) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def summarize(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    return {'count': len(values),
+            'mean': sum(values) / len(values),
+            'p50': values[len(values) // 2],
+            'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+            'max': values[-1]}
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+# Burning benchmark. This stages sets of discs, files of the given size in
+# each disc's directory as a backup would leave them, and burns them with
+# Darbrrb.burn_set and the fake growisofs in bench/fakes, which keeps a
+# model of the drive and its buffer (see there): once as growisofs both
+# masters and writes each disc, reading the staged files, and once mastering
+# ahead, with darbrrb making each disc's image in --image-dir while the disc
+# before it burns. Reading the staged files is slowed down the same way for
+# both, by --source-rate and by a stall of --stall-seconds every
+# --stall-every-MiB, standing in for dar and parchive at the same disk.
+# It reports, for each:
+#
+# * burner idle seconds: the drive waiting on its buffer during a burn, and
+#   the time between one burn and the next in a set;
+# * how long the first disc of each set waited for its image;
+# * how fast images were made, alone and alongside a burn, from darbrrb's
+#   timings;
+# * wall time.
+#
+# Results are appended to a JSONL file (see benchlib) so that versions can
+# be compared.
+#
+# Usage: python3 bench/burn.py [-o results.jsonl] [--data-discs 3]
+#            [--parity-discs 2] [--disc-MiB 128] [--files-per-disc 8]
+#            [--sets 2] [--burn-rate 32] [--source-rate 96]
+#            [--stall-seconds 1.5] [--stall-every-MiB 96] [--buffer-MiB 32]
+#            [--workdir DIR] [--image-dir DIR] [--cpu-slots N]
+
+import argparse
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+
+import benchlib
+import darbrrb
+
+# as the fake growisofs reads a directory: the stalls come every so many MiB
+# read in all, whatever the files
+def source_model(rate, stall_seconds, stall_every_MiB):
+    copy_into_image = darbrrb._copy_into_image
+    read_MiB = [0.0]
+    def slowed(source, out_fd, offset, size):
+        began = time.monotonic()
+        copy_into_image(source, out_fd, offset, size)
+        before = read_MiB[0]
+        read_MiB[0] += size / 1048576
+        seconds = size / 1048576 / rate if rate else 0
+        if stall_every_MiB:
+            seconds += stall_seconds * (int(read_MiB[0] // stall_every_MiB) -
+                                        int(before // stall_every_MiB))
+        time.sleep(max(0, seconds - (time.monotonic() - began)))
+    return slowed
+
+def run_point(workdir, image_dir, mode, data_discs, parity_discs, disc_MiB,
+              files_per_disc, sets, rates, stall_seconds, stall_every_MiB,
+              buffer_MiB, cpu_slots):
+    point_dir = tempfile.mkdtemp(prefix=mode, dir=workdir)
+    report_dir = os.path.join(point_dir, 'reports')
+    os.mkdir(report_dir)
+    s = darbrrb.Settings()
+    s.scratch_dir = os.path.join(point_dir, 'scratch')
+    s.state_dir = os.path.join(point_dir, 'state')
+    s.burner_device = '/dev/null'
+    s.data_discs = data_discs
+    s.parity_discs = parity_discs
+    s.slices_per_disc = files_per_disc
+    s.disc_size_MiB = disc_MiB + s.reserve_space_KiB // 1024 + 1
+    s.burn_buffer_MiB = buffer_MiB
+    s.cpu_slots = cpu_slots
+    if mode == 'ahead':
+        s.image_dir = tempfile.mkdtemp(prefix='images', dir=image_dir)
+    d = darbrrb.Darbrrb(s, benchlib.darbrrb_path)
+    d.ensure_scratch()
+    # someone standing by with blank discs
+    d._ask = lambda prompt: ''
+    file_bytes = disc_MiB * 1048576 // files_per_disc
+    chunk = os.urandom(1048576)
+    env = {
+        'PATH': benchlib.fakes_dir + os.pathsep + os.environ['PATH'],
+        'FAKE_REPORT_DIR': report_dir,
+        'FAKE_BURN_MiB_PER_S': str(rates['burn']),
+        'FAKE_SOURCE_MiB_PER_S': str(rates['source']),
+        'FAKE_SOURCE_STALL_S': str(stall_seconds),
+        'FAKE_SOURCE_STALL_EVERY_MiB': str(stall_every_MiB),
+    }
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    first_disc_waits = []
+    wall_seconds = 0.0
+    try:
+        with contextlib.ExitStack() as stack:
+            # as in the hook dar runs, the discs are in the working directory
+            stack.enter_context(darbrrb.working_directory(s.scratch_dir))
+            stack.callback(setattr, darbrrb, '_copy_into_image',
+                           darbrrb._copy_into_image)
+            darbrrb._copy_into_image = source_model(
+                rates['source'], stall_seconds, stall_every_MiB)
+            for set_zb in range(sets):
+                for i, disc_dir in enumerate(d.disc_dirs()):
+                    for n in range(files_per_disc):
+                        with open(os.path.join(disc_dir, 'f{}.{:04d}'.format(
+                                i, n)), 'wb') as f:
+                            remaining = file_bytes
+                            while remaining > 0:
+                                remaining -= f.write(chunk[:remaining])
+                titles = [d.disc_title('bench', set_zb, i)
+                          for i in range(d.geometry.total_set_count)]
+                began = time.monotonic()
+                def burned(i):
+                    if i == 0:
+                        first_disc_waits.append(time.monotonic() - began)
+                d.burn_set(set_zb, titles, burned)
+                wall_seconds += time.monotonic() - began
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+    burns = benchlib.read_jsonl(os.path.join(report_dir, 'growisofs.jsonl'))
+    between = []
+    for a, b in zip(burns, burns[1:]):
+        if a['title'][:-3] == b['title'][:-3]:
+            between.append(b['started'] - (a['started'] + a['seconds']))
+    spans = darbrrb.read_timings(d._timings_filename())
+    def mastering_rate(alongside):
+        masters = [m for m in spans if m['phase'] == 'master' and
+                   m.get('alongside') == alongside]
+        seconds = sum(m['seconds'] for m in masters)
+        if not seconds:
+            return None
+        return sum(m['bytes'] for m in masters) / 1048576 / seconds
+    # the first disc's wait is in its own figure, not in the burner's idle
+    first_burns = [b['seconds'] for b in burns[::d.geometry.total_set_count]]
+    shutil.rmtree(point_dir)
+    return {
+        'benchmark': 'burn',
+        'mode': mode,
+        'data_discs': data_discs,
+        'parity_discs': parity_discs,
+        'disc_MiB': disc_MiB,
+        'files_per_disc': files_per_disc,
+        'sets': sets,
+        'rates_MiB_per_s': rates,
+        'stall_seconds': stall_seconds,
+        'stall_every_MiB': stall_every_MiB,
+        'buffer_MiB': buffer_MiB,
+        'cpu_slots': cpu_slots,
+        'discs_burned': len(burns),
+        'burner_idle_seconds': (sum(b['idle_seconds'] for b in burns) +
+                                sum(between)),
+        'idle_during_burns_seconds': sum(b['idle_seconds'] for b in burns),
+        'idle_between_burns_seconds': sum(between),
+        'first_disc_wait_seconds': [w - b for w, b in
+                                    zip(first_disc_waits, first_burns)],
+        'mastering_MiB_per_s': mastering_rate(None),
+        'mastering_alongside_burn_MiB_per_s': mastering_rate('burn'),
+        'wall_seconds': wall_seconds,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='darbrrb burning benchmark')
+    parser.add_argument('-o', '--output', default='bench_results.jsonl')
+    parser.add_argument('--data-discs', type=int, default=3)
+    parser.add_argument('--parity-discs', type=int, default=2)
+    parser.add_argument('--disc-MiB', type=int, default=128)
+    parser.add_argument('--files-per-disc', type=int, default=8)
+    parser.add_argument('--sets', type=int, default=2)
+    parser.add_argument('--burn-rate', type=float, default=32)
+    parser.add_argument('--source-rate', type=float, default=96)
+    parser.add_argument('--stall-seconds', type=float, default=1.5)
+    parser.add_argument('--stall-every-MiB', type=int, default=96)
+    parser.add_argument('--buffer-MiB', type=int, default=32)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--image-dir', default=None,
+                        help='where to master images (default: in workdir)')
+    parser.add_argument('--cpu-slots', type=int, default=None,
+                        help='images mastered at once (default: processors)')
+    args = parser.parse_args()
+    rates = {'burn': args.burn_rate, 'source': args.source_rate}
+    workdir = tempfile.mkdtemp(prefix='darbrrb_bench', dir=args.workdir)
+    results = []
+    try:
+        for mode in ('serial', 'ahead'):
+            r = run_point(workdir, args.image_dir or workdir, mode,
+                          args.data_discs, args.parity_discs, args.disc_MiB,
+                          args.files_per_disc, args.sets, rates,
+                          args.stall_seconds, args.stall_every_MiB,
+                          args.buffer_MiB, args.cpu_slots)
+            results.append(r)
+            print('{mode:6}: {discs:3d} discs, burner idle {idle:7.2f}s '
+                  '({during:.2f}s during burns, {between:.2f}s between), '
+                  'first disc waited {first}, {wall:7.1f}s wall'.format(
+                      mode=mode, discs=r['discs_burned'],
+                      idle=r['burner_idle_seconds'],
+                      during=r['idle_during_burns_seconds'],
+                      between=r['idle_between_burns_seconds'],
+                      first=', '.join('{:.2f}s'.format(w) for w in
+                                      r['first_disc_wait_seconds']),
+                      wall=r['wall_seconds']), flush=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    benchlib.append_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+# Micro-benchmark: what does it cost to look up a derived setting, or to work
+# out the title of a disc, through Settings and through a Geometry?
+#
+# Results are appended to a JSONL file (see benchlib) so that versions can
+# be compared.
+#
+# Usage: python3 bench/geometry_lookup.py [-o results.jsonl] [--number 20000]
+
+import argparse
+import timeit
+
+import benchlib
+from darbrrb import Settings, Darbrrb, Geometry
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='darbrrb setting lookup micro-benchmark')
+    parser.add_argument('-o', '--output', default='bench_results.jsonl')
+    parser.add_argument('--number', type=int, default=20000,
+                        help='calls timed per repeat')
+    args = parser.parse_args()
+    settings = Settings()
+    settings.digits = 6
+    d = Darbrrb(settings, benchlib.darbrrb_path)
+    geometry = d.geometry
+    number = args.number
+    cases = [
+        ('Settings.slice_size_KiB', lambda: settings.slice_size_KiB),
+        ('Settings.slice_size_MiB (via __getattr__)',
+         lambda: settings.slice_size_MiB),
+        ('Settings.disc_size_KiB (via __getattr__)',
+         lambda: settings.disc_size_KiB),
+        ('Geometry.slice_size_KiB', lambda: geometry.slice_size_KiB),
+        ('Geometry.slice_size_MiB', lambda: geometry.slice_size_MiB),
+        ('Geometry.disc_size_KiB', lambda: geometry.disc_size_KiB),
+        ('Geometry.from_settings', lambda: Geometry.from_settings(settings)),
+        ('disc_title_for_slice_and_disc',
+         lambda: d.disc_title_for_slice_and_disc('basename', 12345, 2)),
+    ]
+    results = []
+    for name, f in cases:
+        n = number // 100 if name == 'Geometry.from_settings' else number
+        seconds = min(timeit.repeat(f, number=n, repeat=5))
+        results.append({'benchmark': 'geometry_lookup', 'case': name,
+                        'ns_per_call': seconds / n * 1e9})
+        print('{:45s} {:12.0f} ns'.format(name, seconds / n * 1e9))
+    benchlib.append_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+# Restore benchmark. This builds a library of virtual discs, one directory
+# per disc title, holding the files a backup would have put there, as
+# sparse files of the right size. A Darbrrb whose disc-asking, copying and
+# parchive-running methods are replaced by a model then restores from it,
+# driven through _extract as dar would drive it. The model counts disc
+# insertions, bytes copied, parchive runs and the most scratch space used,
+# and keeps a simulated clock:
+#
+# * each time a different disc is asked for, swapping discs takes a while;
+# * copying from a disc runs at optical read speed;
+# * some files may be unreadable (found out after a long time trying), or
+#   readable only partway;
+# * parchive and dar run at given rates.
+#
+# With --kept-last-group, the last parity group is also kept in the state
+# directory, as a backup on the same machine would have kept it; copying from
+# there costs no simulated time.
+#
+# Results are appended to a JSONL file (see benchlib) so that versions of
+# the fetching logic in _fetch_some_slices can be compared.
+#
+# Usage: python3 bench/restore.py [-o results.jsonl] [--slices-per-disc 5,50,500]
+#            [--data-discs 3] [--parity-discs 2] [--group-slices-per-disc 1]
+#            [--sets 2.5] [--slice-MiB 47] [--unreadable 0.005]
+#            [--truncated 0.005] [--kept-last-group] ...
+
+import argparse
+import errno
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import benchlib
+import darbrrb
+
+class DiscLibrary:
+    def __init__(self, root, model):
+        self.root = root
+        self.model = model
+        self.sizes = {}  # file name -> size it should be
+        self.last_set_zb = 0
+        self.in_drive = None
+
+    def add(self, title, name, size):
+        directory = os.path.join(self.root, title)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.truncate(size)
+        self.sizes[name] = size
+
+    # What happens when this file on this disc is read; the same every
+    # time, as with a real scratch.
+    def fate(self, title, name):
+        if name.endswith('.par') or name.endswith('.txt'):
+            return 'fine'
+        r = random.Random('{}/{}/{}'.format(self.model['seed'], title,
+                                            name)).random()
+        if r < self.model['unreadable']:
+            return 'unreadable'
+        elif r < self.model['unreadable'] + self.model['truncated']:
+            return 'truncated'
+        return 'fine'
+
+def build_library(d, library, basename, slices):
+    g = d.geometry
+    for n in range(1, slices + 1):
+        set_zb, disc_zb, group = d.geometry.place(n)
+        library.add(d.disc_title(basename, set_zb, disc_zb),
+                    d._slice_name(basename, n, 'dar'),
+                    int(g.slice_size_KiB * 1024))
+        library.last_set_zb = set_zb
+    for first in range(1, slices + 1, g.slices_per_group):
+        last = min(first + g.slices_per_group - 1, slices)
+        set_zb = g.place(first)[0]
+        parfilename = d._par_filename(basename, first, last)
+        for disc_zb in range(g.total_set_count):
+            library.add(d.disc_title(basename, set_zb, disc_zb),
+                        parfilename, 96 + 120 * (last - first + 1))
+        # the parity volumes are dealt out to the parity discs in turn
+        for i, volume in enumerate(d.parity_volume_names(parfilename)):
+            library.add(d.disc_title(basename, set_zb,
+                                     g.data_discs + i % g.parity_discs),
+                        volume, int(g.slice_size_KiB * 1024) + 96 +
+                        120 * (last - first + 1))
+
+# as _cache_last_group would have, but with links to the library's files
+def keep_last_group(d, library, basename, slices):
+    g = d.geometry
+    first = (slices - 1) // g.slices_per_group * g.slices_per_group + 1
+    last_par = d._par_filename(basename, first, slices)
+    set_zb = g.place(first)[0]
+    cache_dir = d._last_group_dir(basename)
+    os.makedirs(cache_dir)
+    files = []
+    for disc_zb in range(g.total_set_count):
+        title_dir = os.path.join(library.root,
+                                 d.disc_title(basename, set_zb, disc_zb))
+        for f in sorted(os.listdir(title_dir)):
+            if f in files:
+                continue
+            if (f == last_par or f.startswith(last_par[:-3]) or
+                    (f.endswith('.dar') and
+                     d._number_from_slice_name_ob(f) >= first)):
+                os.link(os.path.join(title_dir, f),
+                        os.path.join(cache_dir, f))
+                files.append(f)
+    pars = sorted(f for f in os.listdir(os.path.join(
+        library.root, d.disc_title(basename, set_zb, 0))) if f.endswith('.par'))
+    # without it, the group kept isn't used
+    first_slice_sha256 = darbrrb._sha256_of(os.path.join(
+        library.root, d.disc_title(basename, 0, 0),
+        d._slice_name(basename, 1, 'dar')))[1]
+    with open(os.path.join(cache_dir, 'last_group.json'), 'wt') as f:
+        json.dump({'set_zb': set_zb, 'pars': pars, 'par': last_par,
+                   'files': files,
+                   'first_slice_sha256': first_slice_sha256}, f)
+
+class SimulatedRestore(darbrrb.Darbrrb):
+    def __init__(self, settings, library):
+        super().__init__(settings, benchlib.darbrrb_path)
+        self.library = library
+        self.model = library.model
+        self.clock = 0.0
+        self.insertions = 0
+        self.bytes_copied = 0
+        self.parchive_runs = 0
+        self.failed_groups = 0
+        self.unreadable_files = 0
+        self.truncated_files = 0
+        self.in_scratch = {}
+        self.scratch_high_water = 0
+
+    def parity_volume_names(self, parfilename):
+        first, last = self._numbers_from_par_filename_ob(parfilename)
+        volumes = (self.geometry.parity_discs *
+                   -(-(last - first + 1) // self.geometry.data_discs))
+        return ['{}p{:02d}'.format(parfilename[:-3], i + 1)
+                for i in range(volumes)]
+
+    def _note_scratch(self, name, size):
+        self.in_scratch[name] = size
+        self.scratch_high_water = max(self.scratch_high_water,
+                                      sum(self.in_scratch.values()))
+
+    def written_disc_directory(self, disc_title):
+        if self.library.in_drive != disc_title:
+            self.insertions += 1
+            self.clock += self.model['swap_seconds']
+            self.library.in_drive = disc_title
+        return os.path.join(self.library.root, disc_title)
+
+    def last_set_directory(self, basename, disc_number_in_set_zb):
+        return self.written_disc_directory(self.disc_title(
+            basename, self.library.last_set_zb, disc_number_in_set_zb))
+
+    def _copy(self, source, destination):
+        title = os.path.basename(os.path.dirname(source))
+        name = os.path.basename(source)
+        size = os.path.getsize(source)
+        if not source.startswith(self.library.root):
+            # kept on this machine
+            with open(destination, 'wb') as f:
+                f.truncate(size)
+            self._note_scratch(name, size)
+            return
+        fate = self.library.fate(title, name)
+        if fate == 'unreadable':
+            self.unreadable_files += 1
+            self.clock += self.model['error_seconds']
+            raise OSError(errno.EIO, 'simulated unreadable file', source)
+        if fate == 'truncated':
+            self.truncated_files += 1
+            size //= 2
+        self.clock += size / 1048576 / self.model['read_MiB_per_s']
+        self.bytes_copied += size
+        with open(destination, 'wb') as f:
+            f.truncate(size)
+        self._note_scratch(name, size)
+
+    def _run(self, *args):
+        if args[:2] != ('parchive', 'r'):
+            raise Exception('not simulated', args)
+        self.parchive_runs += 1
+        parfilename = args[2]
+        basename = parfilename.rsplit('.', 2)[0]
+        first, last = self._numbers_from_par_filename_ob(parfilename)
+        slices = [self._slice_name(basename, n, 'dar')
+                  for n in range(first, last + 1)]
+        volumes = self.parity_volume_names(parfilename)
+        def whole(name):
+            return (os.path.exists(name) and
+                    os.path.getsize(name) == self.library.sizes[name])
+        damaged = [n for n in slices if not whole(n)]
+        usable_volumes = [v for v in volumes if whole(v)]
+        self.clock += (sum(self.library.sizes[n] for n in slices) /
+                       1048576 / self.model['parchive_MiB_per_s'])
+        if len(damaged) > len(usable_volumes):
+            self.failed_groups += 1
+            return
+        for name in damaged:
+            with open(name, 'wb') as f:
+                f.truncate(self.library.sizes[name])
+            self._note_scratch(name, self.library.sizes[name])
+
+def restore(d, basename, slices, wanted):
+    dar_seconds_per_slice = (d.geometry.slice_size_MiB /
+                             d.model['dar_MiB_per_s'])
+    d._extract('dir', basename, '0', 'dar', 'init')
+    d._extract('dir', basename, str(slices), 'dar', 'init')
+    for n in wanted:
+        d._extract('dir', basename, str(n), 'dar', 'operating')
+        d.clock += dar_seconds_per_slice
+
+def run_scenario(workdir, spd, data_discs, parity_discs, k, sets, slice_MiB,
+                 scenario, errors, kept, model):
+    point_dir = tempfile.mkdtemp(prefix='point', dir=workdir)
+    scratch_dir = os.path.join(point_dir, 'scratch')
+    os.mkdir(scratch_dir)
+    model = dict(model)
+    if not errors:
+        model['unreadable'] = model['truncated'] = 0
+    s = darbrrb.Settings()
+    s.scratch_dir = scratch_dir
+    s.state_dir = os.path.join(point_dir, 'state')
+    s.data_discs = data_discs
+    s.parity_discs = parity_discs
+    s.slices_per_disc = spd
+    s.group_slices_per_disc = k
+    slices = max(1, int(spd * data_discs * sets))
+    s.digits = len(str(slices)) + 1
+    # make the discs just big enough for slices of about slice_MiB
+    s.disc_size_MiB = int((s.reserve_space_KiB + spd * (slice_MiB * 1024 + 4))
+                          / 1024) + 1
+    library = DiscLibrary(os.path.join(point_dir, 'discs'), model)
+    d = SimulatedRestore(s, library)
+    basename = 'bench'
+    build_library(d, library, basename, slices)
+    if kept:
+        keep_last_group(d, library, basename, slices)
+    slices_per_set = d.geometry.slices_per_set
+    files_on_discs = sum(len(files) for _, _, files in os.walk(library.root))
+    if scenario == 'full':
+        wanted = range(1, slices + 1)
+    else:
+        # like TestPartialRestore: the end of one set into the next
+        wanted = range(min(slices, int(slices_per_set * 0.86)) or 1,
+                       min(slices, int(slices_per_set * 1.08)) + 1)
+    began = time.process_time()
+    with darbrrb.working_directory(scratch_dir):
+        restore(d, basename, slices, wanted)
+    cpu_seconds = time.process_time() - began
+    shutil.rmtree(point_dir)
+    return {
+        'benchmark': 'restore', 'scenario': scenario, 'errors': errors,
+        'kept_last_group': kept,
+        'slices_per_disc': spd, 'data_discs': data_discs,
+        'parity_discs': parity_discs, 'group_slices_per_disc': k,
+        'slices': slices,
+        'slices_wanted': len(wanted), 'slice_MiB': d.geometry.slice_size_MiB,
+        'model': model,
+        'disc_insertions': d.insertions,
+        'bytes_copied': d.bytes_copied,
+        'parchive_runs': d.parchive_runs,
+        'files_on_discs': files_on_discs,
+        'failed_groups': d.failed_groups,
+        'unreadable_files': d.unreadable_files,
+        'truncated_files': d.truncated_files,
+        'scratch_high_water_bytes': d.scratch_high_water,
+        'simulated_seconds': d.clock,
+        'cpu_seconds': cpu_seconds,
+    }
+
+def int_list(text):
+    return [int(x) for x in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='darbrrb restore benchmark')
+    parser.add_argument('-o', '--output', default='bench_results.jsonl')
+    parser.add_argument('--slices-per-disc', type=int_list,
+                        default=[5, 50, 500])
+    parser.add_argument('--data-discs', type=int_list, default=[3])
+    parser.add_argument('--parity-discs', type=int_list, default=[2])
+    parser.add_argument('--group-slices-per-disc', type=int_list,
+                        default=[1])
+    parser.add_argument('--sets', type=float, default=2.5)
+    parser.add_argument('--slice-MiB', type=float, default=47)
+    parser.add_argument('--swap-seconds', type=float, default=60)
+    parser.add_argument('--read-rate', type=float, default=18,
+                        help='optical read speed, MiB/s')
+    parser.add_argument('--error-seconds', type=float, default=120,
+                        help='time spent failing to read a bad file')
+    parser.add_argument('--parchive-rate', type=float, default=60)
+    parser.add_argument('--dar-rate', type=float, default=50)
+    parser.add_argument('--unreadable', type=float, default=0.005,
+                        help='fraction of files that cannot be read')
+    parser.add_argument('--truncated', type=float, default=0.005,
+                        help='fraction of files that can be read partway')
+    parser.add_argument('--seed', default='darbrrb')
+    parser.add_argument('--kept-last-group', action='store_true')
+    parser.add_argument('--workdir', default=None)
+    args = parser.parse_args()
+    # the errors we inject are counted; don't print each one
+    logging.getLogger('darbrrb').setLevel(logging.ERROR)
+    model = {'swap_seconds': args.swap_seconds,
+             'read_MiB_per_s': args.read_rate,
+             'error_seconds': args.error_seconds,
+             'parchive_MiB_per_s': args.parchive_rate,
+             'dar_MiB_per_s': args.dar_rate,
+             'unreadable': args.unreadable, 'truncated': args.truncated,
+             'seed': args.seed}
+    workdir = tempfile.mkdtemp(prefix='darbrrb_bench', dir=args.workdir)
+    results = []
+    try:
+        for spd, dd, pd, k, scenario, errors in itertools.product(
+                args.slices_per_disc, args.data_discs, args.parity_discs,
+                args.group_slices_per_disc, ('full', 'partial'),
+                (False, True)):
+            if spd % k:
+                continue
+            r = run_scenario(workdir, spd, dd, pd, k, args.sets,
+                             args.slice_MiB, scenario, errors,
+                             args.kept_last_group, model)
+            results.append(r)
+            print('{spd:5d} slices/disc {dd:2d}+{pd:<2d} k {k:3d} '
+                  '{scenario:7s} {errors:9s}: {files:6d} files, '
+                  '{ins:5d} insertions, {copied:10.1f} MiB '
+                  'copied, {runs:5d} parchive runs ({failed} failed), '
+                  'scratch {high:9.1f} MiB, {hours:7.2f} h simulated, '
+                  '{cpu:6.2f} s CPU'.format(
+                      spd=spd, dd=dd, pd=pd, k=k, scenario=scenario,
+                      files=r['files_on_discs'],
+                      errors='errors' if errors else 'no errors',
+                      ins=r['disc_insertions'],
+                      copied=r['bytes_copied'] / 1048576,
+                      runs=r['parchive_runs'], failed=r['failed_groups'],
+                      high=r['scratch_high_water_bytes'] / 1048576,
+                      hours=r['simulated_seconds'] / 3600,
+                      cpu=r['cpu_seconds']), flush=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    benchlib.append_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# Whole-backup simulation. For each geometry in the sweep, this backs up and
+# then restores an archive of the given number of sets, with darbrrb's real
+# hook code working on a MemoryFilesystem: the scratch directory, the state
+# directory and the library of discs are all in memory, and the slices and
+# parity volumes have their full sizes but no contents. dar and parchive
+# are stood in for by making the files they would have made, and discs are
+# "burned" into the library as when actually_burn is off. So what is
+# measured is the cost of darbrrb's own logic, apart from I/O:
+#
+# * CPU seconds for the backup hooks and for the restore hooks;
+# * the most bytes there ever were in memory (scratch, state and library);
+# * discs in the library, and files on them.
+#
+# Results are appended to a JSONL file (see benchlib) so that versions can
+# be compared.
+#
+# Usage: python3 bench/simulate.py [-o results.jsonl] [--slices-per-disc 500]
+#            [--data-discs 3] [--parity-discs 2] [--group-slices-per-disc 1]
+#            [--sets 20] [--slice-MiB 47]
+
+import argparse
+import itertools
+import logging
+import time
+
+import benchlib
+import darbrrb
+
+def settings_for(spd, data_discs, parity_discs, k, slice_MiB, slices):
+    s = darbrrb.Settings()
+    s.scratch_dir = '/scratch'
+    s.state_dir = '/state'
+    s.media_directory = '/library'
+    s.actually_burn = False
+    s.data_discs = data_discs
+    s.parity_discs = parity_discs
+    s.slices_per_disc = spd
+    s.group_slices_per_disc = k
+    s.digits = len(str(slices)) + 1
+    # make the discs just big enough for slices of about slice_MiB
+    s.disc_size_MiB = int((s.reserve_space_KiB + spd * (slice_MiB * 1024 + 4))
+                          / 1024) + 1
+    s.expected_data_size_GiB = slices * s.slice_size_KiB / 1048576
+    return s
+
+class SimulatedDarbrrb(darbrrb.Darbrrb):
+    def __init__(self, settings, fs):
+        super().__init__(settings, benchlib.darbrrb_path, fs=fs)
+        self.parchive_runs = 0
+
+    def _run(self, *args):
+        if args[0] != 'parchive':
+            raise Exception('not simulated', args)
+        self.parchive_runs += 1
+        if args[1] == 'r':
+            # everything was read whole; nothing to repair
+            return
+        volumes = int(args[1][len('-n'):])
+        parfilename = args[3]
+        self.fs.make_file(parfilename, 96 + 120 * len(args[4:]))
+        size = int(self.geometry.slice_size_KiB * 1024)
+        for i in range(volumes):
+            self.fs.make_file('{}p{:02d}'.format(parfilename[:-3], i + 1),
+                              size + 96 + 120 * len(args[4:]))
+
+def back_up(d, basename, slices):
+    size = int(d.geometry.slice_size_KiB * 1024)
+    d.ensure_scratch()
+    # as dar would run the hooks: in the scratch directory
+    d.fs.cwd = d.settings.scratch_dir
+    for n in range(1, slices + 1):
+        d.fs.make_file(d._slice_name(basename, n, 'dar'), size)
+        d._create('dir', basename, str(n), 'dar',
+                  'last_slice' if n == slices else 'operating')
+
+def restore(d, basename, slices):
+    d.settings.scratch_dir = '/restore'
+    d.ensure_scratch()
+    d.fs.cwd = d.settings.scratch_dir
+    d._extract('dir', basename, '0', 'dar', 'init')
+    d._extract('dir', basename, str(slices), 'dar', 'init')
+    for n in range(1, slices + 1):
+        d._extract('dir', basename, str(n), 'dar', 'operating')
+
+def run_point(spd, data_discs, parity_discs, k, sets, slice_MiB):
+    slices = max(1, int(spd * data_discs * sets))
+    fs = darbrrb.MemoryFilesystem()
+    fs.makedirs('/library')
+    d = SimulatedDarbrrb(settings_for(spd, data_discs, parity_discs, k,
+                                      slice_MiB, slices), fs)
+    basename = 'bench'
+    began = time.process_time()
+    back_up(d, basename, slices)
+    backup_cpu_seconds = time.process_time() - began
+    discs = fs.listdir('/library')
+    files_on_discs = sum(len(fs.listdir('/library/' + title))
+                         for title in discs)
+    backup_parchive_runs = d.parchive_runs
+    began = time.process_time()
+    restore(d, basename, slices)
+    restore_cpu_seconds = time.process_time() - began
+    return {
+        'benchmark': 'simulate',
+        'slices_per_disc': spd, 'data_discs': data_discs,
+        'parity_discs': parity_discs, 'group_slices_per_disc': k,
+        'slices': slices, 'slice_MiB': d.geometry.slice_size_MiB,
+        'discs': len(discs), 'files_on_discs': files_on_discs,
+        'backup_parchive_runs': backup_parchive_runs,
+        'restore_parchive_runs': d.parchive_runs - backup_parchive_runs,
+        'high_water_bytes': fs.high_water_bytes,
+        'backup_cpu_seconds': backup_cpu_seconds,
+        'restore_cpu_seconds': restore_cpu_seconds,
+    }
+
+def int_list(text):
+    return [int(x) for x in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='darbrrb simulation')
+    parser.add_argument('-o', '--output', default='bench_results.jsonl')
+    parser.add_argument('--slices-per-disc', type=int_list, default=[500])
+    parser.add_argument('--data-discs', type=int_list, default=[3])
+    parser.add_argument('--parity-discs', type=int_list, default=[2])
+    parser.add_argument('--group-slices-per-disc', type=int_list,
+                        default=[1])
+    parser.add_argument('--sets', type=float, default=20)
+    parser.add_argument('--slice-MiB', type=float, default=47)
+    args = parser.parse_args()
+    logging.getLogger('darbrrb').setLevel(logging.ERROR)
+    results = []
+    for spd, dd, pd, k in itertools.product(
+            args.slices_per_disc, args.data_discs, args.parity_discs,
+            args.group_slices_per_disc):
+        if spd % k:
+            continue
+        r = run_point(spd, dd, pd, k, args.sets, args.slice_MiB)
+        results.append(r)
+        print('{spd:5d} slices/disc {dd:2d}+{pd:<2d} k {k:3d}: {slices:6d} '
+              'slices, {discs:4d} discs, {files:7d} files, {gib:9.1f} GiB '
+              'at most, backup {b:7.2f} s CPU, restore {r:7.2f} s '
+              'CPU'.format(spd=spd, dd=dd, pd=pd, k=k, slices=r['slices'],
+                           discs=r['discs'], files=r['files_on_discs'],
+                           gib=r['high_water_bytes'] / 1073741824,
+                           b=r['backup_cpu_seconds'],
+                           r=r['restore_cpu_seconds']), flush=True)
+    benchlib.append_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# Start-up benchmark. dar runs a darbrrb hook for every slice, and each one
+# is a new Python process, so what it costs to start matters. This makes a
+# scratch directory as darbrrb dar would, then times, over many runs, each
+# way of starting the program that a hook could use:
+#
+# * script: the copy of darbrrb.py in the scratch directory, run as a
+#   script, as the hooks were before: compiled every time, tests and all;
+# * hook: the compiled hook that ensure_scratch makes and the darrc runs.
+#
+# Each run does the progress subcommand, which reads one small file, so
+# nearly all of its time is starting up. For each, it reports wall time per
+# run, and the time Python says it spent importing (-X importtime).
+#
+# Results are appended to a JSONL file (see benchlib) so that versions can
+# be compared.
+#
+# Usage: python3 bench/startup.py [-o results.jsonl] [--runs 50]
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import benchlib
+import darbrrb
+
+def import_microseconds(stderr):
+    # the last line is the module run, whose cumulative time includes all
+    # the rest; but a script run as __main__ is not listed, so add up the
+    # top-level imports
+    total = 0
+    for line in stderr.decode('UTF-8', 'replace').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line.split('|')
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue
+        if not fields[2].startswith('  '):
+            total += cumulative
+    return total
+
+def time_runs(program, runs, cwd):
+    command = [sys.executable, program, 'progress']
+    seconds = []
+    for i in range(runs):
+        began = time.monotonic()
+        subprocess.run(command, cwd=cwd, check=True,
+                       stdout=subprocess.DEVNULL)
+        seconds.append(time.monotonic() - began)
+    importing = subprocess.run([sys.executable, '-X', 'importtime'] +
+                               command[1:], cwd=cwd, check=True,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE).stderr
+    return seconds, import_microseconds(importing) / 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description='darbrrb start-up benchmark')
+    parser.add_argument('-o', '--output', default='bench_results.jsonl')
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--workdir', default=None)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix='darbrrb_bench', dir=args.workdir)
+    results = []
+    try:
+        s = darbrrb.Settings()
+        s.measure('scratch_dir', os.path.join(workdir, 'scratch'))
+        s.measure('state_dir', os.path.join(workdir, 'state'))
+        s.measure('disc_size_MiB', 100)
+        s.measure('slices_per_disc', 1)
+        d = darbrrb.Darbrrb(s, benchlib.darbrrb_path)
+        d.ensure_scratch()
+        programs = [('script', os.path.join(s.scratch_dir, 'darbrrb.py'))]
+        if os.path.exists(os.path.join(s.scratch_dir, 'darbrrb_hook.pyc')):
+            programs.append(('hook', os.path.join(s.scratch_dir,
+                                                  'darbrrb_hook.pyc')))
+        for how, program in programs:
+            seconds, import_seconds = time_runs(program, args.runs,
+                                                s.scratch_dir)
+            r = {'benchmark': 'startup', 'how': how, 'runs': args.runs,
+                 'seconds': benchlib.summarize(seconds),
+                 'import_seconds': import_seconds}
+            results.append(r)
+            print('{how:6s}: {mean:6.3f}s mean {p95:6.3f}s p95 per run, '
+                  '{imp:6.3f}s importing'.format(
+                      how=how, mean=r['seconds']['mean'],
+                      p95=r['seconds']['p95'], imp=import_seconds),
+                  flush=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    benchlib.append_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
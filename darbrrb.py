@@ -36,16 +36,16 @@ darrc_template = """
 -v
 create:
 --compression=bzip2
--E "python3 {progname} {progargs} _create %p %b %n %e %c"
+-E "{python} {progname} {progargs} _create %p %b %n %e %c"
 extract:
 -O
--E "python3 {progname} {progargs} _extract %p %b %n %e %c"
+-E "{python} {progname} {progargs} _extract %p %b %n %e %c"
 list:
--E "python3 {progname} {progargs} _list %p %b %n %e %c"
+-E "{python} {progname} {progargs} _list %p %b %n %e %c"
 test:
--E "python3 {progname} {progargs} _test %p %b %n %e %c"
+-E "{python} {progname} {progargs} _test %p %b %n %e %c"
 isolate:
--E "python3 {progname} {progargs} _isolate %p %b %n %e %c"
+-E "{python} {progname} {progargs} _isolate %p %b %n %e %c"
 """
 
 class Settings:
@@ -54,14 +54,112 @@ class Settings:
     burner_device = '/dev/null'
 
 # SCRATCH_DIR must have (DATA_DISCS + PARITY_DISCS) * DISC_SIZE mebibytes free
-# to run backup. SCRATCH_DIR must not exist when this script is run.
+# to run backup. SCRATCH_DIR must be empty, or not exist, when a backup is
+# begun; a restore may be run again in the same SCRATCH_DIR.
 # SCRATCH_DIR must not be a subdirectory of the directory being backed up.
     scratch_dir = '/home/tmp/backup_scratch'
 
+# If STAGING_DIR is set, the discs are put together there instead, and it is
+# STAGING_DIR that needs the (DATA_DISCS + PARITY_DISCS) * DISC_SIZE
+# mebibytes. SCRATCH_DIR then only needs room for dar and parchive to make
+# HOT_GROUPS parity groups: it can be a small fast disk, and STAGING_DIR a
+# big slow one. A mover takes each group from one to the other while dar goes
+# on; when HOT_GROUPS groups are waiting for it, dar waits too.
+    staging_dir = None
+    hot_groups = 3
+
+# STATE_DIR holds records that outlive a single backup, such as the cached
+# results of scanning the directory being backed up. Unlike SCRATCH_DIR, it
+# may already exist.
+    state_dir = '~/.darbrrb'
+
+# So that a restore on this machine can start with the first set of discs, a
+# backup keeps the last parity group of each of its archives in STATE_DIR: a
+# disc's worth of slices per archive, at the most. Only those of the
+# LAST_GROUPS_KEPT backups made most recently are kept; 0 keeps none.
+    last_groups_kept = 3
+
 # This ballpark figure is used to calculate the number of digits to
-# use when numbering archive slices.
+# use when numbering archive slices. When backing up, darbrrb scans the
+# directory being backed up and replaces this figure with what it measured,
+# in the copy of this script that it puts on each disc.
     expected_data_size_GiB = 500.0
 
+# How many directories to read at once when scanning the directory being
+# backed up.
+    prescan_threads = 8
+
+# Progress is kept in SCRATCH_DIR/progress.json. If you would like
+# node-exporter to scrape it, set this to the directory given to its
+# --collector.textfile.directory, and darbrrb.prom will be kept there too.
+    textfile_dir = None
+
+# Every darbrrb process, including the one dar runs for each slice, logs to
+# SCRATCH_DIR/darbrrb.log. When it grows past LOG_MAX_MIB mebibytes, it is
+# compressed and a new one started; the newest LOG_KEEP of those are kept.
+    log_max_MiB = 64
+    log_keep = 20
+
+# How discs get into the drive. 'prompt' asks you to put them in. 'changer'
+# has an autoloader do it, by running MEDIA_CHANGER_COMMAND with one of
+#     load-blank        put a blank disc in the burner
+#     load TITLE        put the disc entitled TITLE in the drive
+#     mount-path        mount the disc in the drive; print where its files are
+#     eject             unmount it and put it back
+#     inventory         print the titles of the discs it has, one per line
+# after it. 'directory' reads discs from directories named by disc title in
+# MEDIA_DIRECTORY, as when you have copied discs onto a hard drive; it's
+# what the -n switch uses, with SCRATCH_DIR. 'iso' reads discs from the ISO
+# images in MEDIA_DIRECTORY, found by volume id, without mounting them; it's
+# what the -o switch uses. It has no blank discs, so to back up with it, use
+# -o too.
+    media_backend = 'prompt'
+    media_changer_command = None
+    media_directory = None
+
+# If set (the -o switch does it), discs aren't burned: an ISO 9660 image of
+# each is written into this directory, named after the disc's title.
+# Burn them later (growisofs -Z /dev/dvd=IMAGE), or keep them as they are.
+# When restoring, discs are read from the images here.
+    iso_dir = None
+
+# If IMAGE_DIR is set, darbrrb masters each disc's ISO 9660 image there, and
+# growisofs only writes it, instead of growisofs doing both from the disc's
+# directory. The images of the next discs are made while this one burns, as
+# many as IMAGE_DIR has room for; a tmpfs will do, if there's the memory. A
+# disc's directory is kept until its disc has burned, so losing IMAGE_DIR
+# loses nothing. The burner reads BURN_BUFFER_MiB of the image ahead of the
+# drive, so that other disk traffic, like the image being made, doesn't
+# starve it.
+    image_dir = None
+    burn_buffer_MiB = 256
+
+# When a command fails, darbrrb asks whether to try again. Unattended (the
+# -u switch), it instead follows the retry policy for the command: try up to
+# ATTEMPTS times, waiting DELAY_SECONDS, then BACKOFF times as long each
+# time after that; but only if the exit code is among TRANSIENT_EXIT_CODES
+# (None means any). The policy named '*' is for commands not listed. When a
+# command has failed for good, ALERT_COMMAND, if set, is run with a message
+# saying what failed as its last argument, before darbrrb gives up.
+    retry_policies = {
+        'growisofs': dict(attempts=3, delay_seconds=60, backoff=2,
+                          transient_exit_codes=None),
+        # a set parchive can't repair won't be repaired by trying again
+        'parchive': dict(attempts=2, delay_seconds=5, backoff=1,
+                         transient_exit_codes=None),
+        # dar itself is the whole backup
+        'dar': dict(attempts=1, delay_seconds=0, backoff=1,
+                    transient_exit_codes=None),
+        '*': dict(attempts=3, delay_seconds=10, backoff=2,
+                  transient_exit_codes=None),
+    }
+    alert_command = None
+
+# How many commands darbrrb may run at once where it can, such as parchive
+# repairing the parity groups fetched for a restore. None means as many as
+# there are processors.
+    cpu_slots = None
+
 # Each redundancy set is composed of (DATA_DISCS + PARITY_DISCS) discs.
 # These are like hard disk shelves with RAID, but with discs instead.
     data_discs = 3
@@ -72,6 +170,14 @@ class Settings:
 # let's be slightly wasteful.
     slices_per_disc = 500
 
+# How many slices from each data disc go into a parity group? Each group has
+# its own par file, on every disc of the set, and its own parchive run; wider
+# groups mean fewer of both. Whole discs can be lost either way, since each
+# parity disc gets as many parity volumes of each group as each data disc
+# gets slices. SLICES_PER_DISC must be a multiple of it, and PAR1 can't
+# handle more than 256 files, slices and parity volumes together, in a group.
+    group_slices_per_disc = 1
+
 # How much space is on a disc?
     # BluRay
     # https://superuser.com/a/565999 "256MB for defect management"
@@ -90,6 +196,23 @@ class Settings:
     # Rock Ridge + Joliet filesystem overhead at 362K + 1.7K per filename.
     reserve_space_KiB = 10240
 
+    def __init__(self):
+        self.measured = {}
+
+    # Darbrrb keeps a Geometry made from these settings; counting changes
+    # lets it know when to make a new one.
+    generation = 0
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        super().__setattr__('generation', self.generation + 1)
+
+    # Settings we measure, rather than read from above, are written into the
+    # copy of this script that dar runs and that goes on every disc, so that
+    # later invocations calculate the same things we did.
+    def measure(self, name, value):
+        setattr(self, name, value)
+        self.measured[name] = value
+
     # calculated settings
 
     @property
@@ -100,10 +223,23 @@ class Settings:
     def total_set_count(self):
         return self.data_discs + self.parity_discs
 
+    @property
+    def slices_per_group(self):
+        return self.data_discs * self.group_slices_per_disc
+
     @property
     def scratch_free_needed_MiB(self):
         return self.total_set_count * self.disc_size_MiB
 
+    # with a STAGING_DIR: the slices and parity volumes of HOT_GROUPS groups;
+    # but see Geometry.hot_free_needed_MiB
+    @property
+    def hot_free_needed_MiB(self):
+        return math.ceil(self.hot_groups * (
+            self.slices_per_group +
+            self.parity_discs * self.group_slices_per_disc) *
+                         self.slice_size_MiB)
+
     def _calculate_digits(self):
         expected_frac_slices = (self.expected_data_size_GiB * 1024.0 *
                                 self.slices_per_disc) / self.disc_size_MiB
@@ -124,18 +260,36 @@ class Settings:
     def number_format(self):
         return '{:0' + str(self.digits) + '}'
 
+    # These are upper bounds: they don't account for compression.
+    @property
+    def expected_slice_count(self):
+        return math.ceil(self.expected_data_size_GiB * 1048576 /
+                         self.slice_size_KiB)
+
+    @property
+    def expected_set_count(self):
+        return math.ceil(self.expected_slice_count / self.slices_per_set)
+
+    @property
+    def expected_disc_count(self):
+        return self.expected_set_count * self.total_set_count
+
     @property
     def _slice_size_not_counting_par_overhead_KiB(self):
-        return ((self.disc_size_KiB - self.reserve_space_KiB) //
+        return ((self.disc_size_KiB - self.reserve_space_KiB -
+                 catalog_space_KiB(self.slices_per_set)) //
                 self.slices_per_disc)
 
     @property
     def slice_size_KiB(self):
         # This allows for 32-character dar slice filenames.
-        par_header_bytes = 96 + 120 * self.data_discs
-        # Each pXX file has a par header; and for each data_discs
-        # slices, there's a par file
-        par_overhead_bytes = par_header_bytes * (1 + 1 / self.data_discs)
+        par_header_bytes = 96 + 120 * self.slices_per_group
+        # Each pXX file has a par header; and for each parity group, there's
+        # a par file, which goes on every disc in the set. So a parity disc
+        # carries a par header per slice, and a par file per
+        # group_slices_per_disc slices.
+        par_overhead_bytes = par_header_bytes + math.ceil(
+            par_header_bytes / self.group_slices_per_disc)
         par_overhead_KiB = (par_overhead_bytes + 1024) // 1024
         return self._slice_size_not_counting_par_overhead_KiB - par_overhead_KiB
 
@@ -156,31 +310,49 @@ class Settings:
 
     # -n switch turns this off
     actually_burn = True
+    # -u switch turns this on
+    unattended = False
 
 
 
-from itertools import chain
 import sys
+# asyncio and contextvars as the Scheduler uses them are from Python 3.7.
+# Run with an older one, say off a disc years from now, this says so rather
+# than failing on an import.
+if sys.version_info < (3, 7):
+    sys.exit('darbrrb needs Python 3.7 or later; this is Python {}'.format(
+        sys.version.split()[0]))
+
+from itertools import chain
 import os
 import shutil
 import glob
 import getopt
 import subprocess
-import tempfile
+import abc
 import contextlib
-import unittest
+import contextvars
 import logging
 import io
 import re
 import itertools
-import random
+import collections
 import math
-import pickle
-import base64
-try:
-    from unittest.mock import Mock, patch, sentinel, call
-except ImportError:
-    from mock import Mock, patch, sentinel, call
+import json
+import fcntl
+import errno
+import time
+import gzip
+import shlex
+import struct
+import stat
+import mmap
+import sqlite3
+import hashlib
+import threading
+# Others, needed only now and then, are imported where they are needed: dar
+# runs this program once per slice, and each import at the top costs every
+# time. See _compile_hook.
 
 
 def usage(settings):
@@ -191,8 +363,7 @@ across sets of {s.total_set_count} {s.disc_size_MiB} MiB optical discs, \
 each set containing {s.data_discs} data disc(s)
 and {s.parity_discs} parity disc(s). It \
 requires the following software (or later versions):
-Python 3.2; mock 1.0 (included in Python 3.3); dar 2.5.4*; parchive 1.1;
-growisofs 7.1; genisoimage 1.1.11.
+Python 3.7; dar 2.5.4*; parchive 1.1; growisofs 7.1; genisoimage 1.1.11.
 
 * If you are encrypting, you need change 8e64f413. If you have dar
 2.5.4 or later, you have change 8e64f413. If you don't (2.5.4 is not
@@ -207,11 +378,22 @@ When backing up, the directory {s.scratch_dir!r} should have
 {s.scratch_free_needed_MiB} MiB of space free. \
 When restoring, copy this script off of the optical
 disc first; you'll need to switch optical discs during the backup.
+If you set staging_dir among the settings, the discs are put together there
+instead, and it needs that much space; {s.scratch_dir!r} then needs only
+{s.hot_free_needed_MiB} MiB.
 
 If you don't like any of these settings, change this script. The
 settings are toward the top.
 
-Usage: python3 {progname} [-v] [-n] dar <dar parameters>
+Usage: python3 {progname} [-v] [-p] [-n|-o DIR] [-u] [-j N] [-i|-d] dar <dar parameters>
+       python3 {progname} plan <GiB or directory> [{media}] [parity discs] [group slices per disc]
+       python3 {progname} chain <basename or chain.json> [YYYY-MM-DDTHH:MM:SS]
+       python3 {progname} timings [timings.jsonl]
+       python3 {progname} profile [directory] [count]
+       python3 {progname} progress
+       python3 {progname} log [darbrrb.log] [name=value ...]
+       python3 {progname} catalog <path> [basename]
+       python3 {progname} export-catalog <basename> <file>
 
 Dar parameters of note:
     Creating archive:   -c <archive basename> -R <dir with files to backup>
@@ -223,12 +405,80 @@ fancy: only use the ones that tell dar which mode to operate in, and
 which files to archive.  Otherwise this script will not form a
 complete record of how dar was run.
 
+When creating an archive, the directory given with -R is scanned first, to
+plan slice numbering and show how many discs the backup will need.
+
+The plan subcommand finds the data_discs, slices_per_disc and so on that
+use the fewest discs to back up that much data onto that kind of disc, such
+that each set survives the loss of that many discs.
+
 The -v switch, before dar, means to be verbose and show the dar command
 being executed and the darrc used. The -n switch, before dar, means don't
 burn any discs: just make directories containing the files that would have
-been burned. (This can use much more scratch space.)
-
-""".format(s=settings, progname=sys.argv[0]),
+been burned. (This can use much more scratch space.) The -o switch, before
+dar, means don't burn any discs: write an ISO 9660 image of each into DIR,
+to burn or keep; when restoring, it means read the discs from the images in
+DIR, whatever they are named, without mounting them. The -j switch, before
+dar, means to split the files being backed up into N parts, by the entries
+directly inside the -R directory, and run N dars at once, one for each part;
+their slices are mixed together onto the same sets of discs. Give the same
+-j switch when restoring. The -u switch, before dar, means nobody is
+watching: failed commands are tried again according to retry_policies among
+the settings, and alert_command is run if they still fail.
+
+Each backup starts a chain of backups, kept in {s.state_dir!r}. The -i
+switch, before dar, means to back up only what has changed since the last
+backup in the chain with the same -c basename; -d, what has changed since the
+full backup that started the chain. These archives are named basename_002,
+basename_003, and so on. The chain subcommand says which archives, on which
+discs, to restore to get the files back as they were at a given time.
+
+How long each part of a backup or restore took (dar, parchive, copying,
+staging, waiting for you to change discs, burning) is written to
+timings.jsonl in {s.scratch_dir!r}. The timings subcommand adds it up by
+phase, and works out the throughput of each device.
+
+dar runs darbrrb again for every slice, so profiling any one of those says
+little. The -p switch, before dar, means each of them profiles itself, into
+the profiles directory in {s.scratch_dir!r}, which is emptied when the backup
+or restore begins. The profile subcommand adds them all up, and lists the
+functions _create and _extract spent the most time in.
+
+How far a backup or restore has got, and when it is likely to finish, is
+kept in progress.json in {s.scratch_dir!r}; the progress subcommand shows
+it. Set textfile_dir among the settings to have node-exporter pick it up.
+
+To start a restore, dar needs the last slices of the archive. So that you
+needn't begin with the last set of discs, a backup keeps the last parity
+group of each archive in last_groups in {s.state_dir!r}, and a restore on
+the same machine starts with the first set. Those of the last
+{s.last_groups_kept} backups are kept.
+
+If a restore stops partway through, run it again the same way, with the same
+scratch directory: restore_journal.json and the restore_journal directory
+there say which parity groups were already copied and repaired, and they are
+not asked for again.
+
+Every backup is recorded in catalog.sqlite in {s.state_dir!r}: how it was
+run, which disc each slice is on, and which slices each file is in. The
+catalog subcommand says which discs are needed to restore a file or
+directory (given relative to the -R directory) from the last backup with
+that basename that has it, or from the last backup at all. Each disc carries
+a catalog of its own set: its discs, and the slices on them with their
+checksums. export-catalog writes one of a whole backup, file names and all,
+to burn or keep.
+
+You will be asked to change discs, unless you set media_backend among the
+settings to have an autoloader do it, or to read discs you have copied into
+directories.
+
+Everything darbrrb logs goes to darbrrb.log in {s.scratch_dir!r}. The log
+subcommand shows it, older compressed logs first. Give it, for example,
+slice_ob=14, set_zb=0, disc_zb=2, group=7 or phase=parchive to see only what
+happened then.
+
+""".format(s=settings, progname=sys.argv[0],
+           media='|'.join(sorted(media_types))),
         file=sys.stderr)
 
 
@@ -241,80 +491,1930 @@ def working_directory(newcwd):
     finally:
         os.chdir(oldcwd)
 
+# The directory being backed up is scanned before dar runs, so that the
+# number of digits in slice numbers, and the number of discs, can be planned
+# from its real size rather than a guess. Each directory's entry in the cache
+# is [mtime_ns, bytes, files, subdirectory names], for the files directly in
+# it; a directory whose mtime hasn't changed since the last scan is not read
+# again. (That misses files which have changed size without being created,
+# deleted or renamed; close enough for planning.)
+def _scan_directory(path, cached):
+    log = logging.getLogger('darbrrb')
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        if cached is not None and cached[0] == mtime_ns:
+            return cached
+        entries = list(os.scandir(path))
+    except OSError as e:
+        log.warning('could not scan directory %r: %s', path, e)
+        return [None, 0, 0, []]
+    size = files = 0
+    subdirs = []
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+                files += 1
+        except OSError as e:
+            log.warning('could not stat %r: %s', entry.path, e)
+    return [mtime_ns, size, files, subdirs]
+
+def scan_source_tree(root, cache=None, threads=8):
+    import concurrent.futures
+    # returns (bytes, files, new cache)
+    cache = cache or {}
+    new_cache = {}
+    total_bytes = total_files = 0
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        pending = {pool.submit(_scan_directory, root, cache.get(root)): root}
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                entry = new_cache[path] = future.result()
+                total_bytes += entry[1]
+                total_files += entry[2]
+                for name in entry[3]:
+                    subdir = os.path.join(path, name)
+                    pending[pool.submit(_scan_directory, subdir,
+                                        cache.get(subdir))] = subdir
+    return total_bytes, total_files, new_cache
+
+# Divide the entries directly under root into at most count groups of about
+# the same total size, for backing up in parallel. Sizes of directories come
+# from the cache scan_source_tree made.
+def split_source_tree(root, cache, count):
+    def subtree_bytes(path):
+        entry = cache.get(path)
+        if entry is None:
+            return 0
+        return entry[1] + sum(subtree_bytes(os.path.join(path, name))
+                              for name in entry[3])
+    sizes = []
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False):
+            sizes.append((subtree_bytes(entry.path), entry.name))
+        else:
+            sizes.append((entry.stat(follow_symlinks=False).st_size,
+                          entry.name))
+    groups = [[0, []] for i in range(count)]
+    # biggest first, each into the emptiest group so far
+    for size, name in sorted(sizes, key=lambda x: (-x[0], x[1])):
+        group = min(groups, key=lambda g: g[0])
+        group[0] += size
+        group[1].append(name)
+    return [sorted(names) for size, names in groups if names]
+
+# Media darbrrb can plan for: usable size in MiB, and how fast a typical
+# burner writes it, in MiB/s.
+media_types = {
+    'bluray': (23841 - 256, 17.2),
+    'dvd': (4482, 21.1),
+    'cd': (680, 6.9),
+}
+
+# Room on each disc for the catalog of its set (see Catalog.export), and for
+# archives.json and chain.json. A slice's row, with its checksum and the
+# index on it, measured at under 200 bytes; the rest, the backup's settings
+# and arguments and the two JSON files, doesn't grow with the set.
+def catalog_space_KiB(slices_per_set):
+    return 128 + math.ceil(slices_per_set * 256 / 1024)
+
+# ISO 9660 + Rock Ridge + Joliet overhead for a disc with this many files;
+# see reserve_space_KiB above.
+def filesystem_overhead_KiB(files):
+    return 362 + 1.7 * files
+
+# One way of laying out a backup of a given size on a given medium, with the
+# figures needed to compare it against other ways.
+class GeometryPlan:
+    # rough rates, good for comparing plans rather than for promises
+    dar_MiB_per_s = 25.0
+    parchive_MiB_per_s = 60.0
+    parchive_startup_s = 0.05
+    disc_swap_s = 120.0
+    # the README has the darrc and original arguments in it
+    readme_KiB = 16
+
+    def __init__(self, data_size_GiB, media, data_discs, parity_discs,
+                 slices_per_disc, program_KiB, group_slices_per_disc=1):
+        self.data_size_GiB = data_size_GiB
+        self.media = media
+        disc_size_MiB, self.write_MiB_per_s = media_types[media]
+        s = self.settings = Settings()
+        s.data_discs = data_discs
+        s.parity_discs = parity_discs
+        s.slices_per_disc = slices_per_disc
+        s.group_slices_per_disc = group_slices_per_disc
+        s.disc_size_MiB = disc_size_MiB
+        s.expected_data_size_GiB = data_size_GiB
+        # a slice or parity volume for each slice, a par file for each
+        # parity group; the README and this script; and the catalog,
+        # archives.json and chain.json, whose room is kept apart from this
+        # (see catalog_space_KiB)
+        self.filesystem_overhead_KiB = filesystem_overhead_KiB(
+            slices_per_disc + slices_per_disc // group_slices_per_disc + 5)
+        s.reserve_space_KiB = int(math.ceil(
+            (self.filesystem_overhead_KiB + program_KiB + self.readme_KiB) /
+            64) * 64)
+        self.slices = max(1, s.expected_slice_count)
+        self.sets = max(1, s.expected_set_count)
+        self.total_discs = self.sets * s.total_set_count
+
+    def feasible(self, max_slice_MiB):
+        s = self.settings
+        return (64 <= s.slice_size_KiB <= max_slice_MiB * 1024 and
+                s.slices_per_disc % s.group_slices_per_disc == 0 and
+                s.group_slices_per_disc * s.total_set_count <= 256)
+
+    @property
+    def parity_overhead(self):
+        return self.settings.parity_discs / self.settings.data_discs
+
+    @property
+    def filesystem_overhead(self):
+        s = self.settings
+        return ((s.reserve_space_KiB + catalog_space_KiB(s.slices_per_set)) /
+                s.disc_size_KiB)
+
+    @property
+    def last_set_fill(self):
+        s = self.settings
+        return (self.slices - (self.sets - 1) * s.slices_per_set) / \
+            s.slices_per_set
+
+    @property
+    def expected_seconds(self):
+        s = self.settings
+        data_MiB = self.data_size_GiB * 1024
+        burned_MiB = data_MiB * (1 + self.parity_overhead)
+        groups = math.ceil(self.slices / s.slices_per_group)
+        return (data_MiB / self.dar_MiB_per_s +
+                data_MiB * s.parity_discs / self.parchive_MiB_per_s +
+                groups * self.parchive_startup_s +
+                burned_MiB / self.write_MiB_per_s +
+                self.total_discs * self.disc_swap_s)
+
+    @property
+    def cost(self):
+        return (self.total_discs, self.expected_seconds)
+
+    def report(self):
+        return """\
+For {p.data_size_GiB:0.2f} GiB on {p.media} discs, surviving the loss of \
+{s.parity_discs} disc(s) per set:
+  {s.data_discs} data + {s.parity_discs} parity discs per set, \
+{s.slices_per_disc} slices of {s.slice_size_MiB:0.2f} MiB per disc
+  {p.sets} set(s), {p.total_discs} discs in all; the last set is \
+{p.last_set_fill:0.0%} full
+  parity overhead {p.parity_overhead:0.0%}, filesystem overhead \
+{p.filesystem_overhead:0.2%}
+  about {hours:0.1f} hours, counting {p.disc_swap_s:0.0f} s per disc swap
+""".format(p=self, s=self.settings, hours=self.expected_seconds / 3600)
+
+    def settings_text(self):
+        return ''.join('    {} = {!r}\n'.format(name,
+                                                getattr(self.settings, name))
+                       for name in ('data_discs', 'parity_discs',
+                                    'slices_per_disc', 'group_slices_per_disc',
+                                    'disc_size_MiB',
+                                    'reserve_space_KiB',
+                                    'expected_data_size_GiB'))
+
+slices_per_disc_choices = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300,
+                           400, 500, 750, 1000, 1500, 2000)
+
+# Search for the layout using the fewest discs, then taking the least time,
+# which can lose parity_discs discs out of each set. Slices are kept no
+# bigger than max_slice_MiB, because media decay truncates whole slices.
+def plan_geometry(data_size_GiB, media='bluray', parity_discs=2,
+                  max_data_discs=12, max_slice_MiB=64, program_KiB=None,
+                  group_slices_per_disc=1):
+    if program_KiB is None:
+        program_KiB = os.path.getsize(__file__) / 1024
+    best = None
+    for data_discs in range(1, max_data_discs + 1):
+        for slices_per_disc in slices_per_disc_choices:
+            plan = GeometryPlan(data_size_GiB, media, data_discs,
+                                parity_discs, slices_per_disc, program_KiB,
+                                group_slices_per_disc)
+            if plan.feasible(max_slice_MiB) and (
+                    best is None or plan.cost < best.cost):
+                best = plan
+    if best is None:
+        raise ValueError('no geometry fits', data_size_GiB, media,
+                         parity_discs)
+    return best
+
+# Find the value of a dar switch, e.g. the directory after -R.
+def dar_argument(args, *switches):
+    for i, a in enumerate(args[:-1]):
+        if a in switches:
+            return args[i+1]
+    return None
+
+# major:minor of the device a file is on, so throughput can be told apart
+# for the optical drive, the scratch disk and so on.
+def _device_of(filename):
+    try:
+        dev = os.stat(filename).st_dev
+    except OSError:
+        return None
+    return '{}:{}'.format(os.major(dev), os.minor(dev))
+
+def read_timings(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Time per phase, and bytes per second per device, from the spans written
+# by Darbrrb.timed. Spans nest, so the phase totals add up to more than the
+# wall time. A span that says what ran alongside it, like the mastering of an
+# image while the disc before burns, is counted apart from the same phase
+# alone, so that the two rates can be compared.
+def summarize_timings(spans):
+    phases = {}
+    devices = {}
+    for span in spans:
+        p = phases.setdefault(span['phase'],
+                              {'count': 0, 'seconds': 0.0, 'max': 0.0})
+        p['count'] += 1
+        p['seconds'] += span['seconds']
+        p['max'] = max(p['max'], span['seconds'])
+        if span.get('device') is not None and 'bytes' in span:
+            phase = span['phase']
+            if span.get('alongside'):
+                phase += '+' + span['alongside']
+            d = devices.setdefault((span['device'], phase),
+                                   {'bytes': 0, 'seconds': 0.0})
+            d['bytes'] += span['bytes']
+            d['seconds'] += span['seconds']
+    lines = ['{:<14} {:>7} {:>11} {:>10} {:>10}'.format(
+        'phase', 'count', 'total s', 'mean s', 'max s')]
+    for name, p in sorted(phases.items(), key=lambda i: -i[1]['seconds']):
+        lines.append('{:<14} {:>7} {:>11.3f} {:>10.4f} {:>10.4f}'.format(
+            name, p['count'], p['seconds'], p['seconds'] / p['count'],
+            p['max']))
+    if devices:
+        lines.append('')
+        lines.append('{:<20} {:<12} {:>12} {:>10}'.format(
+            'device', 'phase', 'MiB', 'MiB/s'))
+        for (device, phase), d in sorted(devices.items()):
+            MiB = d['bytes'] / 1048576
+            lines.append('{:<20} {:<12} {:>12.1f} {:>10}'.format(
+                device, phase, MiB,
+                '{:.1f}'.format(MiB / d['seconds']) if d['seconds'] else '-'))
+    return '\n'.join(lines)
+
+# The profiles written by Darbrrb.profiled, added up for each hook, and the
+# count functions that took the most time in it, not counting the functions
+# they called (own s); with them (cum s) is given too.
+def summarize_profiles(filenames, count=25):
+    import pstats
+    hooks = {}
+    for filename in filenames:
+        hooks.setdefault(os.path.basename(filename).split('.')[0],
+                         []).append(filename)
+    lines = []
+    for hook, names in sorted(hooks.items()):
+        stats = pstats.Stats(*names, stream=io.StringIO())
+        if lines:
+            lines.append('')
+        lines.append('{}: {} run(s), {:.3f} s'.format(hook, len(names),
+                                                    stats.total_tt))
+        lines.append('{:>10} {:>10} {:>10} {:>11}  {}'.format(
+            'own s', 'cum s', 'calls', 'ms per run', 'function'))
+        hottest = sorted(stats.stats.items(),
+                         key=lambda i: (-i[1][2], i[0]))[:count]
+        for (filename, line, name), (cc, nc, tt, ct, callers) in hottest:
+            lines.append('{:>10.3f} {:>10.3f} {:>10} {:>11.3f}  {}'.format(
+                tt, ct, nc, tt / len(names) * 1000, pstats.func_std_string(
+                    (os.path.basename(filename), line, name))))
+    return '\n'.join(lines)
+
+# Replace a file such that anyone reading it sees either the old contents or
+# the new, never half of either.
+def _write_atomically(filename, text):
+    with open(filename + '.new', 'wt') as f:
+        f.write(text)
+    os.replace(filename + '.new', filename)
+
+# (size, hex SHA-256) of a file
+def _sha256_of(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            sha256.update(chunk)
+        return f.tell(), sha256.hexdigest()
+
+# field in progress.json, metric name, help
+progress_metrics = (
+    ('slices_done', 'darbrrb_slices_done', 'Slices dar has finished.'),
+    ('bytes_archived', 'darbrrb_archived_bytes',
+     'Size of the slices dar has finished.'),
+    ('compression_ratio', 'darbrrb_compression_ratio',
+     'Archived bytes per byte backed up.'),
+    ('sets_burned', 'darbrrb_sets_burned', 'Sets of discs burned.'),
+    ('discs_burned', 'darbrrb_discs_burned', 'Discs burned.'),
+    ('projected_remaining_discs', 'darbrrb_projected_remaining_discs',
+     'Discs still to be burned, going by the compression ratio.'),
+    ('discs_read', 'darbrrb_discs_read', 'Discs read from.'),
+    ('slices_fetched', 'darbrrb_slices_fetched',
+     'Slices copied from discs.'),
+    ('bytes_fetched', 'darbrrb_fetched_bytes',
+     'Size of the files copied from discs.'),
+    ('groups_fetched', 'darbrrb_groups_fetched',
+     'Parity groups copied from discs.'),
+    ('groups_repaired', 'darbrrb_groups_repaired',
+     'Parity groups checked and repaired by parchive.'),
+    ('eta_seconds', 'darbrrb_eta_seconds',
+     'Seconds until finished, going by the rate so far.'),
+    ('updated', 'darbrrb_progress_updated_timestamp_seconds',
+     'When progress was last made.'),
+)
+
+# The node-exporter textfile collector format.
+def progress_textfile(progress):
+    labels = '{{mode="{}",basename="{}"}}'.format(
+        progress.get('mode', ''), progress.get('basename', ''))
+    lines = []
+    for field, metric, help in progress_metrics:
+        if progress.get(field) is not None:
+            lines.append('# HELP {} {}'.format(metric, help))
+            lines.append('# TYPE {} gauge'.format(metric))
+            lines.append('{}{} {}'.format(metric, labels, progress[field]))
+    return '\n'.join(lines) + '\n'
+
+def progress_report(progress):
+    lines = ['{} of {}{}'.format(
+        progress.get('mode', 'nothing'), progress.get('basename', '?'),
+        ', finished' if progress.get('finished') else '')]
+    for field, metric, help in progress_metrics:
+        if progress.get(field) is not None and field != 'updated':
+            lines.append('{:<26} {}'.format(field, progress[field]))
+    if progress.get('eta_seconds') is not None:
+        lines.append('{:<26} {}'.format('expected to finish', time.ctime(
+            progress['updated'] + progress['eta_seconds'])))
+    return '\n'.join(lines)
+
+# dar runs a new darbrrb for every slice. Rather than each leaving a log file
+# of its own, they all append to one, each record a line of JSON written with
+# a single write. Records carry the identifiers of the span they happened in
+# (see Darbrrb.timed), so the log can be searched by slice, set or phase.
+#
+# Rotation: the log is renamed only under an exclusive flock on it, and
+# writers write only under a shared flock, having checked that the file
+# they have open is still the one with the log's name. So once it has been
+# renamed, nobody writes to it, and it can be compressed.
+class SharedLogHandler(logging.Handler):
+    def __init__(self, filename, max_bytes, keep, context=None):
+        super().__init__()
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.context = context
+        self.fd = None
+        # records from before the log's directory exists
+        self.pending = []
+
+    def _open(self):
+        self.fd = os.open(self.filename,
+                          os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _is_current(self):
+        try:
+            return os.stat(self.filename).st_ino == os.fstat(self.fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _line(self, record):
+        entry = dict(self.context() if self.context else {},
+                     time=record.created, pid=record.process,
+                     level=record.levelname, logger=record.name,
+                     message=record.getMessage())
+        if record.exc_info:
+            entry['exception'] = logging.Formatter().formatException(
+                record.exc_info)
+        return (json.dumps(entry, sort_keys=True) + '\n').encode('UTF-8')
+
+    def _write(self, data):
+        while True:
+            if self.fd is None:
+                self._open()
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            try:
+                if self._is_current():
+                    os.write(self.fd, data)
+                    return os.fstat(self.fd).st_size
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            # someone rotated it
+            os.close(self.fd)
+            self.fd = None
+
+    def _rotate(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if (not self._is_current() or
+                    os.fstat(self.fd).st_size <= self.max_bytes):
+                # someone beat us to it
+                return
+            rotated = '{}.{:016d}'.format(self.filename,
+                                          int(time.time() * 1e6))
+            os.rename(self.filename, rotated)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        with open(rotated, 'rb') as f, gzip.open(rotated + '.gz', 'wb') as z:
+            shutil.copyfileobj(f, z)
+        os.unlink(rotated)
+        old_logs = rotated_logs(self.filename)
+        for old in old_logs[:max(len(old_logs) - self.keep, 0)]:
+            os.unlink(old)
+
+    def emit(self, record):
+        try:
+            data = self._line(record)
+            if self.fd is None:
+                try:
+                    self._open()
+                except FileNotFoundError:
+                    self.pending.append(data)
+                    return
+                data = b''.join(self.pending) + data
+                self.pending = []
+            if self._write(data) > self.max_bytes:
+                self._rotate()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        super().close()
+
+def rotated_logs(filename):
+    return sorted(glob.glob(glob.escape(filename) + '.' + '[0-9]' * 16 +
+                            '.gz'))
+
+# Every record in the log, oldest first, rotated logs included.
+def read_log(filename):
+    for rotated in rotated_logs(filename):
+        with gzip.open(rotated, 'rt') as f:
+            for line in f:
+                yield json.loads(line)
+    try:
+        with open(filename) as f:
+            for line in f:
+                # a hook may be writing the last line as we read
+                if line.endswith('\n'):
+                    yield json.loads(line)
+    except FileNotFoundError:
+        pass
+
+# criteria like {'slice_ob': '14', 'phase': 'parchive'}, as typed
+def filter_log(records, criteria):
+    for record in records:
+        if all(str(record.get(k)) == v for k, v in criteria.items()):
+            yield record
+
+log_identifiers = ('archive', 'slice_ob', 'set_zb', 'disc_zb', 'group',
+                   'title')
+
+def format_log_record(record):
+    context = ([record['phase']] if 'phase' in record else []) + [
+        '{}={}'.format(k, record[k]) for k in log_identifiers if k in record]
+    line = 'darbrrb {} [{}] {} {}{}: {}'.format(
+        record['pid'], time.strftime('%Y-%m-%d %H:%M:%S',
+                                     time.localtime(record['time'])),
+        record['level'], record['logger'],
+        ' ({})'.format(' '.join(context)) if context else '',
+        record['message'])
+    if 'exception' in record:
+        line += '\n' + record['exception']
+    return line
+
+# ISO 9660 images, with Rock Ridge and Joliet names, of the flat directory
+# of files that makes up a disc; the same thing growisofs -R -J would burn.
+# Every file is copied into the image once, starting on a sector boundary;
+# where the kernel can, it does the copying (and reflinks, on filesystems
+# that can share blocks), and the padding is left as holes.
+iso_sector = 2048
+
+def _both16(n):
+    return struct.pack('<H', n) + struct.pack('>H', n)
+
+def _both32(n):
+    return struct.pack('<I', n) + struct.pack('>I', n)
+
+def _iso_date7(when):
+    t = time.gmtime(when)
+    return bytes([t.tm_year - 1900, t.tm_mon, t.tm_mday, t.tm_hour,
+                  t.tm_min, t.tm_sec, 0])
+
+def _iso_date17(when):
+    return time.strftime('%Y%m%d%H%M%S00', time.gmtime(when)).encode(
+        'ascii') + b'\x00'
+
+# System Use Sharing Protocol entries, which carry the Rock Ridge
+# information
+def _susp(signature, data):
+    return signature + bytes([4 + len(data), 1]) + data
+
+def _rock_ridge(st, name=None):
+    entries = (_susp(b'PX', _both32(st.st_mode) + _both32(st.st_nlink) +
+                     _both32(st.st_uid) + _both32(st.st_gid)) +
+               # modification and access times
+               _susp(b'TF', b'\x06' + _iso_date7(st.st_mtime) +
+                     _iso_date7(st.st_atime)))
+    if name is not None:
+        entries += _susp(b'NM', b'\x00' + name.encode('UTF-8'))
+    return entries
+
+rock_ridge_er = _susp(b'ER', bytes([10, 84, 135, 1]) +
+    b'RRIP_1991A' +
+    b'THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT FOR POSIX FILE '
+    b'SYSTEM SEMANTICS' +
+    b'PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE.  SEE '
+    b'PUBLISHER IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR FOR CONTACT '
+    b'INFORMATION.')
+
+def _iso_directory_record(extent, size, when, flags, identifier,
+                          system_use=b''):
+    pad = b'\x00' if len(identifier) % 2 == 0 else b''
+    record = (_both32(extent) + _both32(size) + _iso_date7(when) +
+              bytes([flags, 0, 0]) + _both16(1) + bytes([len(identifier)]) +
+              identifier + pad + system_use)
+    if len(record) % 2:
+        record += b'\x00'
+    if len(record) + 2 > 255:
+        raise ValueError('directory record too long', identifier)
+    return bytes([len(record) + 2, 0]) + record
+
+# Records may not straddle sectors.
+def _iso_directory_extent(records):
+    extent = bytearray()
+    for record in records:
+        if len(extent) % iso_sector + len(record) > iso_sector:
+            extent += bytes(-len(extent) % iso_sector)
+        extent += record
+    return bytes(extent + bytes(-len(extent) % iso_sector))
+
+# Level 2 names: 30 d-characters at most, one dot. Rock Ridge and Joliet
+# carry the real ones.
+def _iso_names(names):
+    used = set()
+    result = {}
+    for name in names:
+        base, dot, ext = name.rpartition('.')
+        if not dot:
+            base, ext = name, ''
+        base = re.sub('[^A-Z0-9_]', '_', base.upper())
+        ext = re.sub('[^A-Z0-9_]', '_', ext.upper())[:8]
+        stem = base[:29 - len(ext)]
+        n = 0
+        while stem + '.' + ext in used:
+            n += 1
+            stem = base[:29 - len(ext) - len(str(n))] + str(n)
+        used.add(stem + '.' + ext)
+        result[name] = stem + '.' + ext + ';1'
+    return result
+
+def _iso_text(text, length, joliet=False):
+    if joliet:
+        encoded = text.encode('UTF-16-BE')[:length & ~1]
+        return encoded + ' '.encode('UTF-16-BE') * (
+            (length - len(encoded)) // 2) + b' ' * (length % 2)
+    return text.encode('ascii', 'replace')[:length].ljust(length, b' ')
+
+def _iso_volume_descriptor(kind, volume_id, space_size, path_table_size,
+                           l_path_table, m_path_table, root_record, when,
+                           escape=b''):
+    joliet = kind == 2
+    vd = (bytes([kind]) + b'CD001\x01\x00' + _iso_text('', 32, joliet) +
+          _iso_text(volume_id, 32, joliet) + bytes(8) +
+          _both32(space_size) + escape.ljust(32, b'\x00') + _both16(1) +
+          _both16(1) + _both16(iso_sector) + _both32(path_table_size) +
+          struct.pack('<I', l_path_table) + bytes(4) +
+          struct.pack('>I', m_path_table) + bytes(4) + root_record +
+          _iso_text('', 128, joliet) * 3 + _iso_text('DARBRRB', 128, joliet) +
+          b' ' * 37 * 3 + _iso_date17(when) * 2 + b'0' * 16 + b'\x00' +
+          _iso_date17(when) + b'\x01')
+    return vd.ljust(iso_sector, b'\x00')
+
+def _iso_path_table(root_extent, byte_order):
+    return (b'\x01\x00' + struct.pack(byte_order + 'I', root_extent) +
+            struct.pack(byte_order + 'H', 1) + b'\x00\x00').ljust(
+                iso_sector, b'\x00')
+
+def _copy_into_image(source, out_fd, offset, size):
+    with open(source, 'rb') as f:
+        copied = 0
+        try:
+            while copied < size:
+                n = os.copy_file_range(f.fileno(), out_fd, size - copied,
+                                       copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except (AttributeError, OSError):
+            # no copy_file_range here, or not between these filesystems
+            f.seek(copied)
+            while copied < size:
+                data = f.read(min(size - copied, 1048576))
+                if not data:
+                    break
+                os.pwrite(out_fd, data, offset + copied)
+                copied += len(data)
+    if copied != size:
+        raise ValueError('file changed size while imaged', source)
+
+# About how big the image of a directory will be: its files, each taking
+# whole sectors, and a mebibyte for the rest.
+def iso_image_size(fs, directory):
+    return 1048576 + sum(
+        -(-fs.getsize(f) // iso_sector) * iso_sector + iso_sector
+        for f in fs.glob(os.path.join(directory, '*')))
+
+def write_iso_image(filename, volume_id, directory):
+    when = time.time()
+    names = sorted(os.listdir(directory))
+    stats = {name: os.stat(os.path.join(directory, name)) for name in names}
+    for name, st in stats.items():
+        if not stat.S_ISREG(st.st_mode):
+            raise ValueError('only files can go in an image', name)
+        if st.st_size > 0xffffffff:
+            raise ValueError('file too big for one extent', name)
+    root_st = os.stat(directory)
+    iso_names = _iso_names(names)
+    primary_order = sorted(names, key=lambda n: iso_names[n].partition('.'))
+    joliet_order = sorted(names, key=lambda n: n.encode('UTF-16-BE'))
+    # 16 sectors of system area; then primary and Joliet volume descriptors
+    # and the terminator; two pairs of path tables; the continuation area
+    # holding the Rock Ridge ER entry; the two root directories; the files.
+    continuation = 23
+    primary_root = 24
+
+    def directories(extents, primary_size, joliet_size):
+        joliet_root = primary_root + primary_size // iso_sector
+        def dot_records(root, size, dot_use=b'', dotdot_use=b''):
+            return [_iso_directory_record(root, size, when, 2, b'\x00',
+                                          dot_use),
+                    _iso_directory_record(root, size, when, 2, b'\x01',
+                                          dotdot_use)]
+        primary = _iso_directory_extent(dot_records(
+            primary_root, primary_size,
+            _susp(b'SP', b'\xbe\xef\x00') + _rock_ridge(root_st) +
+            _susp(b'CE', _both32(continuation) + _both32(0) +
+                  _both32(len(rock_ridge_er))),
+            _rock_ridge(root_st)) + [
+            _iso_directory_record(
+                extents.get(n, 0), stats[n].st_size, stats[n].st_mtime, 0,
+                iso_names[n].encode('ascii'), _rock_ridge(stats[n], n))
+            for n in primary_order])
+        joliet = _iso_directory_extent(dot_records(joliet_root,
+                                                   joliet_size) + [
+            _iso_directory_record(
+                extents.get(n, 0), stats[n].st_size, stats[n].st_mtime, 0,
+                n.encode('UTF-16-BE'))
+            for n in joliet_order])
+        return primary, joliet
+
+    # the sizes of the directories don't depend on where things are
+    primary, joliet = directories({}, 0, 0)
+    next_sector = primary_root + (len(primary) + len(joliet)) // iso_sector
+    extents = {}
+    for name in names:
+        extents[name] = next_sector
+        next_sector += -(-stats[name].st_size // iso_sector)
+    primary, joliet = directories(extents, len(primary), len(joliet))
+    joliet_root = primary_root + len(primary) // iso_sector
+    space_size = next_sector
+    header = (bytes(16 * iso_sector) +
+              _iso_volume_descriptor(
+                  1, volume_id, space_size, 10, 19, 20,
+                  _iso_directory_record(primary_root, len(primary), when, 2,
+                                        b'\x00'), when) +
+              _iso_volume_descriptor(
+                  2, volume_id, space_size, 10, 21, 22,
+                  _iso_directory_record(joliet_root, len(joliet), when, 2,
+                                        b'\x00'), when, escape=b'%/E') +
+              b'\xffCD001\x01'.ljust(iso_sector, b'\x00') +
+              _iso_path_table(primary_root, '<') +
+              _iso_path_table(primary_root, '>') +
+              _iso_path_table(joliet_root, '<') +
+              _iso_path_table(joliet_root, '>') +
+              rock_ridge_er.ljust(iso_sector, b'\x00') + primary + joliet)
+    fd = os.open(filename + '.new', os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 0o644)
+    try:
+        os.write(fd, header)
+        for name in names:
+            _copy_into_image(os.path.join(directory, name), fd,
+                             extents[name] * iso_sector, stats[name].st_size)
+        os.ftruncate(fd, space_size * iso_sector)
+    finally:
+        os.close(fd)
+    os.replace(filename + '.new', filename)
+
+# Reads the files in the root directory of an ISO 9660 image, by their Rock
+# Ridge names, else their Joliet ones, straight out of the image file. The
+# image is mapped into memory, and view gives a file's contents without
+# copying them; release views before closing.
+class IsoImage:
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.volume_id = iso_volume_id(self.map)
+        descriptors = {}
+        for sector in itertools.count(16):
+            vd = self.map[sector * iso_sector:(sector + 1) * iso_sector]
+            if vd[1:6] != b'CD001' or vd[0] == 255:
+                break
+            if vd[0] == 1 or (vd[0] == 2 and vd[88:91] in (b'%/@', b'%/C',
+                                                           b'%/E')):
+                descriptors.setdefault(vd[0], vd)
+        self.files = {}
+        for ident, extent, size, su in self._root(descriptors[1]):
+            name = _rock_ridge_name(su)
+            if name is None:
+                break
+            self.files[name] = (extent * iso_sector, size)
+        else:
+            return
+        if 2 in descriptors:
+            entries = self._root(descriptors[2])
+            decode = lambda ident: ident.decode('UTF-16-BE')
+        else:
+            entries = self._root(descriptors[1])
+            decode = lambda ident: ident.decode('ascii').rstrip('.')
+        self.files = {decode(ident).split(';')[0]: (extent * iso_sector, size)
+                      for ident, extent, size, su in entries}
+
+    # (identifier, extent, size, system use) of each file
+    def _root(self, vd):
+        root = vd[156:190]
+        offset = struct.unpack('<I', root[2:6])[0] * iso_sector
+        end = offset + struct.unpack('<I', root[10:14])[0]
+        while offset < end:
+            length = self.map[offset]
+            if length == 0:
+                # records don't straddle sectors
+                offset += -offset % iso_sector or iso_sector
+                continue
+            record = self.map[offset:offset + length]
+            offset += length
+            name_length = record[32]
+            ident = record[33:33 + name_length]
+            if record[25] & 2:
+                # a directory, maybe . or ..
+                continue
+            yield (ident, struct.unpack('<I', record[2:6])[0],
+                   struct.unpack('<I', record[10:14])[0],
+                   record[33 + name_length + 1 - name_length % 2:])
+
+    def names(self):
+        return sorted(self.files)
+
+    def view(self, name):
+        offset, size = self.files[name]
+        if offset + size > len(self.map):
+            raise OSError(errno.EIO, 'image is cut short', self.filename)
+        return memoryview(self.map)[offset:offset + size]
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def iso_volume_id(data):
+    pvd = data[16 * iso_sector:17 * iso_sector]
+    if pvd[:6] != b'\x01CD001':
+        raise ValueError('not an ISO 9660 image')
+    return pvd[40:72].decode('ascii', 'replace').rstrip()
+
+def _rock_ridge_name(system_use):
+    name = None
+    i = 0
+    while i + 4 <= len(system_use):
+        signature, length = system_use[i:i+2], system_use[i+2]
+        if length < 4 or signature == b'ST':
+            break
+        if signature == b'NM':
+            # long names are split over several NMs
+            name = (name or b'') + system_use[i+5:i+length]
+        i += length
+    return None if name is None else name.decode('UTF-8')
+
 class NotEnoughScratchSpace(Exception):
     pass
 
 class ScratchAlreadyExists(Exception):
     pass
 
+class BadGeometry(Exception):
+    pass
+
+class NoChain(Exception):
+    pass
+
+class NoSuchDisc(Exception):
+    pass
+
+# a disc's files were wanted, but no disc has been loaded
+class NoDiscLoaded(Exception):
+    pass
+
+# a blank disc was wanted from media that only has written ones
+class NoBlankDiscs(Exception):
+    pass
+
+class WrongBackup(Exception):
+    pass
+
+# what a command gets instead of running, when a Scheduler is stopping
+class Cancelled(Exception):
+    pass
+
+# Everything Darbrrb does with files goes through one of these, so that it
+# can be made to work on a MemoryFilesystem instead of the real one. Paths
+# are as os takes them: relative ones are relative to the current directory.
+class Filesystem:
+    def open(self, filename, mode='r', encoding=None):
+        return io.open(filename, mode, encoding=encoding)
+
+    def listdir(self, path='.'):
+        return os.listdir(path)
+
+    def glob(self, pattern):
+        return glob.glob(pattern)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def getsize(self, path):
+        return os.path.getsize(path)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def makedirs(self, path, exist_ok=False):
+        os.makedirs(path, exist_ok=exist_ok)
+
+    def unlink(self, path):
+        os.unlink(path)
+
+    def rmtree(self, path, ignore_errors=False):
+        shutil.rmtree(path, ignore_errors=ignore_errors)
+
+    def replace(self, source, destination):
+        os.replace(source, destination)
+
+    def copyfile(self, source, destination):
+        shutil.copyfile(source, destination)
+
+    def move(self, source, destination):
+        shutil.move(source, destination)
+
+    # with a single write, so that lines from processes running at once
+    # don't interleave
+    def append(self, filename, data):
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def write_atomically(self, filename, text):
+        _write_atomically(filename, text)
+
+    def sha256(self, filename):
+        return _sha256_of(filename)
+
+    def device_of(self, filename):
+        return _device_of(filename)
+
+    # says the file will be read soon, so it can be read into memory ahead
+    def will_read(self, filename):
+        with open(filename, 'rb') as f:
+            with contextlib.suppress(AttributeError, OSError):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+    def free_bytes(self, path):
+        s = os.statvfs(path)
+        return s.f_bavail * s.f_frsize
+
+    @contextlib.contextmanager
+    def lock(self, filename):
+        with open(filename, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # what to give sqlite3.connect, with uri=True
+    def sqlite_uri(self, filename):
+        import urllib.request
+        return 'file:' + urllib.request.pathname2url(
+            os.path.abspath(filename))
+
+    def compile(self, source, cfile, dfile):
+        import py_compile
+        py_compile.compile(source, cfile=cfile, dfile=dfile, doraise=True)
+
+real_filesystem = Filesystem()
+
+# How discs get into and out of the drive. load_blank and load put a disc in;
+# mount_path says where the files on the loaded disc can be read.
+class Media(abc.ABC):
+    def __init__(self, darbrrb):
+        self.darbrrb = darbrrb
+        self.settings = darbrrb.settings
+
+    @abc.abstractmethod
+    def load_blank(self):
+        pass
+
+    @abc.abstractmethod
+    def load(self, title):
+        pass
+
+    @abc.abstractmethod
+    def mount_path(self):
+        pass
+
+    def eject(self):
+        pass
+
+    # titles of the discs we could load, or None if we can't know
+    def inventory(self):
+        return None
+
+    # the files on the loaded disc, whose mount_path is disc_dir
+    def files(self, disc_dir):
+        return self.darbrrb.fs.listdir(disc_dir)
+
+    def copy(self, source, destination):
+        self.darbrrb._copy(source, destination)
+
+    # We don't know how many sets there are, so we find the last one among
+    # the discs there are. See Darbrrb.disc_title.
+    def load_last_set(self, basename, disc_number_in_set_zb):
+        title_re = re.compile(re.escape(basename[:(32-4-3-2)]) +
+                              r'-[0-9]{4}-[0-9]{3}$')
+        titles = sorted(t for t in self.inventory() if title_re.match(t))
+        if not titles:
+            raise NoSuchDisc('no discs of backup', basename)
+        self.load('{}{:03d}'.format(titles[-1][:-3],
+                                    disc_number_in_set_zb + 1))
+
+class PromptMedia(Media):
+    def __init__(self, darbrrb):
+        super().__init__(darbrrb)
+        self.dir = None
+
+    def load_blank(self):
+        # There are a hundred cooler ways to do this; in 2013, I don't know of
+        # one that works on many distros and OSes, much less ten years from
+        # now. But you'll probably still be able to press enter, some way.
+        self.darbrrb._ask("press enter when you have inserted an empty disc:")
+
+    def load(self, title):
+        # Same as above. Now it's 2016, and all the ways I knew in
+        # 2013 don't work any more, there are new ways. But you could
+        # say "insert disc 2" in 1986, and you can say it today. And
+        # get off my lawn!
+        self.dir = self.darbrrb._ask(
+            "insert and mount disc entitled {} and type the "
+            "directory where its files can be found: ".format(title))
+
+    def load_last_set(self, basename, disc_number_in_set_zb):
+        self.dir = self.darbrrb._ask(
+            "insert and mount disc {} from the last set of "
+            "backup {!r} and type the directory where its "
+            "files can be found: ".format(disc_number_in_set_zb + 1,
+                                          basename))
+
+    def mount_path(self):
+        if self.dir is None:
+            raise NoDiscLoaded()
+        return self.dir
+
+class ChangerMedia(Media):
+    def __init__(self, darbrrb):
+        super().__init__(darbrrb)
+        if not self.settings.media_changer_command:
+            raise ValueError('media_changer_command is not set')
+        self.command = shlex.split(self.settings.media_changer_command)
+
+    def _output(self, *args):
+        return self.darbrrb._run(*(self.command + list(args)),
+                                 output=True).decode('UTF-8')
+
+    def load_blank(self):
+        self.darbrrb._run(*(self.command + ['load-blank']))
+
+    def load(self, title):
+        self.darbrrb._run(*(self.command + ['load', title]))
+
+    def mount_path(self):
+        return self._output('mount-path').strip()
+
+    def eject(self):
+        self.darbrrb._run(*(self.command + ['eject']))
+
+    def inventory(self):
+        return self._output('inventory').split()
+
+class DirectoryMedia(Media):
+    def __init__(self, darbrrb):
+        super().__init__(darbrrb)
+        self.library = os.path.expanduser(self.settings.media_directory or
+                                          self.settings.scratch_dir)
+        self.loaded = None
+        # for the curious, such as tests: every title loaded, in order
+        self.loads = []
+
+    def load_blank(self):
+        self.loaded = None
+
+    def load(self, title):
+        self.loaded = title
+        self.loads.append(title)
+
+    def mount_path(self):
+        if self.loaded is None:
+            raise NoDiscLoaded()
+        return os.path.join(self.library, self.loaded)
+
+    def eject(self):
+        self.loaded = None
+
+    def inventory(self):
+        fs = self.darbrrb.fs
+        return sorted(name for name in fs.listdir(self.library)
+                      if fs.isdir(os.path.join(self.library, name)) and
+                      not name.startswith('__'))
+
+# A library of ISO 9660 image files, by volume id. A disc's mount_path is
+# the image file itself; its files are read straight out of it.
+class IsoMedia(Media):
+    def __init__(self, darbrrb):
+        super().__init__(darbrrb)
+        self.library = os.path.expanduser(self.settings.media_directory or
+                                          self.settings.iso_dir or
+                                          self.settings.scratch_dir)
+        self._index = None
+        self.image = None
+
+    def index(self):
+        if self._index is None:
+            self._index = {}
+            for filename in glob.glob(os.path.join(glob.escape(self.library),
+                                                   '*.iso')):
+                with open(filename, 'rb') as f:
+                    try:
+                        title = iso_volume_id(f.read(17 * iso_sector))
+                    except ValueError:
+                        continue
+                self._index[title] = filename
+        return self._index
+
+    def inventory(self):
+        return sorted(self.index())
+
+    def load_blank(self):
+        raise NoBlankDiscs('images are written with -o, not loaded blank',
+                           self.library)
+
+    def load(self, title):
+        self.eject()
+        if title not in self.index():
+            raise NoSuchDisc('no image of disc', title, self.library)
+        self.image = IsoImage(self.index()[title])
+
+    def mount_path(self):
+        if self.image is None:
+            raise NoDiscLoaded()
+        return self.image.filename
+
+    def eject(self):
+        if self.image is not None:
+            self.image.close()
+            self.image = None
+
+    def files(self, disc_dir):
+        if self.image is None:
+            raise NoDiscLoaded()
+        return self.image.names()
+
+    def copy(self, source, destination):
+        with self.darbrrb.timed('copy') as extra:
+            with self.image.view(os.path.basename(source)) as view, \
+                    self.darbrrb.fs.open(destination, 'wb') as f:
+                f.write(view)
+                extra['bytes'] = len(view)
+            extra['device'] = _device_of(self.image.filename)
+
+media_backends = {
+    'prompt': PromptMedia,
+    'changer': ChangerMedia,
+    'directory': DirectoryMedia,
+    'iso': IsoMedia,
+}
+
+# The quantities derived from the settings, worked out and checked once.
+# The backup and restore code looks these up many times per slice, and each
+# lookup through Settings runs properties and __getattr__. The geometry is
+# saved in the scratch directory so that each hook invocation can load it
+# rather than work it out again.
+class Geometry:
+    saved_fields = ('data_discs', 'parity_discs', 'slices_per_disc',
+                    'disc_size_KiB', 'reserve_space_KiB', 'slice_size_KiB',
+                    'digits', 'group_slices_per_disc')
+    __slots__ = saved_fields + (
+        'total_set_count', 'slices_per_set', 'slices_per_group',
+        'catalog_space_KiB',
+        'disc_size_MiB', 'slice_size_MiB', 'scratch_free_needed_MiB',
+        'number_format', 'slice_name_format', '_places_in_set')
+
+    # group_slices_per_disc has a default, for geometry.json files saved
+    # before there was such a setting
+    def __init__(self, data_discs, parity_discs, slices_per_disc,
+                 disc_size_KiB, reserve_space_KiB, slice_size_KiB, digits,
+                 group_slices_per_disc=1):
+        if data_discs < 1 or parity_discs < 1:
+            raise BadGeometry('need at least one data and one parity disc',
+                              data_discs, parity_discs)
+        if slices_per_disc < 1 or digits < 1:
+            raise BadGeometry('need at least one slice per disc and one '
+                              'digit', slices_per_disc, digits)
+        if (group_slices_per_disc < 1 or
+                slices_per_disc % group_slices_per_disc != 0):
+            raise BadGeometry('slices per disc must be a multiple of group '
+                              'slices per disc', slices_per_disc,
+                              group_slices_per_disc)
+        if group_slices_per_disc * (data_discs + parity_discs) > 256:
+            raise BadGeometry('PAR1 allows at most 256 files in a parity '
+                              'group', group_slices_per_disc, data_discs,
+                              parity_discs)
+        catalog_KiB = catalog_space_KiB(data_discs * slices_per_disc)
+        if slice_size_KiB <= 0 or (slices_per_disc * slice_size_KiB +
+                                   reserve_space_KiB + catalog_KiB >
+                                   disc_size_KiB):
+            raise BadGeometry('slices do not fit on disc', slices_per_disc,
+                              slice_size_KiB, disc_size_KiB)
+        values = dict(
+            data_discs=data_discs, parity_discs=parity_discs,
+            slices_per_disc=slices_per_disc, disc_size_KiB=disc_size_KiB,
+            reserve_space_KiB=reserve_space_KiB,
+            slice_size_KiB=slice_size_KiB, digits=digits,
+            group_slices_per_disc=group_slices_per_disc,
+            total_set_count=data_discs + parity_discs,
+            slices_per_set=data_discs * slices_per_disc,
+            slices_per_group=data_discs * group_slices_per_disc,
+            catalog_space_KiB=catalog_KiB,
+            disc_size_MiB=disc_size_KiB / 1024,
+            slice_size_MiB=slice_size_KiB / 1024,
+            number_format='{:0' + str(digits) + '}',
+            slice_name_format='{{}}.{{:0{}d}}.{{}}'.format(digits),
+            # for each slice in a set: which disc, which parity group
+            _places_in_set=tuple(
+                (i % data_discs, i // (data_discs * group_slices_per_disc))
+                for i in range(data_discs * slices_per_disc)))
+        values['scratch_free_needed_MiB'] = (values['total_set_count'] *
+                                             values['disc_size_MiB'])
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('geometry is read-only', name)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(**{name: getattr(settings, name)
+                      for name in cls.saved_fields})
+
+    @classmethod
+    def load(cls, filename, fs=real_filesystem):
+        with fs.open(filename) as f:
+            return cls(**json.load(f))
+
+    def save(self, filename, fs=real_filesystem):
+        with fs.open(filename, 'wt') as f:
+            json.dump({name: getattr(self, name)
+                       for name in self.saved_fields}, f)
+
+    # With a STAGING_DIR, what scratch needs: the slices and parity volumes
+    # of hot_groups groups.
+    def hot_free_needed_MiB(self, hot_groups):
+        return math.ceil(hot_groups * self.total_set_count *
+                         self.group_slices_per_disc * self.slice_size_MiB)
+
+    # (set, data disc in set, parity group) for a one-based slice number;
+    # all zero-based. Parity groups are numbered from the start of the
+    # backup, not the set.
+    def place(self, slice_number_ob):
+        set_zb, in_set = divmod(slice_number_ob - 1, self.slices_per_set)
+        disc_zb, group_in_set = self._places_in_set[in_set]
+        return (set_zb, disc_zb,
+                set_zb * (self.slices_per_disc // self.group_slices_per_disc) +
+                group_in_set)
+
+# Every backup made, kept in STATE_DIR so it outlives the scratch directory:
+# how it was run, which disc each slice went onto with its size and checksum,
+# and which slices hold each file, as dar lists them from the isolated
+# catalogue. With it, which discs a restore will ask for can be found out
+# without loading any of them.
+class Catalog:
+    schema = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY, basename TEXT NOT NULL, kind TEXT,
+    started REAL, finished REAL, argv TEXT, settings TEXT);
+CREATE TABLE IF NOT EXISTS discs (
+    backup_id INTEGER NOT NULL, title TEXT NOT NULL, set_zb INTEGER,
+    disc_zb INTEGER, parity INTEGER, burned REAL,
+    PRIMARY KEY (backup_id, title));
+CREATE TABLE IF NOT EXISTS slices (
+    backup_id INTEGER NOT NULL, archive TEXT NOT NULL,
+    number INTEGER NOT NULL, bytes INTEGER, sha256 TEXT, title TEXT,
+    PRIMARY KEY (backup_id, archive, number));
+CREATE TABLE IF NOT EXISTS files (
+    backup_id INTEGER NOT NULL, archive TEXT NOT NULL, path TEXT NOT NULL,
+    first_slice INTEGER, last_slice INTEGER);
+CREATE INDEX IF NOT EXISTS files_by_path ON files (path);
+"""
+
+    def __init__(self, filename, fs=real_filesystem):
+        self.filename = filename
+        self.fs = fs
+        self.db = sqlite3.connect(fs.sqlite_uri(filename), timeout=60,
+                                  uri=True)
+        self.db.executescript(self.schema)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def begin_backup(self, basename, argv, settings):
+        with self.db:
+            return self.db.execute(
+                'INSERT INTO backups (basename, started, argv, settings) '
+                'VALUES (?, ?, ?, ?)',
+                (basename, time.time(), json.dumps(argv),
+                 json.dumps(settings, sort_keys=True, default=repr)
+                 )).lastrowid
+
+    def finish_backup(self, backup_id, kind):
+        with self.db:
+            self.db.execute('UPDATE backups SET kind = ?, finished = ? '
+                            'WHERE id = ?', (kind, time.time(), backup_id))
+
+    def record_slice(self, backup_id, archive, number, size, sha256):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO slices (backup_id, '
+                            'archive, number, bytes, sha256) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (backup_id, archive, number, size, sha256))
+
+    def slice_sha256(self, backup_id, archive, number):
+        row = self.db.execute('SELECT sha256 FROM slices WHERE backup_id = ? '
+                              'AND archive = ? AND number = ?',
+                              (backup_id, archive, number)).fetchone()
+        return row and row[0]
+
+    # slices is a list of (archive, number) on the disc
+    def record_disc(self, backup_id, title, set_zb, disc_zb, parity, slices):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO discs (backup_id, title, '
+                            'set_zb, disc_zb, parity) VALUES (?, ?, ?, ?, ?)',
+                            (backup_id, title, set_zb, disc_zb, int(parity)))
+            self.db.executemany('UPDATE slices SET title = ? WHERE '
+                                'backup_id = ? AND archive = ? AND '
+                                'number = ?',
+                                [(title, backup_id, a, n) for a, n in slices])
+
+    def disc_burned(self, backup_id, title):
+        with self.db:
+            self.db.execute('UPDATE discs SET burned = ? WHERE backup_id = ? '
+                            'AND title = ?', (time.time(), backup_id, title))
+
+    # entries are (path, first slice, last slice), from parse_slicing_listing
+    def record_files(self, backup_id, archive, entries):
+        with self.db:
+            self.db.execute('DELETE FROM files WHERE backup_id = ? AND '
+                            'archive = ?', (backup_id, archive))
+            self.db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+                                ((backup_id, archive, path, first, last)
+                                 for path, first, last in entries))
+
+    # The most recent backup with the given basename, or with any basename
+    # if it is None, that has path in it.
+    def find_backup(self, path, basename=None):
+        where, values = _catalog_path_condition(path)
+        if basename is not None:
+            where += ' AND backups.basename = ?'
+            values += (basename,)
+        row = self.db.execute(
+            'SELECT backups.id FROM files JOIN backups ON '
+            'backups.id = files.backup_id WHERE ' + where +
+            ' ORDER BY backups.id DESC LIMIT 1', values).fetchone()
+        return None if row is None else row[0]
+
+    def latest_backup(self, basename):
+        row = self.db.execute('SELECT max(id) FROM backups WHERE '
+                              'basename = ?', (basename,)).fetchone()
+        return row[0]
+
+    # the settings the backup was made with, and its Geometry's saved_fields
+    def settings(self, backup_id):
+        row = self.db.execute('SELECT settings FROM backups WHERE id = ?',
+                              (backup_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    def backup(self, backup_id):
+        row = self.db.execute('SELECT basename, kind, started, finished, '
+                              'argv FROM backups WHERE id = ?',
+                              (backup_id,)).fetchone()
+        return dict(zip(('basename', 'kind', 'started', 'finished', 'argv'),
+                        row[:4] + (json.loads(row[4]),)))
+
+    # The discs a restore of path (a file or a directory) from this backup
+    # needs. A restore always starts by reading dar's catalogue from the last
+    # set of discs of each archive, so those are needed too. The parity
+    # discs of the same sets are only needed if a data disc can't be read.
+    def discs_needed(self, backup_id, path):
+        where, values = _catalog_path_condition(path)
+        archives = {}
+        for archive, first, last in self.db.execute(
+                'SELECT archive, first_slice, last_slice FROM files WHERE '
+                'backup_id = ? AND ' + where, (backup_id,) + values):
+            archives.setdefault(archive, []).append((first, last))
+        data = set()
+        for archive, ranges in archives.items():
+            last_set = ('SELECT max(d.set_zb) FROM slices s JOIN discs d ON '
+                        'd.backup_id = s.backup_id AND d.title = s.title '
+                        'WHERE s.backup_id = ?1 AND s.archive = ?2')
+            data.update(t for t, in self.db.execute(
+                'SELECT DISTINCT s.title FROM slices s JOIN discs d ON '
+                'd.backup_id = s.backup_id AND d.title = s.title WHERE '
+                's.backup_id = ?1 AND s.archive = ?2 AND d.set_zb = (' +
+                last_set + ')', (backup_id, archive)))
+            for first, last in ranges:
+                data.update(t for t, in self.db.execute(
+                    'SELECT DISTINCT title FROM slices WHERE backup_id = ? '
+                    'AND archive = ? AND number BETWEEN ? AND ?',
+                    (backup_id, archive, first, last)))
+        data.discard(None)
+        discs = self.db.execute('SELECT title, set_zb, parity FROM discs '
+                                'WHERE backup_id = ? ORDER BY title',
+                                (backup_id,)).fetchall()
+        sets = set(s for t, s, p in discs if t in data)
+        parity = [t for t, s, p in discs if p and s in sets]
+        return {'archives': sorted(archives), 'data': sorted(data),
+                'parity': parity}
+
+    # Writes a catalog of just this backup into filename, to keep anywhere;
+    # or, with set_zb, of just that set of its discs and the slices on them,
+    # to go on those discs, in the room catalog_space_KiB keeps.
+    def export(self, backup_id, filename, set_zb=None):
+        if self.fs.exists(filename):
+            self.fs.unlink(filename)
+        Catalog(filename, self.fs).close()
+        self.db.execute('ATTACH DATABASE ? AS export',
+                        (self.fs.sqlite_uri(filename),))
+        try:
+            with self.db:
+                self.db.execute('INSERT INTO export.backups SELECT * FROM '
+                                'backups WHERE id = ?', (backup_id,))
+                if set_zb is None:
+                    for table in ('discs', 'slices', 'files'):
+                        self.db.execute('INSERT INTO export.{0} SELECT * '
+                                        'FROM {0} WHERE backup_id = ?'.format(
+                                            table), (backup_id,))
+                else:
+                    self.db.execute('INSERT INTO export.discs SELECT * FROM '
+                                    'discs WHERE backup_id = ? AND '
+                                    'set_zb = ?', (backup_id, set_zb))
+                    self.db.execute('INSERT INTO export.slices SELECT * FROM '
+                                    'slices WHERE backup_id = ? AND title IN '
+                                    '(SELECT title FROM export.discs)',
+                                    (backup_id,))
+        finally:
+            self.db.execute('DETACH DATABASE export')
+
+# paths are as dar lists them: relative to the -R directory. A directory
+# matches everything in it; the range lets the index on path do the work.
+def _catalog_path_condition(path):
+    path = os.path.normpath(path).lstrip('/')
+    if path in ('', '.'):
+        return 'path IS NOT NULL', ()
+    return ('(path = ? OR (path >= ? AND path < ?))',
+            (path, path + '/', path + chr(ord('/') + 1)))
+
+# dar -l CATALOGUE -Tslicing prints a line for each entry: the slice or
+# slices it is in, its flags and permissions, and its path, tab-separated.
+# Entries that are recorded as removed have no slices, and are skipped.
+def parse_slicing_listing(text):
+    for line in text.splitlines():
+        fields = line.split('\t')
+        if len(fields) < 3:
+            continue
+        numbers = [int(n) for n in re.findall(r'[0-9]+', fields[0])]
+        if not numbers or not re.match(r'\s*[0-9]', fields[0]):
+            continue
+        yield (fields[-1].strip(), min(numbers), max(numbers))
+
+def catalog_report(backup, path, needed):
+    lines = ['To restore {} from {} ({}, made {}), have these discs at '
+             'hand:'.format(path, backup['basename'], backup['kind'] or
+                            'unfinished',
+                            time.strftime('%Y-%m-%dT%H:%M:%S',
+                                          time.localtime(backup['started'])))]
+    lines.extend('    ' + t for t in needed['data'])
+    if needed['parity']:
+        lines.append('and, if any of those can\'t be read, these:')
+        lines.extend('    ' + t for t in needed['parity'])
+    return '\n'.join(lines)
+
+# dar's hooks run this program only down to the line that says so, above the
+# tests; see _compile_hook.
+hook_source_end = "# dar's hooks run only what is above this line"
+
 parity_volume_re = re.compile(r'.*\.[pqr][0-9][0-9]')
 
+# Runs things at once, as many as there are resources for. Each resource has
+# a limit: 'cpu' slots, the 'burner', 'image_bytes' of room for disc images
+# (see Darbrrb.scheduler). Whatever is run says how much of each it uses,
+# waits until that much is free, first come first served, and gives it back
+# when it's done. Functions are run in threads, since mostly they wait on
+# parchive or growisofs; what to run, and in what order, is said by
+# coroutines, run in an event loop. If one of them fails, the rest are
+# cancelled, and the commands being run for them killed; once they have all
+# stopped, the failure is raised.
+#
+# It runs the mastering and burning of a set, the repairs of the groups a
+# restore has fetched, the dars of a parallel backup, and the parchive a
+# backup's hook runs for each group alongside the checksums of its slices.
+# Copying slices off the discs for a restore is run as it always was, one
+# after another: there's the one drive to read from.
+class Scheduler:
+    def __init__(self, darbrrb, limits):
+        self.darbrrb = darbrrb
+        self.limits = dict(limits)
+        self.free = dict(limits)
+        self._waiting = []
+        self._turn = 0
+        self._turns = None
+
+    def _grant(self):
+        # a resource is held back for the first one waiting for it
+        held_back = set()
+        for uses, future in list(self._waiting):
+            if future.done():
+                self._waiting.remove((uses, future))
+            elif not held_back & set(uses) and all(
+                    self.free[r] >= n for r, n in uses.items()):
+                for r, n in uses.items():
+                    self.free[r] -= n
+                self._waiting.remove((uses, future))
+                future.set_result(None)
+            else:
+                held_back.update(uses)
+
+    def _release(self, uses):
+        for r, n in uses.items():
+            self.free[r] += n
+        self._grant()
+
+    @contextlib.asynccontextmanager
+    async def using(self, **uses):
+        import asyncio
+        for r, n in uses.items():
+            if n > self.limits.get(r, 0):
+                raise ValueError('needs more than there is', r, n,
+                                 self.limits.get(r, 0))
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((uses, future))
+        self._grant()
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self._release(uses)
+            else:
+                future.cancel()
+                self._grant()
+            raise
+        try:
+            yield
+        finally:
+            self._release(uses)
+
+    # Runs function(*args) in a thread, with the span the caller is in.
+    async def call(self, function, *args, uses={}):
+        import asyncio
+        async with self.using(**uses):
+            running = asyncio.get_running_loop().run_in_executor(
+                None, contextvars.copy_context().run, function, *args)
+            try:
+                return await asyncio.shield(running)
+            except asyncio.CancelledError:
+                # a thread can't be stopped, but its command has been killed
+                with contextlib.suppress(Exception):
+                    await running
+                raise
+
+    # For what must happen in order, like burning the discs of a set: turn n
+    # begins when turn n - 1 ends.
+    @contextlib.asynccontextmanager
+    async def turn(self, number):
+        async with self._turns:
+            await self._turns.wait_for(lambda: self._turn == number)
+        try:
+            yield
+        finally:
+            async with self._turns:
+                self._turn += 1
+                self._turns.notify_all()
+
+    # Runs the coroutines at once, returning what they return.
+    def run(self, *coroutines):
+        import asyncio
+        return asyncio.run(self._run(coroutines))
+
+    async def _run(self, coroutines):
+        import asyncio
+        self.darbrrb._cancelling.clear()
+        self._turn = 0
+        self._turns = asyncio.Condition()
+        tasks = [asyncio.ensure_future(c) for c in coroutines]
+        if not tasks:
+            return []
+        done, pending = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_EXCEPTION)
+        failed = [t for t in tasks if t.done() and not t.cancelled() and
+                  t.exception() is not None]
+        if failed:
+            self.darbrrb._kill_children()
+            for t in pending:
+                t.cancel()
+            try:
+                await asyncio.gather(*pending, return_exceptions=True)
+            finally:
+                self.darbrrb._cancelling.clear()
+            raise failed[0].exception()
+        return [t.result() for t in tasks]
+
 # This is a class not because it needs state, but because I didn't want to pass
 # settings around all the time
 class Darbrrb:
-    def __init__(self, settings, progname, progopts=()):
+    def __init__(self, settings, progname, progopts=(), fs=real_filesystem):
         self.settings = settings
         self.progname = progname
         self.progopts = progopts
+        self.fs = fs
         self.log = logging.getLogger('darbrrb')
+        self._geometry = None
+        self._geometry_generation = None
+        self.prescan_cache = {}
+        self._span = contextvars.ContextVar('span', default=({}, None))
+        self._children = set()
+        self._children_lock = threading.Lock()
+        self._cancelling = threading.Event()
+        self._prompt_lock = threading.RLock()
+        self._burns_begun = 0
+        self._burning = False
+        self._media = None
+        self._media_generation = None
+
+    @property
+    def geometry(self):
+        if self._geometry_generation != self.settings.generation:
+            self._geometry = Geometry.from_settings(self.settings)
+            self._geometry_generation = self.settings.generation
+        return self._geometry
+
+    def _geometry_filename(self):
+        return os.path.join(self.settings.scratch_dir, 'geometry.json')
+
+    # Hook invocations use the geometry the dar subcommand saved, as long as
+    # nobody changes the settings.
+    def load_geometry(self):
+        try:
+            self._geometry = Geometry.load(self._geometry_filename(),
+                                           self.fs)
+            self._geometry_generation = self.settings.generation
+        except FileNotFoundError:
+            self.log.debug('no saved geometry; working it out')
+
+    def _timings_filename(self):
+        return os.path.join(self.settings.scratch_dir, 'timings.jsonl')
+
+    def _profiles_dir(self):
+        return os.path.join(self.settings.scratch_dir, 'profiles')
+
+    # With -p, each run of a hook writes its profile to a file of its own, in
+    # the form cProfile's dump_stats would, for summarize_profiles.
+    @contextlib.contextmanager
+    def profiled(self, hook):
+        if not any(o == '-p' for o, v in self.progopts):
+            yield
+            return
+        import cProfile, marshal
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.create_stats()
+            self.fs.makedirs(self._profiles_dir(), exist_ok=True)
+            filename = os.path.join(self._profiles_dir(),
+                                    '{}.{}.{}.prof'.format(hook, os.getpid(),
+                                                           time.time_ns()))
+            with self.fs.open(filename, 'wb') as f:
+                f.write(marshal.dumps(profiler.stats))
+
+    def clear_profiles(self):
+        for filename in self.fs.glob(os.path.join(self._profiles_dir(),
+                                                  '*.prof')):
+            self.fs.unlink(filename)
+
+    # Each span is one line of JSON, written with a single write so that
+    # dars running in parallel don't interleave their lines.
+    def _record_span(self, span):
+        line = (json.dumps(span, sort_keys=True) + '\n').encode('UTF-8')
+        try:
+            self.fs.append(self._timings_filename(), line)
+        except OSError:
+            # no scratch dir: nowhere to put it
+            return
+
+    # what we're in the middle of, as far as this thread or coroutine knows
+    @property
+    def _span_ids(self):
+        return self._span.get()[0]
 
-    def _run(self, *args):
+    @property
+    def phase(self):
+        return self._span.get()[1]
+
+    # Spans nested inside this one carry its identifiers (slice_ob, set_zb,
+    # disc_zb, group...) too, including those run by a Scheduler on its
+    # behalf. Put anything only this span knows, like bytes or device, in the
+    # dict yielded.
+    @contextlib.contextmanager
+    def timed(self, phase, **ids):
+        token = self._span.set((dict(self._span_ids, **ids), phase))
+        extra = {}
+        start = time.time()
+        began = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            span = dict(self._span_ids, phase=phase, start=start,
+                        seconds=time.perf_counter() - began,
+                        pid=os.getpid())
+            span.update(extra)
+            self._span.reset(token)
+            self._record_span(span)
+
+    # for log records: what we're in the middle of
+    def span_context(self):
+        if self.phase is None:
+            return dict(self._span_ids)
+        return dict(self._span_ids, phase=self.phase)
+
+    # There's one terminal, and a Scheduler may have several threads with
+    # something to ask: one asks at a time. Once what is being run is being
+    # cancelled, there's no point asking.
+    def _ask(self, prompt):
+        with self._prompt_lock:
+            if self._cancelling.is_set():
+                raise Cancelled(prompt)
+            with self.timed('prompt'):
+                return input(prompt)
+
+    # With output=True, what the command writes to stdout is returned.
+    def _run(self, *args, output=False):
+        if self.settings.unattended:
+            return self._run_unattended(args, output)
+        check = self._check_output if output else self._check_call
         try_again = True
         while try_again:
             self.log.info('running command {!r}'.format(args))
             try:
-                subprocess.check_call(args)
+                with self.timed(os.path.basename(args[0])):
+                    result = check(args)
                 try_again = False
             except subprocess.CalledProcessError as e:
                 self.log.exception('an error was encountered '
                                    'when running command {!r}'.format(args))
                 valid_input = False
-                while not valid_input:
-                    the_input = input('Something went wrong '
-                                      'when running command {!r}. '
-                                      'Try again? [Y/n] '.format(args))
-                    if the_input == '':
-                        valid_input = True
-                        try_again = True
-                    elif (the_input.startswith('y') or
-                          the_input.startswith('Y')):
-                        valid_input = True
-                        try_again = True
-                    elif (the_input.startswith('n') or
-                          the_input.startswith('N')):
-                        valid_input = True
-                        try_again = False
-                        self.log.error('re-raising the error')
-                        raise
-                    if not valid_input:
-                        print('Did not understand your input. Asking again.')
+                # the question and any asking again go together
+                with self._prompt_lock:
+                    while not valid_input:
+                        the_input = self._ask('Something went wrong '
+                                              'when running command {!r}. '
+                                              'Try again? [Y/n] '.format(args))
+                        if the_input == '':
+                            valid_input = True
+                            try_again = True
+                        elif (the_input.startswith('y') or
+                              the_input.startswith('Y')):
+                            valid_input = True
+                            try_again = True
+                        elif (the_input.startswith('n') or
+                              the_input.startswith('N')):
+                            valid_input = True
+                            try_again = False
+                            self.log.error('re-raising the error')
+                            raise
+                        if not valid_input:
+                            print('Did not understand your input. '
+                                  'Asking again.')
+        return result
+
+    # Like subprocess.check_call; but when a Scheduler is cancelling what it
+    # runs, the command is killed, and none is started.
+    def _check_call(self, args):
+        self._wait_for_child(args)
+
+    # Likewise subprocess.check_output.
+    def _check_output(self, args):
+        return self._wait_for_child(args, stdout=subprocess.PIPE)
+
+    def _wait_for_child(self, args, **popen_args):
+        if self._cancelling.is_set():
+            raise Cancelled(args)
+        with subprocess.Popen(args, **popen_args) as process:
+            with self._children_lock:
+                self._children.add(process)
+                # cancelled while it was starting
+                if self._cancelling.is_set():
+                    process.terminate()
+            try:
+                output = process.communicate()[0]
+            finally:
+                with self._children_lock:
+                    self._children.discard(process)
+        if self._cancelling.is_set():
+            raise Cancelled(args)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args,
+                                                output)
+        return output
+
+    def _kill_children(self):
+        self._cancelling.set()
+        with self._children_lock:
+            for process in self._children:
+                with contextlib.suppress(OSError):
+                    process.terminate()
+
+    def scheduler(self):
+        limits = {'cpu': self.settings.cpu_slots or os.cpu_count() or 1,
+                  'burner': 1}
+        if self.settings.image_dir is not None:
+            image_dir = os.path.expanduser(self.settings.image_dir)
+            self.fs.makedirs(image_dir, exist_ok=True)
+            limits['image_bytes'] = self.fs.free_bytes(image_dir)
+        return Scheduler(self, limits)
+
+    def retry_policy(self, command):
+        policies = self.settings.retry_policies
+        return policies.get(os.path.basename(command), policies['*'])
+
+    def _run_unattended(self, args, output=False):
+        check = self._check_output if output else self._check_call
+        policy = self.retry_policy(args[0])
+        delay = policy['delay_seconds']
+        for attempt in range(1, policy['attempts'] + 1):
+            self.log.info('running command {!r}'.format(args))
+            try:
+                with self.timed(os.path.basename(args[0])):
+                    return check(args)
+            except subprocess.CalledProcessError as e:
+                transient = (policy['transient_exit_codes'] is None or
+                             e.returncode in policy['transient_exit_codes'])
+                if not transient or attempt == policy['attempts']:
+                    self.log.error('command %r failed with exit code %d, '
+                                   'attempt %d of %d; giving up', args,
+                                   e.returncode, attempt, policy['attempts'])
+                    self.alert('command {!r} failed with exit code {} after '
+                               '{} attempt(s)'.format(args, e.returncode,
+                                                      attempt))
+                    raise
+                self.log.warning('command %r failed with exit code %d, '
+                                 'attempt %d of %d; trying again in %s '
+                                 'seconds', args, e.returncode, attempt,
+                                 policy['attempts'], delay)
+                with self.timed('retry-wait', attempt=attempt,
+                                exit_code=e.returncode):
+                    time.sleep(delay)
+                delay *= policy['backoff']
+
+    # Tell someone we're stuck. Not with _run: that could want to alert.
+    def alert(self, message):
+        message = 'darbrrb on {}: {}'.format(os.uname()[1], message)
+        self.log.error('alert: %s', message)
+        if self.settings.alert_command:
+            try:
+                subprocess.call(shlex.split(self.settings.alert_command) +
+                                [message])
+            except OSError:
+                self.log.exception('could not run alert command %r',
+                                   self.settings.alert_command)
 
     # for mockability
     def _copy(self, source, destination):
-        shutil.copyfile(source, destination)
+        with self.timed('copy') as extra:
+            self.fs.copyfile(source, destination)
+            extra['bytes'] = self.fs.getsize(destination)
+            extra['device'] = self.fs.device_of(source)
+
+    def _move(self, source, destination):
+        with self.timed('move') as extra:
+            extra['bytes'] = self.fs.getsize(source)
+            extra['device'] = self.fs.device_of(source)
+            self.fs.move(source, destination)
+
+    # Media decay can make a file on a disc unreadable partway through. A
+    # truncated slice is no use to parchive, so we throw it away; parchive
+    # can make up for it.
+    def _copy_from_disc(self, source, destination):
+        try:
+            self.media.copy(source, destination)
+            return True
+        except OSError as e:
+            self.log.warning('could not copy %r: %s', source, e)
+            with contextlib.suppress(FileNotFoundError):
+                self.fs.unlink(destination)
+            return False
 
     @property
     def darrc_contents(self):
+        return darrc_template.format(settings=self.settings,
+                python=sys.executable, progname=self._hook_filename(),
+                progargs=' '.join(self._progargs()))
+
+    # only: the options to pass on, if not all of them
+    def _progargs(self, only=None):
         progargs = []
         for o, v in self.progopts:
+            if only is not None and o not in only:
+                continue
             if v:
-                progargs.extend(o, v)
+                progargs.extend((o, v))
             else:
                 progargs.append(o)
-        return darrc_template.format(settings=self.settings,
-                progname=os.path.join(self.settings.scratch_dir, 
-                        os.path.basename(self.progname)),
-                progargs=' '.join(progargs))
+        return progargs
 
-    def readme(self, basename):
+    def original_argv(self):
+        import pickle, base64
         if 'DARBRRB_ORIGINAL_ARGV' in os.environ:
             try:
-                original_argv = pickle.loads(
+                return pickle.loads(
                     base64.b64decode(os.environ['DARBRRB_ORIGINAL_ARGV']))
             except:
-                original_argv = ['there was an error trying to find out']
+                return ['there was an error trying to find out']
         else:
-            original_argv = ['not known']
+            return ['not known']
+
+    def readme(self, basename):
+        original_argv = self.original_argv()
+        archives = self._archives()
+        if archives is None:
+            parallel = ''
+        else:
+            parallel = """* archives.json: this backup was made as {n} dar archives at once, each of
+  part of the files: {names}. Their slices and par files share the discs.
+  archives.json lists, for each set of discs burned so far, which slices of
+  each archive are on it. To restore, run this script with the same -j
+  switch as above; it will ask for a disc from the last set, read
+  archives.json from it, and restore each archive in turn.
+""".format(n=len(archives['archives']),
+           names=', '.join(archives['archives']))
         return """
 
 This disc is part of a backup made by darbrrb, a tool that wraps the dar disk
@@ -360,130 +2460,687 @@ About the files that may be on this disc:
 * {basename}.{one}-{fddn}.par (e.g.): a par index file for a parity volume
   set made over several dar slice files. It contains checksums for each of
   the slice files in the set.
+* chain.json (if present): this backup may contain only the changes since
+  an earlier backup. chain.json lists the backups this one builds on, and
+  the titles of their discs. Run this script with the argument chain and
+  the path to chain.json to find out which backups to restore, in order.
 * {basename}.{one}-{fddn}.p01 (e.g.): a par parity volume file for the
   aforementioned parity volume set. This contains redundant data, such that
   if any of the dar slices in the set is missing or corrupted, it can be re-
   constructed.
-
-""".format(argv=original_argv, s=self.settings,
+{parallel}
+""".format(argv=original_argv, s=self.settings, parallel=parallel,
            contents=self.darrc_contents,
            progname=os.path.basename(self.progname),
            basename=basename,
            one=self.settings.number_format.format(1),
-           fddn=self.settings.number_format.format(self.settings.data_discs))
+           fddn=self.settings.number_format.format(
+               self.settings.slices_per_group))
     # FIXME
 
 
 
-    def dar(self, *args):
+    def _write_darrc(self):
         # Perhaps darrc files can be non-ascii, but we haven't got any
         # non-ascii arguments to give here, so we'll stay on the safe side.
         indented_contents = self.darrc_contents.replace('\n', '\n        ')
-        with open(os.path.join(self.settings.scratch_dir, 'darrc'),
-                  'w', encoding='ascii') as darrc_file:
+        darrc_filename = os.path.join(self.settings.scratch_dir, 'darrc')
+        with self.fs.open(darrc_filename, 'w',
+                          encoding='ascii') as darrc_file:
             self.log.info("""Contents of {name} follow:
 {indented}
-""".format(name=darrc_file.name, indented=indented_contents))
+""".format(name=darrc_filename, indented=indented_contents))
             darrc_file.write(self.darrc_contents)
-            darrc_file.flush()
-            # causes of this working_directory:
-            # 1. when dar makes files, it will make them in the scratch_dir
-            # 2. when dar calls this script, the _create and other methods
-            #    below will have scratch_dir as their cwd.
+        return darrc_filename
+
+    def dar(self, *args):
+        darrc_filename = self._write_darrc()
+        # causes of this working_directory:
+        # 1. when dar makes files, it will make them in the scratch_dir
+        # 2. when dar calls this script, the _create and other methods
+        #    below will have scratch_dir as their cwd.
+        with working_directory(self.settings.scratch_dir):
+            self._run('dar', *(args + ('-B', darrc_filename)))
+
+    # Run several dars at once, each with its own arguments. They can't
+    # all ask for the passphrase on the same terminal, so we ask once, and
+    # give it to them in a darrc only we can read, which is removed as soon
+    # as they are done.
+    def dar_parallel(self, arg_lists):
+        import getpass
+        darrc_filename = self._write_darrc()
+        key_filename = os.path.join(self.settings.scratch_dir, 'key.darrc')
+        passphrase = getpass.getpass('passphrase for the archives: ')
+        fd = os.open(key_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with open(fd, 'wt') as f:
+            print('-K aes:{}'.format(passphrase), file=f)
+        # If one dar fails, the backup is no good: the others are stopped.
+        scheduler = self.scheduler()
+        async def run_dar(command):
+            self.log.info('running command {!r}'.format(command))
+            await scheduler.call(self._check_call, command)
+        try:
             with working_directory(self.settings.scratch_dir):
-                self._run('dar', *(args + ('-B', darrc_file.name)))
+                scheduler.run(*(run_dar(('dar',) + tuple(args) +
+                                        ('-B', darrc_filename,
+                                         '-B', key_filename))
+                                for args in arg_lists))
+        finally:
+            os.unlink(key_filename)
+
+    # A parallel backup is made of several dar archives, which share sets of
+    # discs. archives.json, in the scratch directory and on every disc,
+    # names the archives and the basename the discs are titled with; and,
+    # for each set burned, the range of slice numbers from each archive on
+    # it. Its absence means there's one archive, as usual.
+    def _archives_filename(self):
+        return os.path.join(self.settings.scratch_dir, 'archives.json')
+
+    def _archives(self):
+        try:
+            with self.fs.open(self._archives_filename()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save_archives(self, archives):
+        with self.fs.open(self._archives_filename() + '.new', 'wt') as f:
+            json.dump(archives, f, indent=1)
+        self.fs.replace(self._archives_filename() + '.new',
+                   self._archives_filename())
+
+    def record_archives(self, basename, archive_basenames):
+        self._save_archives({'basename': basename,
+                             'archives': list(archive_basenames),
+                             'finished': [], 'sets': []})
+
+    # dar -c basename -R root ... becomes several dar -c basename_N -R root
+    # -g subdir ... , each for about the same amount of data. Each isolates
+    # its catalogue into the scratch directory, for finish_catalog; returns
+    # (archive basename, isolated catalogue) for each.
+    def backup_in_parallel(self, args, jobs):
+        basename = dar_argument(args, '-c', '--create')
+        root = os.path.abspath(dar_argument(args, '-R', '--fs-root'))
+        groups = split_source_tree(root, self.prescan_cache, jobs)
+        archive_basenames = ['{}_{}'.format(basename, i + 1)
+                             for i in range(len(groups))]
+        self.record_archives(basename, archive_basenames)
+        catalogue_dir = os.path.join(self.settings.scratch_dir, 'catalogues')
+        self.fs.makedirs(catalogue_dir, exist_ok=True)
+        catalogues = [(archive_basename,
+                       os.path.join(catalogue_dir, archive_basename))
+                      for archive_basename in archive_basenames]
+        arg_lists = []
+        for (archive_basename, catalogue), names in zip(catalogues, groups):
+            archive_args = [archive_basename if a == basename else a
+                            for a in args]
+            for name in names:
+                archive_args.extend(('-g', name))
+            archive_args.extend(('-@', catalogue))
+            arg_lists.append(archive_args)
+        self.dar_parallel(arg_lists)
+        return catalogues
+
+    # The archives of a parallel backup are restored one after another.
+    def restore_in_parallel(self, args):
+        basename = dar_argument(args, '-x', '--extract')
+        cached = os.path.join(self._last_group_dir(basename), 'archives.json')
+        if self.fs.exists(cached):
+            self._copy(cached, self._archives_filename())
+        else:
+            disc_dir = self.last_set_directory(basename, 0)
+            self.media.copy(os.path.join(disc_dir, 'archives.json'),
+                            self._archives_filename())
+            self.media.eject()
+        for archive_basename in self._archives()['archives']:
+            self.dar(*[archive_basename if a == basename else a
+                       for a in args])
+
+    # Each backup made with dar -c starts or continues a chain, named by the
+    # basename given to -c. The chain is kept in the state directory, with
+    # the catalogue dar isolates from each archive as it makes it, so that
+    # the next archive in the chain can be made by comparing against it
+    # (dar -A) instead of the files themselves. A full backup starts a new
+    # chain, and is named by the basename itself; an incremental backup is
+    # made against the last archive in the chain, a differential against
+    # the full backup; these are named basename_002, basename_003, and so
+    # on. The chain so far is also put on every disc as chain.json.
+    #
+    # The isolated catalogues list file names and metadata, not contents,
+    # and are not encrypted; they stay on the machine being backed up.
+    def _chain_dir(self, basename):
+        return os.path.join(os.path.expanduser(self.settings.state_dir),
+                            'chains', basename)
+
+    def load_chain(self, basename):
+        try:
+            with self.fs.open(os.path.join(self._chain_dir(basename),
+                                           'chain.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def _save_chain(self, filename, chain):
+        with self.fs.open(filename + '.new', 'wt') as f:
+            json.dump(chain, f, indent=1)
+        self.fs.replace(filename + '.new', filename)
+
+    # returns the arguments for dar, and the chain including the new archive
+    def start_chain_member(self, args, kind):
+        basename = dar_argument(args, '-c', '--create')
+        chain_dir = self._chain_dir(basename)
+        self.fs.makedirs(chain_dir, exist_ok=True)
+        if kind == 'full':
+            chain = []
+            reference = None
+            member = basename
+        else:
+            chain = self.load_chain(basename)
+            if not chain:
+                raise NoChain('no full backup to build on', basename,
+                              chain_dir)
+            reference = chain[-1] if kind == 'incremental' else chain[0]
+            member = '{}_{:03d}'.format(basename, len(chain) + 1)
+        catalogue = os.path.join(chain_dir, member + '_catalogue')
+        chain.append({'basename': member, 'kind': kind,
+                      'reference': reference and reference['basename'],
+                      'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                      'catalogue': catalogue, 'discs': []})
+        self._save_chain(os.path.join(self.settings.scratch_dir,
+                                      'chain.json'), chain)
+        dar_args = [member if a == basename else a for a in args]
+        dar_args.extend(('-@', catalogue))
+        if reference is not None:
+            dar_args.extend(('-A', reference['catalogue']))
+        return dar_args, chain
+
+    # after dar is done: the archive made it onto discs, so the chain can
+    # be built on
+    def finish_chain_member(self, basename, chain):
+        member = chain[-1]
+        member['discs'] = [self.disc_title(member['basename'], s, d)
+                           for s in range(self._sets_burned())
+                           for d in range(self.geometry.total_set_count)]
+        chain_filename = os.path.join(self._chain_dir(basename), 'chain.json')
+        if member['kind'] == 'full' and self.fs.exists(chain_filename):
+            self.fs.replace(chain_filename,
+                       os.path.join(self._chain_dir(basename),
+                                    'chain-until-{}.json'.format(
+                                        member['created'])))
+        self._save_chain(chain_filename, chain)
+
+    # The archives to restore, in order, to get back the files as they were
+    # at a given time (an ISO 8601 string like the ones in chain.json).
+    def chain_for_restore(self, chain, when=None):
+        made_by_then = [m for m in chain
+                        if when is None or m['created'] <= when]
+        if not made_by_then:
+            raise NoChain('no backup in the chain was made by', when)
+        by_name = {m['basename']: m for m in chain}
+        needed = [made_by_then[-1]]
+        while needed[-1]['reference'] is not None:
+            needed.append(by_name[needed[-1]['reference']])
+        return list(reversed(needed))
+
+    def chain_restore_instructions(self, chain, when=None):
+        lines = ['To restore the files as they were at {}, restore these '
+                 'archives in this order:'.format(when or 'the latest backup')]
+        for m in self.chain_for_restore(chain, when):
+            lines.append('')
+            lines.append('{} ({}{}, made {}) from discs:'.format(
+                m['basename'], m['kind'],
+                ' on ' + m['reference'] if m['reference'] else '',
+                m['created']))
+            lines.extend('    ' + t for t in m['discs'])
+            lines.append('  python3 {} dar -x {} -R <directory>'.format(
+                os.path.basename(self.progname), m['basename']))
+        return '\n'.join(lines)
+
+    def _catalog_filename(self):
+        return os.path.join(os.path.expanduser(self.settings.state_dir),
+                            'catalog.sqlite')
+
+    def catalog(self):
+        self.fs.makedirs(os.path.dirname(self._catalog_filename()),
+                         exist_ok=True)
+        return Catalog(self._catalog_filename(), self.fs)
+
+    # How many digits the slice numbers in a backup's file names have. The
+    # copy of this script on its discs works it out as the backup did, from
+    # the size measured then; this one may not. So it's what the catalog
+    # says, or, restoring elsewhere, what the par files on the first disc of
+    # the last set are called.
+    def recorded_digits(self, basename):
+        with self.catalog() as catalog:
+            backup_id = catalog.latest_backup(basename)
+            if backup_id is not None:
+                digits = catalog.settings(backup_id).get('digits')
+                if digits is not None:
+                    return digits
+        disc_dir = self.last_set_directory(basename, 0)
+        pars = [f for f in self.media.files(disc_dir) if f.endswith('.par')]
+        self.media.eject()
+        if not pars:
+            return None
+        return len(self._numbers_from_par_filename(pars[0])[0])
+
+    # The hooks of one backup share its row in the catalog; the first to
+    # need it makes it. Hooks take turns under the scratch lock, so only one
+    # does.
+    def _catalog_backup_id(self, catalog, title_basename):
+        filename = os.path.join(self.settings.scratch_dir,
+                                'catalog_backup.txt')
+        try:
+            with self.fs.open(filename) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            pass
+        settings = {name: getattr(self.settings, name)
+                    for name, value in vars(Settings).items()
+                    if not name.startswith('_') and
+                    not callable(value) and not isinstance(value, property)}
+        settings.update((name, getattr(self.geometry, name))
+                        for name in Geometry.saved_fields)
+        backup_id = catalog.begin_backup(title_basename,
+                                         self.original_argv(), settings)
+        with self.fs.open(filename, 'wt') as f:
+            print(backup_id, file=f)
+        return backup_id
+
+    # (number, size, hex SHA-256) of each of the slices, for the catalog.
+    # The hook works these out for a group while parchive reads the same
+    # slices, rather than for each slice as dar finishes it: dar waits on
+    # the hook.
+    def _checksum_slices(self, dar_files):
+        sums = []
+        for filename in dar_files:
+            number = self._number_from_slice_name_ob(filename)
+            try:
+                with self.timed('checksum', slice_ob=number) as extra:
+                    size, digest = self.fs.sha256(filename)
+                    extra['bytes'] = size
+            except FileNotFoundError:
+                size, digest = 0, None
+            sums.append((number, size, digest))
+        return sums
+
+    # After dar is done: the files in each archive, from its isolated
+    # catalogue, and the kind of backup it was. catalogues is a list of
+    # (archive basename, isolated catalogue).
+    def finish_catalog(self, title_basename, kind, catalogues):
+        with self.catalog() as catalog:
+            backup_id = self._catalog_backup_id(catalog, title_basename)
+            for archive, catalogue in catalogues:
+                try:
+                    with self.timed('list', archive=archive):
+                        listing = subprocess.check_output(
+                            ['dar', '-l', catalogue, '-Tslicing', '-Q'])
+                except (OSError, subprocess.CalledProcessError):
+                    self.log.warning('could not list %r; the catalog will '
+                                     'not say which slices its files are in',
+                                     catalogue, exc_info=True)
+                    continue
+                catalog.record_files(backup_id, archive, parse_slicing_listing(
+                    listing.decode('UTF-8', 'surrogateescape')))
+            catalog.finish_backup(backup_id, kind)
+        self.fs.unlink(os.path.join(self.settings.scratch_dir,
+                                    'catalog_backup.txt'))
+
+    # hooks of parallel dars must take turns with the disc directories ('lock');
+    # movers, with the outbox ('mover.lock')
+    def _scratch_lock(self, name='lock'):
+        return self.fs.lock(os.path.join(self.settings.scratch_dir, name))
+
+    # Progress is kept in progress.json in scratch, replaced whole each time
+    # so that it can be read at any moment. Hooks update it with what they
+    # have done (slices archived, discs burned, groups fetched and so on);
+    # the rest, such as the ETA, is worked out from that each time.
+    def _progress_filename(self):
+        return os.path.join(self.settings.scratch_dir, 'progress.json')
+
+    def _progress(self):
+        try:
+            with self.fs.open(self._progress_filename()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'started': time.time()}
+
+    def _save_progress(self, progress):
+        self.fs.write_atomically(self._progress_filename(), json.dumps(
+            progress, indent=1, sort_keys=True))
+        if self.settings.textfile_dir is not None:
+            self.fs.write_atomically(os.path.join(
+                os.path.expanduser(self.settings.textfile_dir),
+                'darbrrb.prom'), progress_textfile(progress))
+
+    def _compression_filename(self):
+        return os.path.join(os.path.expanduser(self.settings.state_dir),
+                            'compression.json')
+
+    # The last compression ratio observed for each chain, by its title, and
+    # for each kind of backup in it: an incremental holds only what changed,
+    # so its ratio says nothing about the next full backup. Until a backup
+    # finishes, the one before it of the same kind is the best guess we have.
+    def _compression_ratios(self):
+        try:
+            with self.fs.open(self._compression_filename()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _compression_ratio(self, title, kind):
+        ratios = self._compression_ratios().get(title)
+        # before ratios were kept by kind, there was one per archive
+        if not isinstance(ratios, dict):
+            return None
+        return ratios.get(kind)
+
+    def _record_compression_ratio(self, title, kind, ratio):
+        ratios = self._compression_ratios()
+        if not isinstance(ratios.get(title), dict):
+            ratios[title] = {}
+        ratios[title][kind] = ratio
+        self.fs.makedirs(os.path.dirname(self._compression_filename()),
+                         exist_ok=True)
+        self.fs.write_atomically(self._compression_filename(),
+                                 json.dumps(ratios))
+
+    # The chain an archive being made belongs to, and what kind of member of
+    # it the archive is, from the chain.json start_chain_member put in
+    # scratch. Archives made outside a chain are their own.
+    def _chain_title_and_kind(self, basename):
+        try:
+            with self.fs.open(os.path.join(self.settings.scratch_dir,
+                                           'chain.json')) as f:
+                chain = json.load(f)
+        except FileNotFoundError:
+            chain = []
+        if chain and chain[-1]['basename'] == basename:
+            return chain[0]['basename'], chain[-1]['kind']
+        return basename, 'full'
+
+    def _project_backup(self, progress):
+        g = self.geometry
+        source_bytes = self.settings.expected_data_size_GiB * 1073741824
+        progress['source_bytes'] = int(source_bytes)
+        title, kind = self._chain_title_and_kind(progress['basename'])
+        if progress.get('finished'):
+            ratio = progress['bytes_archived'] / max(source_bytes, 1)
+            self._record_compression_ratio(title, kind, ratio)
+        else:
+            ratio = self._compression_ratio(title, kind)
+        progress['compression_ratio'] = ratio
+        to_archive = max(source_bytes * (1.0 if ratio is None else ratio),
+                         progress.get('bytes_archived', 0))
+        slices = max(math.ceil(to_archive / (g.slice_size_KiB * 1024)),
+                     progress.get('slices_done', 0))
+        discs = math.ceil(slices / g.slices_per_set) * g.total_set_count
+        progress['projected_remaining_discs'] = max(
+            discs - progress.get('discs_burned', 0), 0)
+        if progress.get('finished'):
+            progress['eta_seconds'] = 0
+        elif progress.get('bytes_archived'):
+            rate = progress['bytes_archived'] / max(
+                progress['updated'] - progress['started'], 1e-3)
+            progress['eta_seconds'] = round(
+                (to_archive - progress['bytes_archived']) / rate)
+
+    def _project_restore(self, progress):
+        # slices_total is only known once dar has asked for the last slice
+        # of each archive; in a partial restore, dar won't want them all.
+        if progress.get('slices_fetched') and progress.get('slices_total'):
+            per_slice = (progress['updated'] - progress['started']) / \
+                    progress['slices_fetched']
+            progress['eta_seconds'] = round(max(
+                progress['slices_total'] - progress['slices_fetched'], 0) *
+                per_slice)
+
+    # Hooks run one at a time (see _scratch_lock), so this doesn't need a
+    # lock of its own.
+    def update_progress(self, mode, basename, finished=False, **done):
+        progress = self._progress()
+        progress['mode'] = mode
+        progress['basename'] = basename
+        for name, count in done.items():
+            progress[name] = progress.get(name, 0) + count
+        progress['updated'] = time.time()
+        progress['finished'] = finished
+        if mode == 'backup':
+            self._project_backup(progress)
+        else:
+            self._project_restore(progress)
+        self._save_progress(progress)
+        return progress
+
+    # When we're not actually burning, the discs are directories in scratch;
+    # when we're making images, they're images.
+    @property
+    def media(self):
+        if self._media_generation != self.settings.generation:
+            if self.settings.iso_dir is not None:
+                backend = 'iso'
+            elif self.settings.actually_burn:
+                backend = self.settings.media_backend
+            else:
+                backend = 'directory'
+            self._media = media_backends[backend](self)
+            self._media_generation = self.settings.generation
+        return self._media
 
     def wait_for_empty_disc(self):
-        # There are a hundred cooler ways to do this; in 2013, I don't know of
-        # one that works on many distros and OSes, much less ten years from
-        # now. But you'll probably still be able to press enter, some way.
-        if self.settings.actually_burn:
-            input("press enter when you have inserted an empty disc:")
+        if self.settings.iso_dir is None:
+            self.media.load_blank()
 
     def written_disc_directory(self, disc_title):
-        # Same as above. Now it's 2016, and all the ways I knew in
-        # 2013 don't work any more, there are new ways. But you could
-        # say "insert disc 2" in 1986, and you can say it today. And
-        # get off my lawn!
-        if self.settings.actually_burn:
-            dir = input("insert and mount disc entitled {} and type the "
-                        "directory where its files can be found: ".format(
-                            disc_title))
-            return dir
-        else:
-            return os.path.join(self.settings.scratch_dir, disc_title)
+        self.media.load(disc_title)
+        return self.media.mount_path()
 
     # zb: zero-based; ob: one-based
     
     def last_set_directory(self, basename, disc_number_in_set_zb):
-        if self.settings.actually_burn:
-            dir = input("insert and mount disc {} from the last set of "
-                        "backup {!r} and type the directory where its "
-                        "files can be found: ".format(disc_number_in_set_zb + 1,
-                                                      basename))
-            return dir
-        else:
-            dirs = glob.glob(os.path.join(self.settings.scratch_dir,
-                                          basename + '-*'))
-            last_disc_dir = sorted(dirs)[-1]
-            disc_in_last_set_dir = '{}{:03d}'.format(last_disc_dir[:-3],
-                                                     disc_number_in_set_zb + 1)
-            return disc_in_last_set_dir
+        self.media.load_last_set(basename, disc_number_in_set_zb)
+        return self.media.mount_path()
+
+    # Relative to scratch, unless there's a STAGING_DIR.
+    def _staging_root(self):
+        if self.settings.staging_dir is None:
+            return ''
+        return os.path.abspath(os.path.expanduser(self.settings.staging_dir))
 
     def disc_dir(self, disc):
-        return '__disc{:04d}'.format(disc)
+        return os.path.join(self._staging_root(), '__disc{:04d}'.format(disc))
 
     def disc_dirs(self):
-        return sorted(glob.glob('__disc*'))
+        return sorted(self.fs.glob(os.path.join(
+            glob.escape(self._staging_root()), '__disc*')))
+
+    # With a STAGING_DIR, the slices and parity volumes of each group wait
+    # here, in scratch, for the mover to take them to their disc directory.
+    # Moving them here is only a rename.
+    def outbox_dir(self, disc):
+        return os.path.join(self.settings.scratch_dir, '__outbox',
+                            '__disc{:04d}'.format(disc))
+
+    def _outbox_files(self, pattern='*'):
+        return self.fs.glob(os.path.join(
+            glob.escape(self.settings.scratch_dir), '__outbox', '__disc*',
+            pattern))
+
+    # The mover is a process of its own, so that dar needn't wait for it.
+    # Each one drains the outbox and exits; if one is already at it, the next
+    # waits its turn. Of our options, only how much to log matters to it: -n,
+    # for one, would have it warn and sleep before every move.
+    def _start_mover(self):
+        subprocess.Popen([sys.executable, self._hook_filename()] +
+                         self._progargs(only=('-v',)) + ['_move_staged'],
+                         cwd=self.settings.scratch_dir,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         start_new_session=True)
+
+    # If a move is cut short, the file is still whole in the outbox, and is
+    # moved again.
+    def drain_outbox(self):
+        with self._scratch_lock('mover.lock'), self.timed('mover'):
+            for disc in range(1, self.geometry.total_set_count + 1):
+                outbox = self.outbox_dir(disc)
+                for f in sorted(self.fs.listdir(outbox)):
+                    self._move(os.path.join(outbox, f),
+                               os.path.join(self.disc_dir(disc), f))
 
     def disc_title(self, basename, set_number_zb, disc_in_set_number_zb):
         # Max ISO 9660 vol id length is 32. Leave room for numbers and 2 dashes.
         # +1: These numbers are 0-based, but we want the ones in the title 1-based.
-        # If you change the format here, change code above in last_set_directory!
+        # If you change the format here, change Media.load_last_set!
         return "{}-{:04d}-{:03d}".format(basename[:(32-4-3-2)],
                                          set_number_zb + 1,
                                          disc_in_set_number_zb + 1)
         
     def disc_title_for_slice(self, basename, dar_slice_number):
-        set_number = math.floor((dar_slice_number - 1) /
-                self.settings.slices_per_set)
-        disc_in_set_number = ((dar_slice_number - 1) %
-                              self.settings.data_discs)
+        set_number, disc_in_set_number, _ = self.geometry.place(
+            dar_slice_number)
         return self.disc_title(basename, set_number, disc_in_set_number)
 
     def disc_title_for_slice_and_disc(self, basename, dar_slice_number_ob, disc_in_set_number_zb):
-        set_number_zb = math.floor((dar_slice_number_ob - 1) /
-                self.settings.slices_per_set)
+        set_number_zb = self.geometry.place(dar_slice_number_ob)[0]
         return self.disc_title(basename, set_number_zb, disc_in_set_number_zb)
         
     def scratch_free_MiB(self):
-        s = os.statvfs(self.settings.scratch_dir)
-        return s.f_bavail * s.f_frsize // 1048576
+        return self.fs.free_bytes(self.settings.scratch_dir) // 1048576
 
+    def staging_free_MiB(self):
+        return self.fs.free_bytes(self._staging_root()) // 1048576
+
+    def image_free_MiB(self):
+        return self.fs.free_bytes(os.path.expanduser(
+            self.settings.image_dir)) // 1048576
+
+    # With a STAGING_DIR, each has its own amount of space to find. Mastering
+    # ahead, IMAGE_DIR needs room for an image of a whole disc, at least.
     def ensure_free_space(self):
-        free_space_MiB = self.scratch_free_MiB()
-        if free_space_MiB < self.settings.scratch_free_needed_MiB:
-            raise NotEnoughScratchSpace(self.settings.scratch_dir,
-                                        self.settings.scratch_free_needed_MiB,
-                                        free_space_MiB)
-
-    def ensure_scratch(self):
-        if os.path.exists(self.settings.scratch_dir):
-            if not os.path.isdir(self.settings.scratch_dir):
+        needed = [(self.settings.scratch_dir, self.scratch_free_MiB,
+                   self.geometry.scratch_free_needed_MiB)]
+        if self.settings.staging_dir is not None:
+            needed = [(self.settings.scratch_dir, self.scratch_free_MiB,
+                       self.geometry.hot_free_needed_MiB(
+                           self.settings.hot_groups)),
+                      (self._staging_root(), self.staging_free_MiB,
+                       self.geometry.scratch_free_needed_MiB)]
+        if self._mastering_ahead():
+            image_dir = os.path.expanduser(self.settings.image_dir)
+            self.fs.makedirs(image_dir, exist_ok=True)
+            needed.append((image_dir, self.image_free_MiB,
+                           math.ceil(self.geometry.disc_size_MiB) + 1))
+        for directory, free_MiB, needed_MiB in needed:
+            free_space_MiB = free_MiB()
+            if free_space_MiB < needed_MiB:
+                raise NotEnoughScratchSpace(directory, needed_MiB,
+                                            free_space_MiB)
+
+    # A backup begins with an empty scratch directory (but for the log, which
+    # is opened before this): the slices, counters and so on that a backup
+    # which stopped partway left there would be taken for this one's. With
+    # reuse, as for a restore, which may be run again where it stopped, what
+    # is there is kept.
+    def ensure_scratch(self, reuse=False):
+        if self.fs.exists(self.settings.scratch_dir):
+            if not self.fs.isdir(self.settings.scratch_dir):
                 raise ScratchAlreadyExists()
+            leftovers = sorted(
+                name for name in self.fs.listdir(self.settings.scratch_dir)
+                if not name.startswith('darbrrb.log'))
+            if leftovers and not reuse:
+                raise ScratchAlreadyExists(self.settings.scratch_dir,
+                                           leftovers[:5])
         else:
-            os.mkdir(self.settings.scratch_dir)
-        for disc in range(1, self.settings.total_set_count + 1):
-            os.mkdir(os.path.join(self.settings.scratch_dir,
-                    self.disc_dir(disc)))
+            self.fs.mkdir(self.settings.scratch_dir)
+        for disc in range(1, self.geometry.total_set_count + 1):
+            self.fs.makedirs(os.path.join(self.settings.scratch_dir,
+                                          self.disc_dir(disc)), exist_ok=reuse)
+            if self.settings.staging_dir is not None:
+                self.fs.makedirs(self.outbox_dir(disc), exist_ok=reuse)
         self.ensure_free_space()
+        self.geometry.save(self._geometry_filename(), self.fs)
+        self.fs.append(os.path.join(self.settings.scratch_dir, 'lock'), b'')
+        self.fs.append(self._timings_filename(), b'')
+        self._save_progress({'started': time.time()})
         # this is the copy of this program that dar will run
-        self._copy(self.progname,
-                   os.path.join(self.settings.scratch_dir,
-                                os.path.basename(self.progname)))
+        self._copy_self(os.path.join(self.settings.scratch_dir,
+                                     os.path.basename(self.progname)))
+        self._compile_hook()
+
+    def _hook_filename(self):
+        return os.path.join(self.settings.scratch_dir, 'darbrrb_hook.pyc')
+
+    # dar runs this program once for every slice. Run as a script, it would
+    # be compiled from scratch each time, and would import unittest and
+    # define the tests too. So the part of the copy in the scratch directory
+    # above the tests, with a call to main, is compiled once here, and dar
+    # runs that. Tracebacks still point at the copy, whose lines are the
+    # same. The whole program is still what goes on the discs.
+    def _compile_hook(self):
+        copy = os.path.join(self.settings.scratch_dir,
+                            os.path.basename(self.progname))
+        with self.fs.open(copy, 'rt', encoding='utf-8') as f:
+            source = f.read()
+        source = source[:source.index('\n' + hook_source_end) + 1]
+        hook_source = os.path.join(self.settings.scratch_dir,
+                                   'darbrrb_hook.py')
+        with self.fs.open(hook_source, 'wt', encoding='utf-8') as f:
+            f.write(source + 'main({!r})\n'.format(copy))
+        self.fs.compile(hook_source, self._hook_filename(), copy)
+
+    # This program is a real file, even when the scratch directory isn't.
+    def _copy_self(self, destination):
+        if not self.settings.measured and self.fs is real_filesystem:
+            self._copy(self.progname, destination)
+            return
+        with io.open(self.progname, 'rt', encoding='utf-8') as f:
+            source = f.read()
+        for name, value in sorted(self.settings.measured.items()):
+            # only the first one: that's the one toward the top
+            source, count = re.subn(
+                r'(?m)^(    {} = ).*$'.format(re.escape(name)),
+                lambda m: m.group(1) + repr(value), source, count=1)
+            if count != 1:
+                raise ValueError('could not find setting to record', name)
+        with self.fs.open(destination, 'wt', encoding='utf-8') as f:
+            f.write(source)
+
+    def _prescan_cache_filename(self):
+        return os.path.join(os.path.expanduser(self.settings.state_dir),
+                            'prescan.json')
+
+    def prescan(self, root):
+        root = os.path.abspath(root)
+        cache_filename = self._prescan_cache_filename()
+        try:
+            with open(cache_filename) as f:
+                caches = json.load(f)
+        except (FileNotFoundError, ValueError):
+            caches = {}
+        total_bytes, total_files, caches[root] = scan_source_tree(
+            root, caches.get(root), self.settings.prescan_threads)
+        self.prescan_cache = caches[root]
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+        with open(cache_filename + '.new', 'wt') as f:
+            json.dump(caches, f)
+        os.replace(cache_filename + '.new', cache_filename)
+        self.log.info('%r contains %d files, %d bytes', root, total_files,
+                      total_bytes)
+        self.settings.measure('expected_data_size_GiB',
+                              total_bytes / 1073741824)
+        return total_bytes, total_files
+
+    def expected_discs_message(self):
+        s = self.settings
+        return ('{s.expected_data_size_GiB:0.2f} GiB to back up: at most '
+                '{s.expected_set_count} set(s) of {s.total_set_count} '
+                'discs, {s.expected_disc_count} discs in all, '
+                'before compression.'.format(s=s))
 
     def _par_filename(self, basename, min_number, max_number):
-        parformat = "{{}}.{0}-{0}.par".format(self.settings.number_format)
+        parformat = "{{}}.{0}-{0}.par".format(self.geometry.number_format)
         return parformat.format(basename, min_number, max_number)
 
     def make_redundancy_files(self, basename, dar_files, max_number):
@@ -492,72 +3149,463 @@ About the files that may be on this disc:
             raise ValueError('no dar slices for parchive to operate on')
         min_number = max_number - nslices + 1
         parfilename = self._par_filename(basename, min_number, max_number)
+        # as many parity volumes for each parity disc as there are slices on
+        # each data disc
+        g = self.geometry
+        volumes = g.parity_discs * math.ceil(nslices / g.data_discs)
         self._run(*(['parchive',
-                     '-n{}'.format(self.settings.parity_discs),
+                     '-n{}'.format(volumes),
                      'a', parfilename,
                 ] + dar_files))
         return parfilename
 
-    def burn(self, basename, slice_number, disc_in_set_number, dir, happening):
-        if self.settings.actually_burn:
-            self._run('growisofs', '-Z', self.settings.burner_device,
-                      '-R', '-J', '-V',
-                      self.disc_title_for_slice_and_disc(basename, slice_number,
-                                                         disc_in_set_number),
-                      dir)
-        else:
-            destination = os.path.join(self.settings.scratch_dir,
-                    self.disc_title_for_slice_and_disc(basename, slice_number,
-                                                       disc_in_set_number))
-            self.log.info('not actually burning: moving files from {} to ' \
-                    '{}'.format(dir, destination))
-            os.mkdir(destination)
-            for f in glob.glob(os.path.join(dir, '*')):
-                shutil.move(f, os.path.join(destination, os.path.basename(f)))
+    def burn(self, disc_title, dir):
+        with self.timed('burn', title=disc_title) as extra:
+            extra['bytes'] = sum(self.fs.getsize(f) for f in
+                                 self.fs.glob(os.path.join(dir, '*')))
+            if self.settings.iso_dir is not None:
+                iso_dir = os.path.expanduser(self.settings.iso_dir)
+                os.makedirs(iso_dir, exist_ok=True)
+                image = os.path.join(iso_dir, disc_title + '.iso')
+                extra['device'] = _device_of(iso_dir)
+                self.log.info('writing files from {} into image '
+                              '{}'.format(dir, image))
+                write_iso_image(image, disc_title, dir)
+            elif self.settings.actually_burn:
+                extra['device'] = self.settings.burner_device
+                self._run('growisofs', '-Z', self.settings.burner_device,
+                          '-R', '-J', '-V', disc_title, dir)
+                self.media.eject()
+            else:
+                destination = os.path.join(self.media.library, disc_title)
+                self.log.info('not actually burning: moving files from {} '
+                              'to {}'.format(dir, destination))
+                self.fs.mkdir(destination)
+                for f in self.fs.glob(os.path.join(dir, '*')):
+                    self._move(f, os.path.join(destination,
+                                               os.path.basename(f)))
+
+    def _mastering_ahead(self):
+        return (self.settings.image_dir is not None and
+                self.settings.iso_dir is None and self.settings.actually_burn)
+
+    # Burns the discs of the set, calling burned with the number of each in
+    # the set once it's burned. Mastering ahead, the image of each disc is
+    # made as soon as there's room for it in IMAGE_DIR and a cpu slot free,
+    # so the next disc's is made while this one burns; the discs are burned
+    # in order, as their images are ready.
+    def burn_set(self, set_number_zb, titles, burned):
+        dirs = self.disc_dirs()
+        if not self._mastering_ahead():
+            for i, d in enumerate(dirs):
+                with self.timed('disc', set_zb=set_number_zb, disc_zb=i):
+                    self.log.info("burning from {}".format(d))
+                    self.wait_for_empty_disc()
+                    self.burn(titles[i], d)
+                    burned(i)
+                    with self.timed('clean'):
+                        for fn in self.fs.glob(os.path.join(d, '*')):
+                            self.fs.unlink(fn)
+            return
+        image_dir = os.path.expanduser(self.settings.image_dir)
+        scheduler = self.scheduler()
+        # there was room when the backup began, but IMAGE_DIR may be shared
+        sizes = [iso_image_size(self.fs, d) for d in dirs]
+        if max(sizes) > scheduler.limits['image_bytes']:
+            raise NotEnoughScratchSpace(
+                image_dir, math.ceil(max(sizes) / 1048576),
+                scheduler.limits['image_bytes'] // 1048576)
+        async def disc(i):
+            with self.timed('disc', set_zb=set_number_zb, disc_zb=i):
+                async with scheduler.using(image_bytes=sizes[i]):
+                    image = await scheduler.call(
+                        self._master_image, titles[i], dirs[i], image_dir,
+                        uses={'cpu': 1})
+                    async with scheduler.turn(i):
+                        await scheduler.call(self.wait_for_empty_disc)
+                        await scheduler.call(self.burn_image, titles[i],
+                                             image, uses={'burner': 1})
+                        burned(i)
+                        # only now: until the disc has burned, its files
+                        # are the only copy but for the image
+                        for fn in self.fs.glob(os.path.join(dirs[i], '*')):
+                            self.fs.unlink(fn)
+                    self.fs.unlink(image)
+        scheduler.run(*(disc(i) for i in range(len(dirs))))
+
+    # The span says whether a disc burned while the image was being made, so
+    # that what the burn does to how fast images are made can be seen (see
+    # summarize_timings).
+    def _master_image(self, title, directory, image_dir):
+        image = os.path.join(image_dir, title + '.iso')
+        burns_begun = self._burns_begun
+        burning = self._burning
+        with self.timed('master', title=title) as extra:
+            self.log.info('mastering image {} from {}'.format(image,
+                                                              directory))
+            write_iso_image(image, title, directory)
+            # for the burner to find in memory
+            self.fs.will_read(image)
+            extra.update(bytes=self.fs.getsize(image),
+                         device=self.fs.device_of(image_dir),
+                         source_device=self.fs.device_of(directory))
+            if (burning or self._burning or
+                    self._burns_begun != burns_begun):
+                extra['alongside'] = 'burn'
+        return image
+
+    def burn_image(self, disc_title, image):
+        with self.timed('burn', title=disc_title) as extra:
+            extra['bytes'] = self.fs.getsize(image)
+            extra['device'] = self.settings.burner_device
+            self._burns_begun += 1
+            self._burning = True
+            try:
+                self._run('growisofs',
+                          '-use-the-force-luke=bufsize:{}m'.format(
+                              self.settings.burn_buffer_MiB),
+                          '-Z', '{}={}'.format(self.settings.burner_device,
+                                               image))
+            finally:
+                self._burning = False
+            self.media.eject()
+
+    def _sets_burned(self):
+        try:
+            with self.fs.open(os.path.join(self.settings.scratch_dir,
+                                           'sets_burned.txt')) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def _record_set_burned(self, set_number_zb):
+        with self.fs.open(os.path.join(self.settings.scratch_dir,
+                                       'sets_burned.txt'), 'wt') as f:
+            print(set_number_zb + 1, file=f)
+
+    # How many slices each data disc of the set has had staged for it, so
+    # far. Counted, rather than found by listing the first disc after every
+    # slice, which would take longer the fuller the disc.
+    def _slices_staged(self):
+        try:
+            with self.fs.open(os.path.join(self.settings.scratch_dir,
+                                           'slices_staged.txt')) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def _record_slices_staged(self, count):
+        with self.fs.open(os.path.join(self.settings.scratch_dir,
+                                       'slices_staged.txt'), 'wt') as f:
+            print(count, file=f)
+
+    # Which slices of which archive are in the set about to be burned.
+    # Every disc in a set has all the par files of the set.
+    def _record_set_layout(self, archives):
+        ranges = {}
+        for f in self.fs.listdir(self.disc_dir(1)):
+            if f.endswith('.par'):
+                archive = f.rsplit('.', 2)[0]
+                a, b = self._numbers_from_par_filename_ob(f)
+                r = ranges.setdefault(archive, [a, b])
+                r[0], r[1] = min(r[0], a), max(r[1], b)
+        archives['sets'].append(ranges)
+        self._save_archives(archives)
+        for d in self.disc_dirs():
+            self._copy(self._archives_filename(),
+                       os.path.join(d, 'archives.json'))
 
     def _create(self, dir, basename, number, extension, happening):
+        with self.timed('create', archive=basename, slice_ob=int(number)):
+            with contextlib.ExitStack() as stack:
+                with self.timed('lock-wait'):
+                    stack.enter_context(self._scratch_lock())
+                self._create_locked(dir, basename, number, extension,
+                                    happening)
+
+    def _create_locked(self, dir, basename, number, extension, happening):
         number = int(number)
+        g = self.geometry
+        tiered = self.settings.staging_dir is not None
+        archives = self._archives()
+        if archives is None:
+            title_basename = basename
+            all_finished = happening == 'last_slice'
+        else:
+            title_basename = archives['basename']
+            if happening == 'last_slice':
+                archives['finished'].append(basename)
+                self._save_archives(archives)
+            all_finished = set(archives['finished']) >= set(
+                archives['archives'])
         # note: dar has caused this function to be called; dar's cwd is
-        # SCRATCH_DIR, hence so is ours
-        dar_files_here = sorted(glob.glob('*.dar'))
-        if len(dar_files_here) >= self.settings.data_discs or \
+        # SCRATCH_DIR, hence so is ours. Other dars running in parallel
+        # may have left their slices here too.
+        dar_files_here = sorted(self.fs.glob(glob.escape(basename) +
+                                             '.*.dar'))
+        try:
+            slice_bytes = self.fs.getsize(
+                self._slice_name(basename, number, extension))
+        except FileNotFoundError:
+            slice_bytes = 0
+        self.update_progress('backup', title_basename, slices_done=1,
+                             bytes_archived=slice_bytes)
+        if len(dar_files_here) >= g.slices_per_group or \
                 happening == 'last_slice':
-            parfilename = self.make_redundancy_files(
-                    basename, dar_files_here, number)
-            par_volumes = [f for f in os.listdir()
-                           if parity_volume_re.match(f)]
+            scheduler = self.scheduler()
+            async def parity():
+                return await scheduler.call(
+                    self.make_redundancy_files, basename, dar_files_here,
+                    number, uses={'cpu': 1})
+            async def checksums():
+                return await scheduler.call(
+                    self._checksum_slices, dar_files_here, uses={'cpu': 1})
+            with self.timed('parity', group=g.place(number)[2]):
+                parfilename, sums = scheduler.run(parity(), checksums())
+            with self.catalog() as catalog:
+                backup_id = self._catalog_backup_id(catalog, title_basename)
+                for n, size, digest in sums:
+                    catalog.record_slice(backup_id, basename, n, size, digest)
+            par_volume_prefix = parfilename[:-len('par')]
+            par_volumes = [f for f in self.fs.listdir()
+                           if parity_volume_re.match(f) and
+                           f.startswith(par_volume_prefix)]
+            with self.timed('stage', group=g.place(number)[2]):
+                # left in scratch, par files would make every listing of it
+                # longer for the rest of the backup
+                *copy_dirs, move_dir = self.disc_dirs()
+                for d in copy_dirs:
+                    self._copy(parfilename, os.path.join(d, parfilename))
+                self._move(parfilename, os.path.join(move_dir, parfilename))
+                for d in self.disc_dirs():
+                    with self.fs.open(os.path.join(d, 'README.txt'),
+                                      'wt') as readme:
+                        readme.write(self.readme(basename))
+                    this_program = os.path.basename(self.progname)
+                    self._copy(this_program, os.path.join(d, this_program))
+                    if self.fs.exists('chain.json'):
+                        self._copy('chain.json',
+                                   os.path.join(d, 'chain.json'))
+                if tiered:
+                    stage_dir = self.outbox_dir
+                else:
+                    stage_dir = self.disc_dir
+                data_dirs = itertools.cycle(stage_dir(i+1)
+                        for i in range(g.data_discs))
+                redundancy_dirs = itertools.cycle(stage_dir(i+1)
+                        for i in range(g.data_discs, g.total_set_count))
+                for f, d in itertools.chain(
+                        zip(dar_files_here, data_dirs),
+                        zip(par_volumes, redundancy_dirs)):
+                    self._move(f, os.path.join(d, f))
+                # the first data disc gets the most
+                self._record_slices_staged(
+                    self._slices_staged() +
+                    -(-len(dar_files_here) // g.data_discs))
+            if tiered:
+                waiting = len(self._outbox_files('*.dar'))
+                if waiting >= (g.slices_per_group *
+                               (self.settings.hot_groups - 1)):
+                    with self.timed('mover-wait'):
+                        self.drain_outbox()
+                else:
+                    self._start_mover()
+        dars_on_discs = self._slices_staged()
+        size_if_we_dont_burn_KiB = (
+            dars_on_discs + g.group_slices_per_disc) * \
+                g.slice_size_KiB + g.reserve_space_KiB + g.catalog_space_KiB
+        if size_if_we_dont_burn_KiB > g.disc_size_KiB or all_finished:
+            if tiered:
+                with self.timed('mover-wait'):
+                    self.drain_outbox()
+            set_number_zb = self._sets_burned()
+            if archives is not None:
+                self._record_set_layout(archives)
+            titles = [self.disc_title(title_basename, set_number_zb, i)
+                      for i in range(g.total_set_count)]
+            with self.catalog() as catalog, \
+                    self.timed('catalog', set_zb=set_number_zb):
+                backup_id = self._catalog_backup_id(catalog, title_basename)
+                for i, (title, d) in enumerate(zip(titles,
+                                                   self.disc_dirs())):
+                    catalog.record_disc(
+                        backup_id, title, set_number_zb, i,
+                        i >= g.data_discs,
+                        [(f.rsplit('.', 2)[0],
+                          self._number_from_slice_name_ob(f))
+                         for f in self.fs.listdir(d) if f.endswith('.dar')])
+                # the files in it are only known after dar is done
+                catalog.export(backup_id, 'catalog.sqlite', set_number_zb)
+                for d in self.disc_dirs():
+                    self._copy('catalog.sqlite',
+                               os.path.join(d, 'catalog.sqlite'))
+                self.fs.unlink('catalog.sqlite')
+                if archives is None:
+                    finished = [basename] if all_finished else []
+                else:
+                    finished = archives['finished']
+                for archive in finished:
+                    self._cache_last_group(catalog, backup_id, title_basename,
+                                           archive, set_number_zb)
+                if (archives is not None and all_finished and
+                        self.settings.last_groups_kept):
+                    self.fs.makedirs(self._last_group_dir(title_basename),
+                                     exist_ok=True)
+                    self._copy(self._archives_filename(), os.path.join(
+                        self._last_group_dir(title_basename),
+                        'archives.json'))
+            def burned(i):
+                with self.catalog() as catalog:
+                    catalog.disc_burned(backup_id, titles[i])
+                if i < g.total_set_count - 1:
+                    self.update_progress('backup', title_basename,
+                                         discs_burned=1)
+            self.burn_set(set_number_zb, titles, burned)
+            self._record_set_burned(set_number_zb)
+            self._record_slices_staged(0)
+            self.update_progress('backup', title_basename, discs_burned=1,
+                                 sets_burned=1, finished=all_finished)
+
+    # To start a restore, dar wants the last slice, where its catalogue is;
+    # that means the last parity group, from the last set of discs, before
+    # going back to the first set. So when the last group of an archive is
+    # burned, it is also kept in STATE_DIR, with the names of the par files
+    # on the discs of its set, and a restore on this machine starts with the
+    # first set. If a later backup had the same basename, the group kept is
+    # of the later one; so the SHA-256 of slice 1 is kept with it, and
+    # checked when slice 1 is restored, and a group without it isn't used.
+    def _last_group_dir(self, basename):
+        return os.path.join(os.path.expanduser(self.settings.state_dir),
+                            'last_groups', basename)
+
+    # The backups whose last groups are kept, oldest first: for each, the
+    # basename its discs are titled with, and the basenames of its archives.
+    def _kept_last_groups_filename(self):
+        return os.path.join(os.path.expanduser(self.settings.state_dir),
+                            'last_groups', 'kept.json')
+
+    def _kept_last_groups(self):
+        try:
+            with self.fs.open(self._kept_last_groups_filename()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    # Notes that the group of archive, in the backup title_basename, is
+    # kept; and removes the groups of all but the last_groups_kept backups
+    # noted most recently.
+    def _note_last_group(self, title_basename, archive):
+        kept = self._kept_last_groups()
+        archives = next((a for t, a in kept if t == title_basename), [])
+        if archive not in archives:
+            archives.append(archive)
+        kept = [[t, a] for t, a in kept if t != title_basename]
+        kept.append([title_basename, archives])
+        split = max(len(kept) - self.settings.last_groups_kept, 0)
+        dropped, kept = kept[:split], kept[split:]
+        in_use = set(itertools.chain.from_iterable([t] + a for t, a in kept))
+        for title, archives in dropped:
+            for name in [title] + archives:
+                if name not in in_use:
+                    self.fs.rmtree(self._last_group_dir(name),
+                                   ignore_errors=True)
+        self.fs.makedirs(os.path.dirname(self._kept_last_groups_filename()),
+                         exist_ok=True)
+        self.fs.write_atomically(self._kept_last_groups_filename(),
+                                 json.dumps(kept))
+
+    def _cache_last_group(self, catalog, backup_id, title_basename, archive,
+                          set_number_zb):
+        self._note_last_group(title_basename, archive)
+        if not self.settings.last_groups_kept:
+            return
+        ours = archive + '.'
+        pars = sorted(f for f in self.fs.listdir(self.disc_dir(1))
+                      if f.endswith('.par') and f.startswith(ours))
+        if not pars:
+            # it was in an earlier set
+            return
+        last_par = pars[-1]
+        first_ob, last_ob = self._numbers_from_par_filename_ob(last_par)
+        wanted = set([last_par] + [self._slice_name(archive, n, 'dar')
+                                   for n in range(first_ob, last_ob + 1)])
+        cache_dir = self._last_group_dir(archive)
+        self.fs.rmtree(cache_dir, ignore_errors=True)
+        self.fs.makedirs(cache_dir)
+        files = []
+        with self.timed('cache-last-group', archive=archive):
             for d in self.disc_dirs():
-                self._copy(parfilename, os.path.join(d, parfilename))
-                with io.open(os.path.join(d, 'README.txt'), 'wt') as readme:
-                    readme.write(self.readme(basename))
-                this_program = os.path.basename(self.progname)
-                self._copy(this_program, os.path.join(d, this_program))
-            data_dirs = itertools.cycle(self.disc_dir(i+1)
-                    for i in range(self.settings.data_discs))
-            redundancy_dirs = itertools.cycle(self.disc_dir(i+1)
-                    for i in range(self.settings.data_discs,
-                            self.settings.total_set_count))
-            for f, d in itertools.chain(
-                    zip(dar_files_here, data_dirs),
-                    zip(par_volumes, redundancy_dirs)):
-                shutil.move(f, d)
-        dars_on_discs = len(glob.glob(
-                os.path.join(self.disc_dir(1), '*.dar')))
-        size_if_we_dont_burn_KiB = (dars_on_discs + 1) * \
-                self.settings.slice_size_KiB + \
-                self.settings.reserve_space_KiB
-        if size_if_we_dont_burn_KiB > self.settings.disc_size_KiB or \
-                happening == 'last_slice':
-            for i, d in enumerate(self.disc_dirs()):
-                self.log.info("burning from {}".format(d))
-                self.wait_for_empty_disc()
-                self.burn(basename, number, i, d, happening)
-                for fn in glob.glob(os.path.join(d, '*')):
-                    os.unlink(fn)
+                for f in sorted(self.fs.listdir(d)):
+                    if f in files:
+                        continue
+                    if f in wanted or (parity_volume_re.match(f) and
+                                       f.startswith(last_par[:-3])):
+                        self._copy(os.path.join(d, f),
+                                   os.path.join(cache_dir, f))
+                        files.append(f)
+        self.fs.write_atomically(os.path.join(cache_dir, 'last_group.json'),
+                                 json.dumps({
+                                     'set_zb': set_number_zb, 'pars': pars,
+                                     'par': last_par, 'files': files,
+                                     'first_slice_sha256':
+                                     catalog.slice_sha256(backup_id,
+                                                          archive, 1)}))
+
+    def _cached_last_group(self, basename):
+        try:
+            with self.fs.open(os.path.join(self._last_group_dir(basename),
+                                           'last_group.json')) as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return None
+        if cached.get('first_slice_sha256') is None:
+            self.log.warning('not using the last parity group kept in %s: '
+                             'without a checksum of slice 1, it could be of '
+                             'another backup', self._last_group_dir(basename))
+            return None
+        return cached
+
+    # Puts the kept group in scratch as though it had been fetched from the
+    # discs, for _fetch_some_slices to repair (or check) as usual.
+    def _fetch_cached_last_group(self, journal, basename, cached,
+                                 title_basename):
+        if self._journal_pars(basename, cached['set_zb']) is None:
+            self._save_journal_pars(basename, cached['set_zb'],
+                                    cached['pars'])
+        entry = self._journal_group(cached['par'])
+        if not self._journal_says(entry, 'fetched'):
+            with self.timed('fetch-cache', archive=basename):
+                for f in cached['files']:
+                    self._copy(os.path.join(self._last_group_dir(basename), f),
+                               os.path.join(self.settings.scratch_dir, f))
+            self._journal_files(entry, cached['files'])
+            entry['fetched'] = True
+            entry['repaired'] = False
+            self._save_journal_group(cached['par'], entry)
+            self.update_progress('restore', title_basename, groups_fetched=1)
+        journal.setdefault('cached', {})[basename] = \
+                cached['first_slice_sha256']
+        self._save_journal(journal)
+
+    def _check_cached_last_group(self, basename):
+        journal = self._journal()
+        expected = journal.get('cached', {}).get(basename)
+        if expected is None:
+            return
+        first = self._slice_name(basename, 1, 'dar')
+        entry = self._journal_group(self._group_of_slice(journal, basename, 1))
+        if entry['repaired'] and entry['files'].get(first, [0, 0, None])[2]:
+            if entry['files'][first][2] != expected:
+                raise WrongBackup(
+                    'the last parity group kept in {} is of another '
+                    'backup; remove it, and restore again'.format(
+                        self._last_group_dir(basename)))
+            del journal['cached'][basename]
+            self._save_journal(journal)
 
     def _slice_name(self, basename, number, extension):
-        return '{{}}.{{:0{}d}}.{{}}'.format(self.settings.digits).format(
-            basename, number, extension)
+        return self.geometry.slice_name_format.format(basename, number,
+                                                      extension)
 
     def _number_from_slice_name_ob(self, filename):
         return int(filename.split('.')[-2], 10)
@@ -565,10 +3613,12 @@ About the files that may be on this disc:
     def _number_from_slice_name_zb(self, filename):
         return self._number_from_slice_name_ob(filename) - 1
 
+    # maybe.dots.here.XXXXX-YYYYY.par
+    def _numbers_from_par_filename(self, filename):
+        return filename.split('.')[-2].split('-')
+
     def _numbers_from_par_filename_ob(self, filename):
-        # maybe.dots.here.XXXXX-YYYYY.par
-        numbers = filename.split('.')[-2]
-        first_s, last_s = numbers.split('-')
+        first_s, last_s = self._numbers_from_par_filename(filename)
         first_ob = int(first_s, 10)
         last_ob = int(last_s, 10)
         return (first_ob, last_ob)
@@ -579,34 +3629,195 @@ About the files that may be on this disc:
 
     def _last_parity_set_slices_zb(self, basename):
         # SIDE EFFECT: compels the insertion of the first disc in the
-        # last set.
+        # last set, and leaves it in.
         #
         # Any disc in a set has all the pars from the set. The name of
         # the par file contains the slice numbers in the set. So WLOG
-        # we ask for the first disc.
+        # we ask for the first disc; and while it's in, we note the par
+        # files, so that it needn't be asked for again to fetch the set.
+        # Returns the last group, and the disc loaded, as (title, where
+        # its files are).
         disc_dir = self.last_set_directory(basename, 0)
         self.log.debug('first disc in last set is %r', disc_dir)
-        last_par = sorted([x for x in os.listdir(disc_dir)
-                           if x.endswith('.par')])[-1]
+        pars = sorted([x for x in self.media.files(disc_dir)
+                       if x.endswith('.par') and x.startswith(basename + '.')])
+        last_par = pars[-1]
         self.log.debug('last_par is %r', last_par)
-        return self._numbers_from_par_filename_zb(last_par)
-
-    def _fetch_some_slices(self, basename, first_slice_zb, last_slice_zb=None):
+        first_zb, last_zb = self._numbers_from_par_filename_zb(last_par)
+        set_number_zb = self.geometry.place(first_zb + 1)[0]
+        self._save_journal_pars(basename, set_number_zb, pars)
+        return first_zb, last_zb, (
+            self.disc_title(basename, set_number_zb, 0), disc_dir)
+
+    # For a parallel backup, the slices of an archive aren't striped
+    # across sets in order; archives.json says where they went.
+    def _set_for_slice_zb(self, archives, basename, slice_zb):
+        for set_number_zb, ranges in enumerate(archives['sets']):
+            a, b = ranges.get(basename, (0, -1))
+            if a <= slice_zb + 1 <= b:
+                return set_number_zb
+        raise ValueError('no set contains slice', basename, slice_zb + 1)
+
+    def _last_parity_set_of_archive_zb(self, archives, basename):
+        last_zb = max(ranges[basename][1] for ranges in archives['sets']
+                      if basename in ranges) - 1
+        return (last_zb - last_zb % self.geometry.slices_per_group, last_zb)
+
+    # The restore journal, in the scratch directory, is what a restore has
+    # done so far, so that if it dies partway through and is run again, it
+    # needn't ask for the same discs or repair the same parity groups again.
+    # restore_journal.json says which is the last parity group of each
+    # archive. In the restore_journal directory beside it, there's a file
+    # for each parity group, by the name of its par file: the files copied
+    # for it, each with its size, modification time and, once the group is
+    # repaired, SHA-256; whether all the discs have been read for it; and
+    # whether parchive has repaired it. There's also a file for each set,
+    # with the par files on its first disc, which would otherwise mean
+    # asking for that disc. Files are trusted again if their size and
+    # modification time haven't changed. Each hook reads and writes only
+    # the groups it deals with, so that hooks don't take longer the more
+    # slices there have been.
+    def _journal_filename(self):
+        return os.path.join(self.settings.scratch_dir, 'restore_journal.json')
+
+    def _journal_dir(self):
+        return os.path.join(self.settings.scratch_dir, 'restore_journal')
+
+    def _journal(self):
+        try:
+            with self.fs.open(self._journal_filename()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'last_set': {}, 'cached': {}}
+
+    def _save_journal(self, journal):
+        self.fs.write_atomically(self._journal_filename(),
+                                 json.dumps(journal))
+
+    def _journal_entry(self, name):
+        try:
+            with self.fs.open(os.path.join(self._journal_dir(),
+                                           name + '.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save_journal_entry(self, name, value):
+        self.fs.makedirs(self._journal_dir(), exist_ok=True)
+        self.fs.write_atomically(os.path.join(self._journal_dir(),
+                                              name + '.json'),
+                                 json.dumps(value))
+
+    def _journal_pars(self, basename, set_number_zb):
+        return self._journal_entry('{}.set{}'.format(basename,
+                                                     set_number_zb))
+
+    def _save_journal_pars(self, basename, set_number_zb, pars):
+        self._save_journal_entry('{}.set{}'.format(basename, set_number_zb),
+                                 pars)
+
+    def _journal_group(self, parfilename):
+        return self._journal_entry(parfilename) or {
+            'files': {}, 'fetched': False, 'repaired': False}
+
+    def _save_journal_group(self, parfilename, entry):
+        self._save_journal_entry(parfilename, entry)
+
+    # every group in the journal, by the name of its par file
+    def _journal_groups(self):
+        try:
+            names = self.fs.listdir(self._journal_dir())
+        except FileNotFoundError:
+            return {}
+        return {name[:-len('.json')]: self._journal_group(
+                    name[:-len('.json')])
+                for name in names if name.endswith('.par.json')}
+
+    def _journal_files(self, entry, filenames, checksum=False):
+        for f in filenames:
+            filename = os.path.join(self.settings.scratch_dir, f)
+            try:
+                st = self.fs.stat(filename)
+            except FileNotFoundError:
+                entry['files'].pop(f, None)
+                continue
+            digest = None
+            if checksum:
+                with self.timed('checksum') as extra:
+                    extra['bytes'], digest = self.fs.sha256(filename)
+            entry['files'][f] = [st.st_size, st.st_mtime_ns, digest]
+        return entry
+
+    def _journal_says(self, entry, state):
+        if not entry[state]:
+            return False
+        for f, (size, mtime_ns, digest) in entry['files'].items():
+            try:
+                st = self.fs.stat(os.path.join(self.settings.scratch_dir,
+                                               f))
+            except FileNotFoundError:
+                return False
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                return False
+        return True
+
+    # The par file of the parity group a slice is in. Groups are made of
+    # slices_per_group slices of one archive, from the first, so only the
+    # last one, which the journal knows once dar has asked for the last
+    # slice, can be shorter.
+    def _group_of_slice(self, journal, basename, number_ob):
+        g = self.geometry
+        first_ob = number_ob - (number_ob - 1) % g.slices_per_group
+        last_ob = first_ob + g.slices_per_group - 1
+        last_set = journal['last_set'].get(basename)
+        if last_set is not None and last_set[0] + 1 == first_ob:
+            last_ob = last_set[1] + 1
+        return self._par_filename(basename, first_ob, last_ob)
+
+    # whether a slice was repaired, and its group hasn't changed since
+    def _journal_repaired(self, basename, number_ob):
+        entry = self._journal_group(self._group_of_slice(
+            self._journal(), basename, number_ob))
+        return (self._slice_name(basename, number_ob, 'dar') in
+                entry['files'] and self._journal_says(entry, 'repaired'))
+
+    # Fetches the groups from first_slice_zb to last_slice_zb, or to the end
+    # of the set, reading each disc of the set once. loaded is the disc in
+    # the drive, if it's one of them, as (title, where its files are).
+    def _fetch_some_slices(self, basename, first_slice_zb, last_slice_zb=None,
+                           loaded=None):
         self.log.debug('_fetch_some_slices(%r, %r)', first_slice_zb, last_slice_zb)
+        g = self.geometry
+        archives = self._archives()
         # we need entire parity sets, so if first_slice_zb is in the
         # middle of a set, we start at the beginning of the set
-        first_slice_zb -= first_slice_zb % self.settings.data_discs
-        set_number_zb = math.floor(first_slice_zb /
-                                   self.settings.slices_per_set)
+        first_slice_zb -= first_slice_zb % g.slices_per_group
+        if archives is None:
+            title_basename = basename
+            set_number_zb = g.place(first_slice_zb + 1)[0]
+        else:
+            title_basename = archives['basename']
+            set_number_zb = self._set_for_slice_zb(archives, basename,
+                                                   first_slice_zb)
+        # in a parallel backup, files from other archives are on the discs
+        ours = basename + '.'
         self.log.debug('for slice %r (zb) et seq we want set (zb) %d',
                        first_slice_zb, set_number_zb)
         # MAYBE FIXME: we take the set of .par files on the first disc
         # of the set as authoritative; if any are missing I'm not sure
         # what would happen.
-        disc_zb = 0
-        disc_title = self.disc_title(basename, set_number_zb, disc_zb)
-        disc_dir = self.written_disc_directory(disc_title)
-        pars = sorted([x for x in os.listdir(disc_dir) if x.endswith('.par')])
+        pars = self._journal_pars(basename, set_number_zb)
+        if pars is None:
+            disc_zb = 0
+            disc_title = self.disc_title(title_basename, set_number_zb,
+                                         disc_zb)
+            with self.timed('fetch-index', set_zb=set_number_zb,
+                            disc_zb=disc_zb, title=disc_title):
+                disc_dir = self.written_disc_directory(disc_title)
+                pars = sorted([x for x in self.media.files(disc_dir)
+                               if x.endswith('.par') and x.startswith(ours)])
+                loaded = (disc_title, disc_dir)
+            self._save_journal_pars(basename, set_number_zb, pars)
         self.log.debug('pars: %r', pars)
         parity_set_ranges = [self._numbers_from_par_filename_zb(p) for p in pars]
         parity_sets_hereafter = [(a,b) for a,b in parity_set_ranges 
@@ -615,40 +3826,13 @@ About the files that may be on this disc:
                           for a,b in parity_sets_hereafter]
         self.log.debug('pars_hereafter (after slice %d, %d in set %d): %r',
                        first_slice_zb,
-                       first_slice_zb % self.settings.slices_per_set,
+                       first_slice_zb % g.slices_per_set,
                        set_number_zb,
                        pars_hereafter)
         if last_slice_zb is None:
-            max_last_slice_zb = parity_sets_hereafter[-1][-1]
-            if (max_last_slice_zb - first_slice_zb) < (
-                    0.5 * self.settings.slices_per_set):
-                # no use being smart
-                self.log.debug('less than half a set left, fetching the rest')
-                last_slice_zb = max_last_slice_zb
-            else:
-                try:
-                    with open(os.path.join(self.settings.scratch_dir,
-                                           'last_fetched_fraction.txt')) as f:
-                        last_fetched_set_zb = int(f.readline())
-                        last_fetched_fraction = float(f.readline())
-                except FileNotFoundError:
-                    last_fetched_set_zb = set_number_zb
-                    last_fetched_fraction = 0.03
-                if last_fetched_set_zb != set_number_zb:
-                    # this file is out of date
-                    last_fetched_set_zb = set_number_zb
-                    last_fetched_fraction = 0.03
-                to_fetch_fraction = last_fetched_fraction * 3
-                self.log.debug('this time we are fetching %6.3f of a set',
-                               to_fetch_fraction)
-                max_to_fetch = int((to_fetch_fraction *
-                                    self.settings.slices_per_set) + 1)
-                last_slice_zb = min(max_last_slice_zb,
-                                    first_slice_zb + max_to_fetch)
-                with open(os.path.join(self.settings.scratch_dir,
-                                       'last_fetched_fraction.txt'), 'wt') as f:
-                    print(last_fetched_set_zb, file=f)
-                    print(to_fetch_fraction, file=f)
+            # the rest of the set: fetching it in pieces would mean asking
+            # for every disc of the set again for each piece
+            last_slice_zb = parity_sets_hereafter[-1][-1]
         # we need entire parity sets, so if last_slice_zb is in the
         # middle of a set, we end at the end of the set
         for a, b in parity_sets_hereafter:
@@ -659,37 +3843,149 @@ About the files that may be on this disc:
             self.log.error('could not find which parity set slice %d is in',
                            last_slice_zb)
         self.log.debug('last_slice_zb is %d', last_slice_zb)
-        for disc_zb in range(self.settings.total_set_count):
-            disc_title = self.disc_title(basename, set_number_zb, disc_zb)
-            disc_dir = self.written_disc_directory(disc_title)
-            for f in os.listdir(disc_dir):
-                if f.endswith('.dar'):
-                    n = self._number_from_slice_name_zb(f)
-                    if n >= first_slice_zb and n <= last_slice_zb:
-                        self._copy(os.path.join(disc_dir, f),
-                                   os.path.join(self.settings.scratch_dir, f))
-                elif parity_volume_re.match(f):
-                    a, b = self._numbers_from_par_filename_zb(f)
-                    if a >= first_slice_zb and b <= last_slice_zb:
-                        self._copy(os.path.join(disc_dir, f),
-                                   os.path.join(self.settings.scratch_dir, f))
-                elif f.endswith('.par'):
-                    if f in pars_hereafter:
-                        self._copy(os.path.join(disc_dir, f),
-                                   os.path.join(self.settings.scratch_dir, f))
-        for (a,b), parfilename in zip(parity_sets_hereafter, pars_hereafter):
-            if a >= first_slice_zb and b <= last_slice_zb:
-                self._run('parchive', 'r', parfilename)
+        groups = [((a,b), parfilename) for (a,b), parfilename
+                  in zip(parity_sets_hereafter, pars_hereafter)
+                  if a >= first_slice_zb and b <= last_slice_zb]
+        entries = {parfilename: self._journal_group(parfilename)
+                   for (a,b), parfilename in groups}
+        to_fetch = [((a,b), parfilename) for (a,b), parfilename in groups
+                    if not self._journal_says(entries[parfilename],
+                                              'fetched')]
+        self.log.debug('groups already fetched: %d of %d',
+                       len(groups) - len(to_fetch), len(groups))
+        for (a,b), parfilename in to_fetch:
+            # whatever was done for it before can't be trusted now
+            entries[parfilename] = {'files': {}, 'fetched': False,
+                                    'repaired': False}
+        # groups start every slices_per_group slices
+        starting_at = {a: parfilename for (a,b), parfilename in to_fetch}
+        def group_of(f):
+            if f.endswith('.dar'):
+                n = self._number_from_slice_name_zb(f)
+            elif parity_volume_re.match(f) or f.endswith('.par'):
+                n = self._numbers_from_par_filename_zb(f)[0]
+            else:
+                return None
+            return starting_at.get(n - n % g.slices_per_group)
+        for disc_zb in range(g.total_set_count if to_fetch else 0):
+            disc_title = self.disc_title(title_basename, set_number_zb,
+                                         disc_zb)
+            with self.timed('fetch-disc', set_zb=set_number_zb,
+                            disc_zb=disc_zb, title=disc_title):
+                if loaded is not None and loaded[0] == disc_title:
+                    disc_dir = loaded[1]
+                else:
+                    disc_dir = self.written_disc_directory(disc_title)
+                loaded = None
+                copied = []
+                for f in self.media.files(disc_dir):
+                    if not f.startswith(ours):
+                        continue
+                    group = group_of(f)
+                    if group is None:
+                        continue
+                    if self._copy_from_disc(
+                            os.path.join(disc_dir, f),
+                            os.path.join(self.settings.scratch_dir, f)):
+                        copied.append((group, f))
+                self.media.eject()
+            for group in set(group for group, f in copied):
+                self._save_journal_group(group, self._journal_files(
+                    entries[group], [f for g_, f in copied if g_ == group]))
+            self.update_progress(
+                'restore', title_basename, discs_read=1,
+                slices_fetched=len([f for group, f in copied
+                                    if f.endswith('.dar')]),
+                bytes_fetched=sum(
+                    self.fs.getsize(os.path.join(self.settings.scratch_dir, f))
+                    for group, f in copied
+                    if self.fs.exists(os.path.join(self.settings.scratch_dir,
+                                                   f))))
+        if loaded is not None:
+            self.media.eject()
+        for (a,b), parfilename in to_fetch:
+            entries[parfilename]['fetched'] = True
+            self._save_journal_group(parfilename, entries[parfilename])
+        self.update_progress('restore', title_basename,
+                             groups_fetched=len(to_fetch))
+        # as many groups are repaired at once as there are cpu slots
+        scheduler = self.scheduler()
+        async def repair(a, b, parfilename):
+            if self._journal_says(entries[parfilename], 'repaired'):
+                return
+            await scheduler.call(self._repair_group, basename, a, b,
+                                 parfilename, entries[parfilename],
+                                 uses={'cpu': 1})
+            self.update_progress('restore', title_basename, groups_repaired=1)
+        scheduler.run(*(repair(a, b, parfilename)
+                        for (a, b), parfilename in groups))
+
+    # Each group has its own file in the journal, so this can be run for
+    # several at once; and what is repaired is recorded even if the repair
+    # of another group fails meanwhile.
+    def _repair_group(self, basename, a, b, parfilename, entry):
+        with self.timed('repair', group=self.geometry.place(a + 1)[2]):
+            self._run('parchive', 'r', parfilename)
+        # parchive may have put back slices that couldn't be copied
+        self._journal_files(
+            entry, sorted(set(entry['files']) |
+                          set(self._slice_name(basename, n + 1, 'dar')
+                              for n in range(a, b + 1))),
+            checksum=True)
+        entry['repaired'] = True
+        self._save_journal_group(parfilename, entry)
 
     def _extract(self, dir, basename, number, extension, happening):
+        with self.timed('extract', archive=basename, slice_ob=int(number)):
+            self._extract_timed(dir, basename, number, extension, happening)
+
+    def _extract_timed(self, dir, basename, number, extension, happening):
         number = int(number)
         if number == 0:
             # dar wants the last slice but doesn't know its number
-            self._fetch_some_slices(basename,
-                                    *self._last_parity_set_slices_zb(basename))
+            archives = self._archives()
+            journal = self._journal()
+            cached = self._cached_last_group(basename)
+            loaded = None
+            if archives is not None:
+                first_zb, last_zb = self._last_parity_set_of_archive_zb(
+                    archives, basename)
+                title_basename = archives['basename']
+            elif basename in journal['last_set']:
+                first_zb, last_zb = journal['last_set'][basename]
+                title_basename = basename
+            elif cached is not None:
+                first_zb, last_zb = self._numbers_from_par_filename_zb(
+                    cached['par'])
+                title_basename = basename
+            else:
+                first_zb, last_zb, loaded = self._last_parity_set_slices_zb(
+                    basename)
+                title_basename = basename
+            if journal['last_set'].get(basename) != [first_zb, last_zb]:
+                journal['last_set'][basename] = [first_zb, last_zb]
+                self._save_journal(journal)
+            # now we know how many slices there are
+            self.update_progress('restore', title_basename,
+                                 slices_total=last_zb + 1)
+            if cached is not None:
+                self._fetch_cached_last_group(journal, basename, cached,
+                                              title_basename)
+                self._fetch_some_slices(basename, first_zb, last_zb)
+            else:
+                # The discs of the last set are in the drive now for its last
+                # group; the rest of the set is fetched too, rather than
+                # asking for them all again when dar gets there.
+                if archives is None:
+                    set_first_zb = (self.geometry.place(last_zb + 1)[0] *
+                                    self.geometry.slices_per_set)
+                else:
+                    set_first_zb = archives['sets'][self._set_for_slice_zb(
+                        archives, basename, last_zb)][basename][0] - 1
+                self._fetch_some_slices(basename, set_first_zb,
+                                        loaded=loaded)
         else:
-            slice_name = self._slice_name(basename, number, extension)
-            if os.path.exists(slice_name):
+            if self._journal_repaired(basename, number):
                 # the first time this gets called with a real number,
                 # happening is still 'init' so the hawkeyed will see
                 # one of these messages before we go back to set 1
@@ -698,9 +3994,586 @@ About the files that may be on this disc:
                 return
             else:
                 self._fetch_some_slices(basename, number)
+                self._check_cached_last_group(basename)
 
     _list = _extract
-        
+
+def main(progname):
+    s = Settings()
+    if len(sys.argv) < 2:
+        usage(s)
+        sys.exit(1)
+    opts, remaining = getopt.getopt(sys.argv[1:], 'hvnptj:iduo:', ['help'])
+    # the darbrrbs dar runs get these too, in the scratch directory
+    opts = [(o, os.path.abspath(v)) if o == '-o' else (o, v)
+            for o, v in opts]
+    loglevel = logging.WARNING
+    testing = False
+    profiling = False
+    jobs = 1
+    kind = 'full'
+    for o, v in opts:
+        if o == '-h' or o == '--help':
+            usage(s)
+            sys.exit(1)
+        elif o == '-v':
+            loglevel -= 10
+        elif o == '-n':
+            s.actually_burn = False
+            # warn user
+            from time import sleep
+            for i in range(25):
+                for j in range(4):
+                    print('not actually burning', end=' * ')
+                print('\n')
+            sleep(5)
+        elif o == '-p':
+            # the hooks dar runs do the profiling; see Darbrrb.profiled
+            profiling = True
+        elif o == '-t':
+            loglevel = logging.DEBUG
+            testing = True
+        elif o == '-j':
+            jobs = int(v)
+        elif o == '-i':
+            kind = 'incremental'
+        elif o == '-d':
+            kind = 'differential'
+        elif o == '-u':
+            s.unattended = True
+        elif o == '-o':
+            s.iso_dir = v
+        else:
+            raise Exception('unknown switch {}'.format(o))
+    # style only influences how format is interpreted, not also how values are
+    # interpolated into log messages. source: Python 3.2
+    # logging/__init__.py:317, LogRecord class, getMessage method.
+    fmt = logging.Formatter(style='{', fmt='darbrrb {process} '
+                        '[{asctime}] {name}: {message}')
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(fmt)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(stream)
+    root_logger.setLevel(loglevel)
+    # dar expects its stdin and stdout to be a terminal so we will
+    # make a log file for our messages rather than depend on
+    # redirection. It's shared by all of us, including the darbrrbs dar
+    # runs.
+    if not testing:
+        shared_log = SharedLogHandler(
+            os.path.join(s.scratch_dir, 'darbrrb.log'),
+            s.log_max_MiB * 1048576, s.log_keep)
+        root_logger.addHandler(shared_log)
+    log = logging.getLogger('__main__'.format(os.getpid()))
+    log.debug('called with args %r', sys.argv)
+    if testing:
+        # strip off switches: they are not for unittest.main
+        sys.argv = [sys.argv[0]] + remaining
+        import unittest
+        sys.exit(unittest.main())
+    d = Darbrrb(s, progname, opts)
+    shared_log.context = d.span_context
+    if remaining[0].startswith('_'):
+        d.load_geometry()
+    try:
+        if remaining[0] == 'dar':
+            import pickle, base64
+            os.environ['DARBRRB_ORIGINAL_ARGV'] = base64.b64encode(
+                pickle.dumps(sys.argv, protocol=0)).decode('UTF-8')
+            root = dar_argument(remaining[1:], '-R', '--fs-root')
+            if root is not None and dar_argument(remaining[1:], '-c',
+                                                 '--create') is not None:
+                d.prescan(root)
+                print(d.expected_discs_message(), file=sys.stderr)
+            creating = dar_argument(remaining[1:], '-c',
+                                    '--create') is not None
+            if jobs > 1 and kind != 'full':
+                raise Exception('-i and -d cannot be used with -j')
+            if (s.unattended and s.actually_burn and s.iso_dir is None and
+                    s.media_backend == 'prompt'):
+                raise Exception('-u needs a media_backend that can change '
+                                'discs without you')
+            if (creating and s.actually_burn and s.iso_dir is None and
+                    s.media_backend == 'iso'):
+                raise Exception("the 'iso' media_backend has no blank discs; "
+                                "use -o DIR to write images")
+            reading = dar_argument(remaining[1:], '-x', '--extract', '-l',
+                                   '--list', '-t', '--test')
+            if reading is not None:
+                digits = d.recorded_digits(reading)
+                if digits is not None:
+                    s.digits = digits
+            d.ensure_scratch(reuse=not creating)
+            if profiling:
+                d.clear_profiles()
+            if jobs > 1 and root is not None and creating:
+                catalogues = d.backup_in_parallel(remaining[1:], jobs)
+                d.finish_catalog(dar_argument(remaining[1:], '-c',
+                                              '--create'), kind, catalogues)
+            elif jobs > 1 and dar_argument(remaining[1:], '-x',
+                                           '--extract') is not None:
+                d.restore_in_parallel(remaining[1:])
+            elif creating:
+                dar_args, chain = d.start_chain_member(remaining[1:], kind)
+                d.dar(*dar_args)
+                d.finish_chain_member(dar_argument(remaining[1:], '-c',
+                                                   '--create'), chain)
+                d.finish_catalog(chain[-1]['basename'], kind,
+                                 [(chain[-1]['basename'],
+                                   chain[-1]['catalogue'])])
+            else:
+                d.dar(*remaining[1:])
+        elif remaining[0] == 'plan':
+            if len(remaining) < 2:
+                usage(s)
+                sys.exit(1)
+            media = remaining[2] if len(remaining) > 2 else 'bluray'
+            if media not in media_types:
+                usage(s)
+                print('unknown kind of disc {!r}: use one of {}'.format(
+                    media, ', '.join(sorted(media_types))), file=sys.stderr)
+                sys.exit(1)
+            if os.path.isdir(remaining[1]):
+                data_size_GiB = d.prescan(remaining[1])[0] / 1073741824
+            else:
+                try:
+                    data_size_GiB = float(remaining[1])
+                except ValueError:
+                    usage(s)
+                    print('{!r} is neither a directory nor a size in '
+                          'GiB'.format(remaining[1]), file=sys.stderr)
+                    sys.exit(1)
+            parity_discs = (int(remaining[3]) if len(remaining) > 3
+                            else s.parity_discs)
+            group_slices_per_disc = (int(remaining[4]) if len(remaining) > 4
+                                     else s.group_slices_per_disc)
+            plan = plan_geometry(data_size_GiB, media, parity_discs,
+                                 group_slices_per_disc=group_slices_per_disc)
+            print(plan.report())
+            print('Put these among the settings at the top of this script:')
+            print(plan.settings_text())
+        elif remaining[0] == 'chain':
+            if len(remaining) < 2:
+                usage(s)
+                sys.exit(1)
+            if os.path.isfile(remaining[1]):
+                with open(remaining[1]) as f:
+                    chain = json.load(f)
+            else:
+                chain = d.load_chain(remaining[1])
+            print(d.chain_restore_instructions(
+                chain, remaining[2] if len(remaining) > 2 else None))
+        elif remaining[0] == 'timings':
+            filename = (remaining[1] if len(remaining) > 1
+                        else d._timings_filename())
+            print(summarize_timings(read_timings(filename)))
+        elif remaining[0] == 'profile':
+            directory = (remaining[1] if len(remaining) > 1
+                         else d._profiles_dir())
+            count = remaining[2] if len(remaining) > 2 else '25'
+            if not count.isdigit() or int(count) < 1:
+                usage(s)
+                sys.exit(1)
+            filenames = glob.glob(os.path.join(directory, '*.prof'))
+            if not filenames:
+                raise Exception('no profiles in', directory)
+            print(summarize_profiles(filenames, int(count)))
+        elif remaining[0] == 'log':
+            filename = os.path.join(s.scratch_dir, 'darbrrb.log')
+            criteria = {}
+            for a in remaining[1:]:
+                if '=' in a:
+                    name, value = a.split('=', 1)
+                    criteria[name] = value
+                else:
+                    filename = a
+            for record in filter_log(read_log(filename), criteria):
+                print(format_log_record(record))
+        elif remaining[0] == 'catalog':
+            if len(remaining) < 2:
+                usage(s)
+                sys.exit(1)
+            with d.catalog() as catalog:
+                backup_id = catalog.find_backup(
+                    remaining[1], remaining[2] if len(remaining) > 2 else None)
+                if backup_id is None:
+                    raise Exception('no backup in the catalog has',
+                                    remaining[1:])
+                print(catalog_report(catalog.backup(backup_id), remaining[1],
+                                     catalog.discs_needed(backup_id,
+                                                          remaining[1])))
+        elif remaining[0] == 'export-catalog':
+            if len(remaining) < 3:
+                usage(s)
+                sys.exit(1)
+            with d.catalog() as catalog:
+                backup_id = catalog.latest_backup(remaining[1])
+                if backup_id is None:
+                    raise Exception('no backup in the catalog is called',
+                                    remaining[1])
+                catalog.export(backup_id, remaining[2])
+        elif remaining[0] == 'progress':
+            print(progress_report(d._progress()))
+        elif remaining[0] == '_create':
+            with d.profiled('_create'):
+                d._create(*remaining[1:])
+        elif remaining[0] == '_extract':
+            with d.profiled('_extract'):
+                d._extract(*remaining[1:])
+        elif remaining[0] == '_list':
+            d._list(*remaining[1:])
+        elif remaining[0] == '_move_staged':
+            d.drain_outbox()
+        else:
+            raise Exception("unknown subcommand", remaining)
+        log.debug('execution ended without exception')
+    except Exception as e:
+        log.exception('execution ended abnormally')
+        raise
+
+# dar's hooks run only what is above this line; see _compile_hook.
+# ---- tests ----
+
+import tempfile
+import unittest
+import random
+try:
+    from unittest.mock import Mock, patch, sentinel, call
+except ImportError:
+    from mock import Mock, patch, sentinel, call
+
+class _MemoryFile:
+    __slots__ = ('size', 'data', 'mtime_ns', 'database')
+
+    def __init__(self, size=0, data=None, database=None):
+        self.size = size
+        self.data = data
+        self.mtime_ns = time.time_ns()
+        self.database = database
+
+    # Files made with MemoryFilesystem.make_file have a size, but no
+    # contents, and read as zeros.
+    def contents(self):
+        if self.database is not None:
+            return b''.join(line.encode('UTF-8') + b'\n'
+                            for line in self.database.iterdump())
+        if self.data is None:
+            return bytes(self.size)
+        return self.data
+
+    # A copy of a database is a plain file of the same size, holding the
+    # database as SQL.
+    def copy(self):
+        if self.database is not None:
+            return _MemoryFile(self.contents_size(), self.contents())
+        if isinstance(self.data, bytearray):
+            return _MemoryFile(self.size, bytes(self.data))
+        return _MemoryFile(self.size, self.data)
+
+    def contents_size(self):
+        if self.database is None:
+            return self.size
+        page_count, = self.database.execute('PRAGMA page_count').fetchone()
+        page_size, = self.database.execute('PRAGMA page_size').fetchone()
+        return page_count * page_size
+
+_MemoryStat = collections.namedtuple('_MemoryStat', 'st_size st_mtime_ns')
+
+class _MemoryWriter(io.BytesIO):
+    def __init__(self, fs, path, initial=b''):
+        super().__init__(initial)
+        self.seek(0, io.SEEK_END)
+        self.fs = fs
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            data = self.getvalue()
+            self.fs._put(self.path, _MemoryFile(len(data), data))
+        super().close()
+
+# Files and directories kept in memory, for simulating backups and restores
+# much bigger than there is room for, and faster than any disk. Sizes are
+# kept to the byte, so that disc and scratch space come out as they would;
+# slices and parity volumes stood in for with make_file take no room in
+# memory. Only this process can see the files: the dar, parchive and
+# growisofs it would run, and the mover, must be stood in for too. SQLite
+# databases are kept in memory by SQLite itself. counts has how many times
+# files were opened, copied and moved, and directories listed, and how many
+# names the listings had, for telling how the work grows with a backup.
+# What changes the sizes is done under a lock, since a Scheduler may be
+# repairing several groups at once.
+class MemoryFilesystem:
+    def __init__(self, capacity_bytes=1 << 60, cwd='/'):
+        self.capacity_bytes = capacity_bytes
+        self.cwd = cwd
+        self.files = {}
+        self.dirs = {'/': set()}
+        self.used_bytes = 0
+        self.high_water_bytes = 0
+        self.counts = collections.Counter()
+        self._lock = threading.RLock()
+
+    def _abs(self, path):
+        return os.path.normpath(os.path.join(self.cwd, path))
+
+    def _file(self, path):
+        path = self._abs(path)
+        try:
+            return self.files[path]
+        except KeyError:
+            if path in self.dirs:
+                raise IsADirectoryError(errno.EISDIR, os.strerror(
+                    errno.EISDIR), path)
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                    path)
+
+    def _parent(self, path):
+        parent, name = os.path.split(path)
+        if parent not in self.dirs:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                    parent)
+        return self.dirs[parent], name
+
+    def _put(self, path, f):
+        with self._lock:
+            self._put_locked(self._abs(path), f)
+
+    def _put_locked(self, path, f):
+        if path in self.dirs:
+            raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR),
+                                    path)
+        names, name = self._parent(path)
+        old = self.files.get(path)
+        if old is not None:
+            self.used_bytes -= old.size
+            if old.database is not None:
+                old.database.close()
+        if self.used_bytes + f.size > self.capacity_bytes:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+        self.used_bytes += f.size
+        self.high_water_bytes = max(self.high_water_bytes, self.used_bytes)
+        self.files[path] = f
+        names.add(name)
+
+    def _remove(self, path):
+        with self._lock:
+            self._remove_locked(path)
+
+    def _remove_locked(self, path):
+        f = self.files.pop(path)
+        self.used_bytes -= f.size
+        self._parent(path)[0].discard(os.path.basename(path))
+        if f.database is not None:
+            f.database.close()
+
+    # a file of the given size, without contents
+    def make_file(self, path, size):
+        self._put(path, _MemoryFile(size))
+
+    def open(self, filename, mode='r', encoding=None):
+        self.counts['open'] += 1
+        binary = 'b' in mode
+        kind = mode.replace('b', '').replace('t', '')
+        if kind == 'r':
+            f = io.BytesIO(self._file(filename).contents())
+        elif kind == 'w':
+            f = _MemoryWriter(self, self._abs(filename))
+            self._put(filename, _MemoryFile())
+        elif kind == 'a':
+            path = self._abs(filename)
+            if path not in self.files:
+                self._put(path, _MemoryFile())
+            f = _MemoryWriter(self, path, self.files[path].contents())
+        else:
+            raise ValueError('unsupported mode', mode)
+        if binary:
+            return f
+        return io.TextIOWrapper(f, encoding=encoding)
+
+    def listdir(self, path='.'):
+        path = self._abs(path)
+        if path not in self.dirs:
+            if path in self.files:
+                raise NotADirectoryError(errno.ENOTDIR, os.strerror(
+                    errno.ENOTDIR), path)
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                    path)
+        self.counts['listdir'] += 1
+        self.counts['listed'] += len(self.dirs[path])
+        return list(self.dirs[path])
+
+    def glob(self, pattern):
+        import fnmatch
+        dirname, basename = os.path.split(pattern)
+        if glob.has_magic(dirname):
+            dirnames = self.glob(dirname)
+        else:
+            dirnames = [dirname]
+        found = []
+        for d in dirnames:
+            if not self.isdir(d or '.'):
+                continue
+            names = self.listdir(d or '.')
+            if glob.has_magic(basename):
+                names = fnmatch.filter(names, basename)
+            elif basename in names or not basename:
+                names = [basename]
+            else:
+                names = []
+            if not basename.startswith('.'):
+                names = [n for n in names if not n.startswith('.')]
+            if d:
+                found.extend(os.path.join(d, n) for n in names)
+            else:
+                found.extend(names)
+        return found
+
+    def exists(self, path):
+        path = self._abs(path)
+        return path in self.files or path in self.dirs
+
+    def isdir(self, path):
+        return self._abs(path) in self.dirs
+
+    def getsize(self, path):
+        return self._file(path).contents_size()
+
+    def stat(self, path):
+        f = self._file(path)
+        return _MemoryStat(f.contents_size(), f.mtime_ns)
+
+    def mkdir(self, path):
+        path = self._abs(path)
+        if self.exists(path):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                                  path)
+        names, name = self._parent(path)
+        names.add(name)
+        self.dirs[path] = set()
+
+    def makedirs(self, path, exist_ok=False):
+        path = self._abs(path)
+        if path in self.dirs:
+            if not exist_ok:
+                raise FileExistsError(errno.EEXIST,
+                                      os.strerror(errno.EEXIST), path)
+            return
+        parent = os.path.dirname(path)
+        if parent not in self.dirs:
+            self.makedirs(parent)
+        self.mkdir(path)
+
+    def unlink(self, path):
+        self._file(path)
+        self._remove(self._abs(path))
+
+    def rmtree(self, path, ignore_errors=False):
+        path = self._abs(path)
+        if path not in self.dirs:
+            if ignore_errors:
+                return
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                    path)
+        for name in list(self.dirs[path]):
+            child = os.path.join(path, name)
+            if child in self.dirs:
+                self.rmtree(child)
+            else:
+                self._remove(child)
+        del self.dirs[path]
+        self._parent(path)[0].discard(os.path.basename(path))
+
+    # A database is reached by the name of its file, so a database moved
+    # elsewhere becomes a plain file.
+    def replace(self, source, destination):
+        f = self._file(source)
+        if f.database is not None:
+            f = f.copy()
+        self._remove(self._abs(source))
+        self._put(destination, f)
+
+    def copyfile(self, source, destination):
+        self.counts['copy'] += 1
+        self._put(destination, self._file(source).copy())
+
+    def move(self, source, destination):
+        self.counts['move'] += 1
+        if self.isdir(destination):
+            destination = os.path.join(destination, os.path.basename(source))
+        self.replace(source, destination)
+
+    # in place, since a file like timings.jsonl is appended to many times
+    def append(self, filename, data):
+        with self._lock:
+            self._append_locked(self._abs(filename), data)
+
+    def _append_locked(self, path, data):
+        if path not in self.files:
+            self._put(path, _MemoryFile(0, bytearray()))
+        f = self._file(path)
+        if self.used_bytes + len(data) > self.capacity_bytes:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+        if f.data is None or f.database is not None:
+            f.data = bytearray(f.contents())
+        elif not isinstance(f.data, bytearray):
+            f.data = bytearray(f.data)
+        f.data += data
+        self.used_bytes += len(f.data) - f.size
+        self.high_water_bytes = max(self.high_water_bytes, self.used_bytes)
+        f.size = len(f.data)
+        f.mtime_ns = time.time_ns()
+
+    def write_atomically(self, filename, text):
+        with self.open(filename, 'wt') as f:
+            f.write(text)
+
+    # Files without contents aren't read to checksum them: that would be
+    # measuring I/O. Their digest is of their size.
+    def sha256(self, filename):
+        f = self._file(filename)
+        if f.data is None and f.database is None:
+            return f.size, hashlib.sha256(
+                'empty {}'.format(f.size).encode('ascii')).hexdigest()
+        data = f.contents()
+        return len(data), hashlib.sha256(data).hexdigest()
+
+    def device_of(self, filename):
+        return 'memory'
+
+    def will_read(self, filename):
+        self._file(filename)
+
+    def free_bytes(self, path):
+        return self.capacity_bytes - self.used_bytes
+
+    # one process, so nobody to take turns with
+    @contextlib.contextmanager
+    def lock(self, filename):
+        if not self.exists(filename):
+            self._put(filename, _MemoryFile())
+        yield
+
+    # A database lives as long as a connection to it is open, so the file
+    # keeps one; unlinking the file lets it go.
+    def sqlite_uri(self, filename):
+        import urllib.parse
+        path = self._abs(filename)
+        uri = 'file:darbrrb-{}{}?mode=memory&cache=shared'.format(
+            id(self), urllib.parse.quote(path))
+        f = self.files.get(path)
+        if f is None or f.database is None:
+            database = sqlite3.connect(uri, uri=True)
+            self._put(path, _MemoryFile(database=database))
+        return uri
+
+    # Nothing can run it; but it takes as long to compile.
+    def compile(self, source, cfile, dfile):
+        import marshal
+        with self.open(source, 'rt', encoding='utf-8') as f:
+            code = compile(f.read(), dfile, 'exec')
+        with self.open(cfile, 'wb') as f:
+            f.write(marshal.dumps(code))
 
 class TestDigits(unittest.TestCase):
     def test1(self):
@@ -715,6 +4588,7 @@ class UsesTempScratchDir(unittest.TestCase):
     def setUp(self):
         self.settings = Settings()
         tempdir = tempfile.mkdtemp('darbrrb_test')
+        self.settings.state_dir = tempfile.mkdtemp('darbrrb_test_state')
         self.old_tempfile_tempdir = tempfile.tempdir
         tempfile.tempdir = tempdir
         self.settings.scratch_dir = tempdir
@@ -724,6 +4598,7 @@ class UsesTempScratchDir(unittest.TestCase):
     
     def tearDown(self):
         shutil.rmtree(self.settings.scratch_dir)
+        shutil.rmtree(self.settings.state_dir)
         tempfile.tempdir = self.old_tempfile_tempdir
 
     def mkdirp_parents(self, *names):
@@ -808,6 +4683,176 @@ class TestWorkingDirectoryContextManager(unittest.TestCase):
                                 call('/zart')])
 
 
+class TestPrescan(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.root = os.path.join(self.settings.scratch_dir, 'tree')
+        for name, size in (('a', 100), ('b/c', 2000), ('b/d/e', 30000),
+                           ('f/g', 7)):
+            filename = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as f:
+                f.write(b'x' * size)
+        self.d = Darbrrb(self.settings, __file__)
+
+    def testTotals(self):
+        total_bytes, files, cache = scan_source_tree(self.root, threads=3)
+        self.assertEqual(total_bytes, 32107)
+        self.assertEqual(files, 4)
+        self.assertEqual(len(cache), 4)
+
+    def testUnchangedDirectoriesAreNotRead(self):
+        self.d.prescan(self.root)
+        with patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(self.d.prescan(self.root), (32107, 4))
+            self.assertEqual(scandir.call_count, 0)
+            with open(os.path.join(self.root, 'b', 'd', 'h'), 'wb') as f:
+                f.write(b'x' * 5)
+            self.assertEqual(self.d.prescan(self.root), (32112, 5))
+            self.assertEqual(scandir.call_count, 1)
+
+    def testMeasuredSizeIsRecorded(self):
+        self.d.prescan(self.root)
+        self.assertAlmostEqual(self.settings.expected_data_size_GiB,
+                               32107 / 1073741824)
+        self.assertEqual(self.settings.expected_set_count, 1)
+        copy = os.path.join(self.settings.scratch_dir, 'copy.py')
+        self.d._copy_self(copy)
+        with open(copy) as f:
+            recorded = [l for l in f if 'expected_data_size_GiB = ' in l]
+        self.assertEqual(recorded[0].strip(), 'expected_data_size_GiB = ' +
+                         repr(self.settings.expected_data_size_GiB))
+
+    def testSplit(self):
+        self.d.prescan(self.root)
+        self.assertEqual(split_source_tree(self.root, self.d.prescan_cache,
+                                           2),
+                         [['b'], ['a', 'f']])
+        self.assertEqual(len(split_source_tree(self.root,
+                                               self.d.prescan_cache, 5)), 3)
+
+    # so that the catalog knows which slices their files are in
+    @patch('subprocess.check_output')
+    @patch.object(Darbrrb, 'dar_parallel')
+    def testParallelArchivesIsolateCatalogues(self, dar_parallel,
+                                              check_output):
+        self.d.prescan(self.root)
+        catalogues = self.d.backup_in_parallel(['-c', 'bn', '-R', self.root],
+                                               2)
+        self.assertEqual([a for a, c in catalogues], ['bn_1', 'bn_2'])
+        for (archive, catalogue), args in zip(
+                catalogues, dar_parallel.call_args[0][0]):
+            self.assertEqual(args[args.index('-@') + 1], catalogue)
+            self.assertEqual(os.path.dirname(catalogue), os.path.join(
+                self.settings.scratch_dir, 'catalogues'))
+        check_output.return_value = TestCatalog.listing.encode('UTF-8')
+        self.d.finish_catalog('bn', 'full', catalogues)
+        with self.d.catalog() as catalog:
+            backup_id = catalog.latest_backup('bn')
+            self.assertEqual(catalog.db.execute(
+                'SELECT DISTINCT archive FROM files WHERE backup_id = ? '
+                'ORDER BY archive', (backup_id,)).fetchall(),
+                [('bn_1',), ('bn_2',)])
+
+    def testDarArgument(self):
+        self.assertEqual(dar_argument(('-c', 'bn', '-R', '/r'), '-R'), '/r')
+        self.assertEqual(dar_argument(('-x', 'bn'), '-c', '--create'), None)
+
+
+class TestPlanGeometry(unittest.TestCase):
+    sizes_GiB = (0.01, 3, 40, 500, 4000)
+
+    # A catalog of a whole set, as each disc carries, with the longest names
+    # and biggest numbers there can be; by slices in the set.
+    catalog_bytes = {}
+    def set_catalog_bytes(self, slices_per_set):
+        if slices_per_set not in self.catalog_bytes:
+            directory = tempfile.mkdtemp('darbrrb_test')
+            try:
+                whole = os.path.join(directory, 'whole.sqlite')
+                exported = os.path.join(directory, 'set.sqlite')
+                with Catalog(whole) as catalog:
+                    backup_id = catalog.begin_backup(
+                        'x' * 23, ['/usr/bin/python3', 'darbrrb.py', 'dar',
+                                   '-c', 'x' * 23, '-R', '/' + 'y' * 200],
+                        {name: repr(value) for name, value in
+                         vars(Settings).items()})
+                    for n in range(slices_per_set):
+                        catalog.record_slice(backup_id, 'x' * 23 + '_999',
+                                             10 ** 8 + n, 10 ** 11, 'f' * 64)
+                    catalog.record_disc(backup_id, 'x' * 23 + '-9999-099', 0,
+                                        0, False, [('x' * 23 + '_999',
+                                                    10 ** 8 + n)
+                                                   for n in range(
+                                                       slices_per_set)])
+                    catalog.export(backup_id, exported, 0)
+                self.catalog_bytes[slices_per_set] = os.path.getsize(exported)
+            finally:
+                shutil.rmtree(directory)
+        return self.catalog_bytes[slices_per_set]
+
+    # archives.json for 8 archives at once over 100 sets, and chain.json for
+    # a chain of 20 backups of 50 discs each
+    json_bytes = (len(json.dumps({
+        'basename': 'x' * 23, 'archives': ['x' * 23 + '_8'] * 8,
+        'finished': ['x' * 23 + '_8'] * 8,
+        'sets': [{'x' * 23 + '_8': [10 ** 8, 10 ** 8]} for i in range(8)] *
+        100}, indent=1)) + len(json.dumps([{
+            'basename': 'x' * 23 + '_020', 'kind': 'incremental',
+            'reference': 'x' * 23 + '_019', 'created': '2016-03-01T00:00:00',
+            'catalogue': '/' + 'y' * 200, 'discs': ['x' * 23 + '-9999-099'] *
+            50}] * 20, indent=1)))
+
+    # Worked out from the file formats rather than from the settings, so
+    # that a mistake in the slice size arithmetic shows up here.
+    def fullest_disc_bytes(self, s):
+        k = s.group_slices_per_disc
+        groups_per_disc = s.slices_per_disc // k
+        par_header_bytes = 96 + 120 * s.data_discs * k
+        slice_bytes = s.slice_size_KiB * 1024
+        readme_bytes = len(Darbrrb(s, __file__).readme('x' * 23))
+        fs_bytes = (362 + 1.7 * (s.slices_per_disc + groups_per_disc + 5)
+                    ) * 1024
+        common = (groups_per_disc * par_header_bytes + fs_bytes +
+                  os.path.getsize(__file__) + readme_bytes +
+                  self.set_catalog_bytes(s.slices_per_set) + self.json_bytes)
+        data_disc = s.slices_per_disc * slice_bytes
+        parity_disc = s.slices_per_disc * (slice_bytes + par_header_bytes)
+        return common + max(data_disc, parity_disc)
+
+    def testNeverOverflows(self):
+        for media in media_types:
+            for parity_discs in (1, 2, 3):
+                for size in self.sizes_GiB:
+                    for k in (1, 10):
+                        plan = plan_geometry(size, media, parity_discs,
+                                             group_slices_per_disc=k)
+                        s = plan.settings
+                        self.assertEqual(s.parity_discs, parity_discs)
+                        self.assertEqual(s.slices_per_disc % k, 0)
+                        self.assertLessEqual(self.fullest_disc_bytes(s),
+                                             s.disc_size_MiB * 1048576,
+                                             plan.report())
+
+    def testNoWorseThanDefaults(self):
+        for size in self.sizes_GiB:
+            plan = plan_geometry(size, 'bluray', Settings.parity_discs)
+            default = Settings()
+            default.expected_data_size_GiB = size
+            self.assertLessEqual(plan.total_discs,
+                                 max(1, default.expected_set_count) *
+                                 default.total_set_count)
+
+    def testSettingsText(self):
+        plan = plan_geometry(40, 'dvd', 1)
+        namespace = {}
+        exec('class S:\n' + plan.settings_text(), namespace)
+        self.assertEqual(namespace['S'].parity_discs, 1)
+        self.assertEqual(namespace['S'].disc_size_MiB, 4482)
+        self.assertEqual(namespace['S'].slices_per_disc,
+                         plan.settings.slices_per_disc)
+
+
 @patch('os.chdir')
 @patch('os.getcwd', return_value='/zart')
 @patch.object(Darbrrb, '_run')
@@ -829,6 +4874,31 @@ class TestInvokeDar(UsesTempScratchDir):
                 call(self.settings.scratch_dir),
                 call('/zart')])
 
+@patch.object(Darbrrb, 'scratch_free_MiB', return_value=1000000)
+class TestEnsureScratch(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.d = Darbrrb(self.settings, __file__)
+
+    def testEmptyOrLogOnly(self, scratch_free_MiB):
+        with open(os.path.join(self.settings.scratch_dir, 'darbrrb.log'),
+                  'wt') as f:
+            f.write('{}\n')
+        self.d.ensure_scratch()
+        self.assertTrue(os.path.isdir(os.path.join(
+            self.settings.scratch_dir, self.d.disc_dir(1))))
+
+    def testBackupRefusesLeftovers(self, scratch_free_MiB):
+        self.d.ensure_scratch()
+        with open(os.path.join(self.settings.scratch_dir, self.d.disc_dir(1),
+                               'old.0001.dar'), 'wb'):
+            pass
+        with self.assertRaises(ScratchAlreadyExists):
+            self.d.ensure_scratch()
+
+    def testRestoreReuses(self, scratch_free_MiB):
+        self.d.ensure_scratch(reuse=True)
+        self.d.ensure_scratch(reuse=True)
 
 @patch.object(Darbrrb, '_run')
 @patch.object(Darbrrb, 'wait_for_empty_disc')
@@ -902,6 +4972,1105 @@ class TestDarbrrbFourPlusOne(UsesTempScratchDir):
             ])
         self.assertEqual(self.d._run.call_count, 6)
 
+    def testTimings(self, wfed, _run):
+        self.touch_dar_files('thing', 13, 14)
+        self.touch_par_files('thing', 13, 14, 1)
+        self.d._create('dir', 'thing', '14', 'dar', 'last_slice')
+        spans = read_timings(self.d._timings_filename())
+        burns = [s for s in spans if s['phase'] == 'burn']
+        self.assertEqual([s['title'] for s in burns],
+                         ['thing-0001-{:03d}'.format(i) for i in range(1, 6)])
+        self.assertEqual([s['disc_zb'] for s in burns], list(range(5)))
+        for s in burns:
+            self.assertEqual(s['device'], '/dev/zero')
+            self.assertEqual(s['slice_ob'], 14)
+        self.assertIn('parity', [s['phase'] for s in spans])
+
+    def testIsoImages(self, wfed, _run):
+        self.settings.iso_dir = os.path.join(self.settings.scratch_dir,
+                                             'images')
+        self.touch_dar_files('thing', 13, 14)
+        self.touch_par_files('thing', 13, 14, 1)
+        self.d._create('dir', 'thing', '14', 'dar', 'last_slice')
+        self.assertEqual(sorted(os.listdir(self.settings.iso_dir)),
+                         ['thing-0001-{:03d}.iso'.format(i)
+                          for i in range(1, 6)])
+        self.assertEqual(self.d._run.call_count, 1)
+        self.assertEqual(glob.glob('__disc*/*'), [])
+
+    def testProgress(self, wfed, _run):
+        self.settings.textfile_dir = self.settings.scratch_dir
+        self.touch_dar_files('thing', 13, 14)
+        self.touch_par_files('thing', 13, 14, 1)
+        self.d._create('dir', 'thing', '14', 'dar', 'last_slice')
+        progress = self.d._progress()
+        self.assertEqual((progress['slices_done'], progress['discs_burned'],
+                          progress['sets_burned']), (1, 5, 1))
+        self.assertTrue(progress['finished'])
+        self.assertEqual(progress['projected_remaining_discs'], 0)
+        self.assertEqual(progress['eta_seconds'], 0)
+        self.assertEqual(self.d._compression_ratios(),
+                         {'thing': {'full': progress['compression_ratio']}})
+        with open('darbrrb.prom') as f:
+            prom = f.read()
+        self.assertIn('darbrrb_discs_burned{mode="backup",basename="thing"} 5',
+                      prom.splitlines())
+
+    def testCatalog(self, wfed, _run):
+        self.touch_dar_files('thing', 13, 14)
+        self.touch_par_files('thing', 13, 14, 1)
+        with open('thing.0013.dar', 'wb') as f:
+            f.write(b'slice thirteen')
+        with open('thing.0014.dar', 'wb') as f:
+            f.write(b'slice fourteen')
+        on_discs = []
+        with patch.object(self.d, 'burn', side_effect=lambda title, d:
+                          on_discs.append(os.listdir(d))):
+            self.d._create('dir', 'thing', '14', 'dar', 'last_slice')
+        self.assertEqual(len(on_discs), 5)
+        self.assertTrue(all('catalog.sqlite' in l for l in on_discs))
+        with self.d.catalog() as catalog:
+            self.assertEqual(catalog.db.execute(
+                'SELECT archive, number, bytes, sha256, title '
+                'FROM slices ORDER BY number').fetchall(),
+                [('thing', 13, 14,
+                  hashlib.sha256(b'slice thirteen').hexdigest(),
+                  'thing-0001-001'),
+                 ('thing', 14, 14,
+                  hashlib.sha256(b'slice fourteen').hexdigest(),
+                  'thing-0001-002')])
+            self.assertEqual(catalog.db.execute(
+                'SELECT count(*) FROM discs WHERE burned IS NOT NULL '
+                'AND parity').fetchone(), (1,))
+
+    # the slices of a group are recorded when its parity is made, in the
+    # backup's row that the first group made
+    def testCatalogBackupRow(self, wfed, _run):
+        self.touch_dar_files('thing', 1, 3)
+        for n in range(1, 4):
+            self.d._create('dir', 'thing', str(n), 'dar', 'operating')
+        self.assertFalse(os.path.exists('catalog_backup.txt'))
+        self.touch_dar_files('thing', 4, 4)
+        self.touch_par_files('thing', 1, 4, 1)
+        self.d._create('dir', 'thing', '4', 'dar', 'operating')
+        with open('catalog_backup.txt') as f:
+            backup_id = int(f.read())
+        self.touch_dar_files('thing', 5, 8)
+        self.touch_par_files('thing', 5, 8, 1)
+        self.d._create('dir', 'thing', '8', 'dar', 'operating')
+        with open('catalog_backup.txt') as f:
+            self.assertEqual(int(f.read()), backup_id)
+        with self.d.catalog() as catalog:
+            self.assertEqual(catalog.db.execute(
+                'SELECT count(*) FROM backups').fetchone(), (1,))
+            self.assertEqual(catalog.db.execute(
+                'SELECT backup_id, number FROM slices ORDER BY number'
+                ).fetchall(), [(backup_id, n) for n in range(1, 9)])
+
+class TestCatalog(UsesTempScratchDir):
+    listing = (
+        'Slice(s)|[Data ][D][ EA  ][FSA][Compr][S]|Permission| Filemane\n'
+        '--------+--------------------------------+----------+-------------'
+        '----------------\n'
+        '1\t[Saved][-]       [-L-][     ][ ]  drwxr-xr-x\ta\n'
+        '1\t[Saved][ ]       [-L-][  50%][ ]  -rw-r--r--\ta/x\n'
+        '2-3\t[Saved][ ]       [-L-][  10%][ ]  -rw-r--r--\ta/y\n'
+        '4\t[Saved][ ]       [-L-][  10%][ ]  -rw-r--r--\ta0\n'
+        '7\t[Saved][ ]       [-L-][  10%][ ]  -rw-r--r--\tb/z\n'
+        '\t[--- REMOVED ENTRY ----][        ]  -rw-r--r--\tb/gone\n')
+
+    def setUp(self):
+        super().setUp()
+        self.settings.data_discs = 2
+        self.settings.parity_discs = 1
+        self.settings.slices_per_disc = 2
+        self.d = Darbrrb(self.settings, __file__)
+
+    # two sets of three discs; slices alternate between the data discs
+    def back_up(self, catalog):
+        backup_id = catalog.begin_backup('photos', ['darbrrb.py', 'dar'], {})
+        for n in range(1, 9):
+            catalog.record_slice(backup_id, 'photos', n, 100, None)
+        for set_zb in range(2):
+            for disc_zb in range(3):
+                catalog.record_disc(
+                    backup_id, self.d.disc_title('photos', set_zb, disc_zb),
+                    set_zb, disc_zb, disc_zb == 2,
+                    [('photos', n) for n in range(1, 9)
+                     if self.d.geometry.place(n)[:2] == (set_zb, disc_zb)])
+        catalog.record_files(backup_id, 'photos',
+                             parse_slicing_listing(self.listing))
+        catalog.finish_backup(backup_id, 'full')
+        return backup_id
+
+    def testParseSlicingListing(self):
+        self.assertEqual(list(parse_slicing_listing(self.listing)),
+                         [('a', 1, 1), ('a/x', 1, 1), ('a/y', 2, 3),
+                          ('a0', 4, 4), ('b/z', 7, 7)])
+
+    def testDiscsNeeded(self):
+        with self.d.catalog() as catalog:
+            backup_id = self.back_up(catalog)
+            self.assertEqual(catalog.find_backup('a/x'), backup_id)
+            self.assertEqual(catalog.find_backup('/a/'), backup_id)
+            self.assertIsNone(catalog.find_backup('a/x', 'music'))
+            self.assertIsNone(catalog.find_backup('c'))
+            # a, not a0; and the last set, for dar's catalogue
+            self.assertEqual(catalog.discs_needed(backup_id, 'a'), {
+                'archives': ['photos'],
+                'data': ['photos-0001-001', 'photos-0001-002',
+                         'photos-0002-001', 'photos-0002-002'],
+                'parity': ['photos-0001-003', 'photos-0002-003']})
+            self.assertEqual(catalog.discs_needed(backup_id, 'b/z')['parity'],
+                             ['photos-0002-003'])
+            self.assertIn('photos-0002-002', catalog_report(
+                catalog.backup(backup_id), 'b/z',
+                catalog.discs_needed(backup_id, 'b/z')))
+
+    def testExportSet(self):
+        exported = os.path.join(self.settings.scratch_dir, 'export.sqlite')
+        with self.d.catalog() as catalog:
+            backup_id = self.back_up(catalog)
+            catalog.export(backup_id, exported, 1)
+        with Catalog(exported) as catalog:
+            self.assertEqual(catalog.latest_backup('photos'), backup_id)
+            self.assertEqual(catalog.db.execute(
+                'SELECT title FROM discs ORDER BY title').fetchall(),
+                [('photos-0002-001',), ('photos-0002-002',),
+                 ('photos-0002-003',)])
+            self.assertEqual(catalog.db.execute(
+                'SELECT number FROM slices ORDER BY number').fetchall(),
+                [(5,), (6,), (7,), (8,)])
+            self.assertEqual(catalog.db.execute(
+                'SELECT count(*) FROM files').fetchone(), (0,))
+
+    def testExport(self):
+        exported = os.path.join(self.settings.scratch_dir, 'export.sqlite')
+        with self.d.catalog() as catalog:
+            self.back_up(catalog)
+            backup_id = self.back_up(catalog)
+            catalog.export(backup_id, exported)
+        with Catalog(exported) as catalog:
+            self.assertEqual(catalog.latest_backup('photos'), backup_id)
+            self.assertEqual(catalog.db.execute(
+                'SELECT count(*) FROM backups').fetchone(), (1,))
+            self.assertEqual(catalog.db.execute(
+                'SELECT count(*) FROM files').fetchone(), (5,))
+
+    @patch('subprocess.check_output')
+    def testFinish(self, check_output):
+        check_output.return_value = self.listing.encode('UTF-8')
+        self.d.ensure_scratch()
+        with self.d.catalog() as catalog:
+            backup_id = self.d._catalog_backup_id(catalog, 'photos')
+        self.d.finish_catalog('photos', 'incremental',
+                              [('photos_002', '/state/photos_002_catalogue')])
+        check_output.assert_called_once_with(
+            ['dar', '-l', '/state/photos_002_catalogue', '-Tslicing', '-Q'])
+        with self.d.catalog() as catalog:
+            self.assertEqual(catalog.find_backup('a/y', 'photos'), backup_id)
+            self.assertEqual(catalog.backup(backup_id)['kind'],
+                             'incremental')
+        self.assertFalse(os.path.exists(os.path.join(
+            self.settings.scratch_dir, 'catalog_backup.txt')))
+
+class TestProgress(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.settings.expected_data_size_GiB = 1.0
+        self.settings.data_discs = 2
+        self.settings.parity_discs = 1
+        self.settings.slices_per_disc = 4
+        self.settings.disc_size_MiB = 100
+        self.d = Darbrrb(self.settings, __file__)
+
+    @patch('time.time')
+    def testProjection(self, time_):
+        self.d._record_compression_ratio('thing', 'full', 0.5)
+        time_.return_value = 1000.0
+        self.d._save_progress(self.d._progress())
+        time_.return_value = 1100.0
+        progress = self.d.update_progress('backup', 'thing', slices_done=1,
+                                          bytes_archived=64 * 1048576)
+        self.assertEqual(progress['compression_ratio'], 0.5)
+        # 512 MiB to archive in slices of a bit under 23 MiB: 23 slices,
+        # three sets of three discs
+        self.assertEqual(progress['projected_remaining_discs'], 9)
+        # 64 MiB in 100 seconds, 448 MiB to go
+        self.assertEqual(progress['eta_seconds'], 700)
+        progress = self.d.update_progress('backup', 'thing', discs_burned=3,
+                                          sets_burned=1)
+        self.assertEqual(progress['projected_remaining_discs'], 6)
+
+    def testChainMembers(self):
+        with open(os.path.join(self.settings.scratch_dir, 'chain.json'),
+                  'wt') as f:
+            json.dump([{'basename': 'thing', 'kind': 'full'},
+                       {'basename': 'thing_002', 'kind': 'incremental'}], f)
+        self.d._record_compression_ratio('thing', 'full', 0.5)
+        progress = self.d.update_progress('backup', 'thing_002',
+                                          slices_done=1,
+                                          bytes_archived=1048576)
+        # a full backup's ratio is no guess for an incremental
+        self.assertIsNone(progress['compression_ratio'])
+        self.d.update_progress('backup', 'thing_002', finished=True)
+        with open(os.path.join(self.settings.scratch_dir, 'chain.json'),
+                  'wt') as f:
+            json.dump([{'basename': 'thing', 'kind': 'full'},
+                       {'basename': 'thing_002', 'kind': 'incremental'},
+                       {'basename': 'thing_003', 'kind': 'incremental'}], f)
+        self.d.update_progress('backup', 'thing_003', slices_done=1,
+                               bytes_archived=2097152, finished=True)
+        # one entry for the chain, whatever its members are called; 3 MiB
+        # archived of 1 GiB
+        self.assertEqual(self.d._compression_ratios(), {'thing': {
+            'full': 0.5, 'incremental': 3 / 1024}})
+
+    def testNoPreviousRatio(self):
+        progress = self.d.update_progress('backup', 'thing', slices_done=1,
+                                          bytes_archived=1048576)
+        self.assertIsNone(progress['compression_ratio'])
+        # 1 GiB before compression: 46 slices, six sets
+        self.assertEqual(progress['projected_remaining_discs'], 18)
+
+    def testTextfile(self):
+        text = progress_textfile({'mode': 'restore', 'basename': 'x',
+                                  'groups_repaired': 3, 'updated': 12.5})
+        self.assertEqual(text.splitlines(), [
+            '# HELP darbrrb_groups_repaired Parity groups checked and '
+            'repaired by parchive.',
+            '# TYPE darbrrb_groups_repaired gauge',
+            'darbrrb_groups_repaired{mode="restore",basename="x"} 3',
+            '# HELP darbrrb_progress_updated_timestamp_seconds When progress '
+            'was last made.',
+            '# TYPE darbrrb_progress_updated_timestamp_seconds gauge',
+            'darbrrb_progress_updated_timestamp_seconds'
+            '{mode="restore",basename="x"} 12.5'])
+
+class TestMedia(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.settings.data_discs = 2
+        self.settings.parity_discs = 1
+        self.settings.slices_per_disc = 2
+        self.settings.digits = 4
+        self.d = Darbrrb(self.settings, __file__)
+
+    def testDirectoryLastSet(self):
+        self.settings.actually_burn = False
+        self.mkdirp(*[os.path.join(self.settings.scratch_dir, t) for t in
+                      ('thing-0001-001', 'thing-0002-001', 'thing-0002-002',
+                       'thing_002-0003-001', '__disc0001')])
+        self.assertIsInstance(self.d.media, DirectoryMedia)
+        self.assertEqual(self.d.last_set_directory('thing', 1),
+                         os.path.join(self.settings.scratch_dir,
+                                      'thing-0002-002'))
+        self.assertEqual(self.d.written_disc_directory('thing-0001-001'),
+                         os.path.join(self.settings.scratch_dir,
+                                      'thing-0001-001'))
+        self.assertEqual(self.d.media.loads,
+                         ['thing-0002-002', 'thing-0001-001'])
+        with self.assertRaises(NoSuchDisc):
+            self.d.last_set_directory('other', 0)
+
+    def testPrompt(self):
+        with patch.object(Darbrrb, '_ask', return_value='/media/cdrom'):
+            self.assertEqual(self.d.written_disc_directory('thing-0001-001'),
+                             '/media/cdrom')
+            self.assertIn('thing-0001-001', self.d._ask.call_args[0][0])
+
+    def testNothingLoaded(self):
+        for backend in ('prompt', 'directory', 'iso'):
+            with self.assertRaises(NoDiscLoaded):
+                media_backends[backend](self.d).mount_path()
+        with self.assertRaises(NoDiscLoaded):
+            IsoMedia(self.d).files(None)
+        with self.assertRaises(TypeError):
+            Media(self.d)
+
+    def testNoBlankImages(self):
+        self.settings.media_backend = 'iso'
+        with self.assertRaises(NoBlankDiscs):
+            self.d.wait_for_empty_disc()
+
+    @patch.object(Darbrrb, '_run')
+    def testChanger(self, _run):
+        self.settings.media_backend = 'changer'
+        self.settings.media_changer_command = 'changer --slot-base 5'
+        def run(*args, output=False):
+            if output:
+                return {'inventory': b'thing-0001-001\nthing-0001-002\n'
+                                     b'thing-0001-003\n',
+                        'mount-path': b'/mnt/changer\n'}[args[-1]]
+        _run.side_effect = run
+        self.assertEqual(self.d.last_set_directory('thing', 2),
+                         '/mnt/changer')
+        changer = ('changer', '--slot-base', '5')
+        self.assertEqual(_run.call_args_list, [
+            call(*changer, 'inventory', output=True),
+            call(*changer, 'load', 'thing-0001-003'),
+            call(*changer, 'mount-path', output=True)])
+
+    @patch.object(Darbrrb, '_run')
+    def testChangerBurnsUnattended(self, _run):
+        self.settings.media_backend = 'changer'
+        self.settings.media_changer_command = 'changer'
+        self.settings.burner_device = '/dev/zero'
+        with patch.object(Darbrrb, 'scratch_free_MiB', return_value=100000):
+            self.d.ensure_scratch()
+        with working_directory(self.settings.scratch_dir):
+            self.touch_dar_files('thing', 1, 1)
+            self.touch_par_files('thing', 1, 1, 1)
+            self.d._create('dir', 'thing', '1', 'dar', 'last_slice')
+        commands = [c[0][:2] for c in _run.call_args_list]
+        self.assertEqual(commands[1:], [
+            ('changer', 'load-blank'), ('growisofs', '-Z'),
+            ('changer', 'eject')] * 3)
+
+@patch('time.sleep')
+@patch.object(Darbrrb, '_ask', side_effect=AssertionError('asked'))
+class TestUnattended(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.settings.unattended = True
+        self.settings.alert_command = 'alert --to root'
+        self.d = Darbrrb(self.settings, __file__)
+
+    def failure(self, code):
+        return subprocess.CalledProcessError(code, 'x')
+
+    @patch.object(Darbrrb, '_check_call')
+    def testTransientFailure(self, check_call, _ask, sleep):
+        check_call.side_effect = [self.failure(1), None]
+        self.d._run('growisofs', '-Z', '/dev/sr0')
+        self.assertEqual(check_call.call_count, 2)
+        sleep.assert_called_once_with(60)
+        retries = [span for span in read_timings(self.d._timings_filename())
+                   if span['phase'] == 'retry-wait']
+        self.assertEqual([(r['attempt'], r['exit_code']) for r in retries],
+                         [(1, 1)])
+
+    @patch('subprocess.call')
+    @patch.object(Darbrrb, '_check_call')
+    def testGivesUpAndAlerts(self, check_call, call_, _ask, sleep):
+        check_call.side_effect = self.failure(2)
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.d._run('mystery', 'x')
+        self.assertEqual(check_call.call_count, 3)
+        self.assertEqual(sleep.call_args_list, [call(10), call(20)])
+        args = call_.call_args[0][0]
+        self.assertEqual(args[:3], ['alert', '--to', 'root'])
+        self.assertIn("'mystery'", args[3])
+        self.assertIn('after 3 attempt(s)', args[3])
+
+    @patch.object(Darbrrb, '_check_output')
+    def testOutput(self, check_output, _ask, sleep):
+        check_output.side_effect = [self.failure(1), b'/mnt/changer\n']
+        self.assertEqual(self.d._run('changer', 'mount-path', output=True),
+                         b'/mnt/changer\n')
+        self.assertEqual(check_output.call_count, 2)
+        self.assertEqual(
+            [span['phase'] for span in read_timings(
+                self.d._timings_filename())].count('changer'), 2)
+
+    @patch('subprocess.call')
+    @patch.object(Darbrrb, '_check_call')
+    def testPermanentFailure(self, check_call, call_, _ask, sleep):
+        self.settings.retry_policies = dict(
+            self.settings.retry_policies,
+            parchive=dict(attempts=5, delay_seconds=1, backoff=1,
+                          transient_exit_codes=[3]))
+        check_call.side_effect = self.failure(1)
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.d._run('parchive', 'r', 'x.par')
+        self.assertEqual(check_call.call_count, 1)
+        self.assertFalse(sleep.called)
+        self.assertTrue(call_.called)
+
+class TestScheduler(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.settings.cpu_slots = 2
+        self.d = Darbrrb(self.settings, __file__)
+        self.scheduler = self.d.scheduler()
+
+    def testLimits(self):
+        import asyncio
+        running = []
+        peak = []
+        def work():
+            running.append(1)
+            peak.append(len(running))
+            time.sleep(0.05)
+            running.pop()
+        async def job():
+            await self.scheduler.call(work, uses={'cpu': 1})
+        self.scheduler.run(*(job() for _ in range(6)))
+        self.assertEqual(len(peak), 6)
+        self.assertEqual(max(peak), 2)
+
+    def testTooMuch(self):
+        async def job():
+            async with self.scheduler.using(cpu=3):
+                pass
+        with self.assertRaises(ValueError):
+            self.scheduler.run(job())
+
+    def testTurns(self):
+        import asyncio
+        order = []
+        async def job(n):
+            # the later ones are ready first
+            await asyncio.sleep(0.01 * (3 - n))
+            async with self.scheduler.turn(n):
+                order.append(n)
+        self.scheduler.run(*(job(n) for n in range(4)))
+        self.assertEqual(order, [0, 1, 2, 3])
+
+    def testReturns(self):
+        async def job(n):
+            return await self.scheduler.call(lambda: n * 2, uses={'cpu': 1})
+        self.assertEqual(self.scheduler.run(*(job(n) for n in range(3))),
+                         [0, 2, 4])
+
+    def testFailureKillsTheRest(self):
+        async def sleeps():
+            await self.scheduler.call(self.d._check_call, ['sleep', '30'])
+        async def fails():
+            await self.scheduler.call(time.sleep, 0.2)
+            raise WrongBackup('no')
+        began = time.monotonic()
+        with self.assertRaises(WrongBackup):
+            self.scheduler.run(sleeps(), fails())
+        self.assertLess(time.monotonic() - began, 10)
+        self.assertFalse(self.d._children)
+        # and what's run after that isn't cancelled
+        self.d._check_call(['true'])
+        self.assertEqual(self.d._check_output(['echo', 'x']), b'x\n')
+
+    # attended, failed commands being run at once are asked about in turn
+    @patch('builtins.input', return_value='y')
+    def testOnePromptAtATime(self, input_):
+        asking = []
+        overlapped = []
+        def ask(prompt):
+            asking.append(prompt)
+            if len(asking) > 1:
+                overlapped.append(list(asking))
+            time.sleep(0.05)
+            asking.remove(prompt)
+            return 'y'
+        input_.side_effect = ask
+        failed = set()
+        def check_call(args):
+            if args[1] not in failed:
+                failed.add(args[1])
+                raise subprocess.CalledProcessError(1, args)
+        async def job(n):
+            await self.scheduler.call(self.d._run, 'parchive', str(n),
+                                      uses={'cpu': 1})
+        with patch.object(self.d, '_check_call', side_effect=check_call):
+            self.scheduler.run(*(job(n) for n in range(4)))
+        self.assertEqual(input_.call_count, 4)
+        self.assertEqual(overlapped, [])
+
+    # nor, once they are being cancelled, asked about at all
+    @patch('builtins.input', return_value='n')
+    def testNoPromptOnceCancelling(self, input_):
+        def check_call(args):
+            time.sleep(0.05 * int(args[1]))
+            raise subprocess.CalledProcessError(1, args)
+        async def job(n):
+            await self.scheduler.call(self.d._run, 'parchive', str(n),
+                                      uses={'cpu': 1})
+        with patch.object(self.d, '_check_call', side_effect=check_call):
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.scheduler.run(job(1), job(2))
+        self.assertEqual(input_.call_count, 1)
+
+    def testFailureIsRaisedOnce(self):
+        ran = []
+        async def fails(n):
+            await self.scheduler.call(time.sleep, 0.05 * n, uses={'cpu': 1})
+            ran.append(n)
+            raise WrongBackup(n)
+        async def waits():
+            async with self.scheduler.using(cpu=2):
+                ran.append('waits')
+        with self.assertRaises(WrongBackup) as raised:
+            self.scheduler.run(fails(1), fails(5), waits())
+        self.assertEqual(raised.exception.args, (1,))
+        self.assertNotIn('waits', ran)
+
+class TestSharedLog(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.filename = os.path.join(self.settings.scratch_dir, 'darbrrb.log')
+        self.logger = logging.getLogger('test shared log')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        super().tearDown()
+
+    def handler(self, max_bytes=1048576, keep=20, context=None):
+        handler = SharedLogHandler(self.filename, max_bytes, keep, context)
+        self.logger.addHandler(handler)
+        return handler
+
+    def testSpanIdentifiers(self):
+        d = Darbrrb(self.settings, __file__)
+        self.handler(context=d.span_context)
+        self.logger.info('before')
+        with d.timed('create', slice_ob=14):
+            with d.timed('burn', set_zb=0, disc_zb=2):
+                self.logger.info('burning')
+        records = list(read_log(self.filename))
+        self.assertEqual([r['message'] for r in records],
+                         ['before', 'burning'])
+        self.assertNotIn('phase', records[0])
+        self.assertEqual(
+            (records[1]['phase'], records[1]['slice_ob'],
+             records[1]['disc_zb']), ('burn', 14, 2))
+        self.assertEqual(
+            [r['message'] for r in filter_log(records, {'slice_ob': '14'})],
+            ['burning'])
+        self.assertIn('(burn slice_ob=14 set_zb=0 disc_zb=2): burning',
+                      format_log_record(records[1]))
+
+    def testBeforeScratchExists(self):
+        self.filename = os.path.join(self.settings.scratch_dir, 'later',
+                                     'darbrrb.log')
+        self.handler()
+        self.logger.info('early')
+        os.mkdir(os.path.dirname(self.filename))
+        self.logger.info('late')
+        self.assertEqual([r['message'] for r in read_log(self.filename)],
+                         ['early', 'late'])
+
+    def testRotation(self):
+        self.handler(max_bytes=2000, keep=3)
+        for i in range(100):
+            self.logger.info('message %d', i)
+        self.assertEqual(len(rotated_logs(self.filename)), 3)
+        messages = [r['message'] for r in read_log(self.filename)]
+        self.assertEqual(messages, ['message {}'.format(i) for i in
+                                    range(100 - len(messages), 100)])
+
+    # as when dar runs a darbrrb per slice while the one that ran dar logs
+    def testSeveralProcesses(self):
+        self.handler(max_bytes=20000, keep=1000)
+        children = []
+        for child in range(4):
+            pid = os.fork()
+            if pid == 0:
+                for i in range(300):
+                    self.logger.info('child %d message %d', child, i)
+                os._exit(0)
+            children.append(pid)
+        for pid in children:
+            os.waitpid(pid, 0)
+        self.assertGreater(len(rotated_logs(self.filename)), 1)
+        messages = [r['message'] for r in read_log(self.filename)]
+        self.assertEqual(sorted(messages), sorted(
+            'child {} message {}'.format(c, i)
+            for c in range(4) for i in range(300)))
+
+class TestIsoImage(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.dir = os.path.join(self.settings.scratch_dir, 'disc')
+        os.mkdir(self.dir)
+        self.contents = {
+            'thing.0001.dar': os.urandom(5000),
+            'thing.0001-0002.p01': os.urandom(2048),
+            'thing.0001-0002.par': os.urandom(10),
+            'README.txt': b'',
+        }
+        for name, data in self.contents.items():
+            with open(os.path.join(self.dir, name), 'wb') as f:
+                f.write(data)
+        self.image = os.path.join(self.settings.scratch_dir, 'disc.iso')
+        write_iso_image(self.image, 'thing-0001-001', self.dir)
+        with open(self.image, 'rb') as f:
+            self.data = f.read()
+
+    def testVolumeDescriptors(self):
+        pvd = self.data[16 * iso_sector:17 * iso_sector]
+        self.assertEqual(pvd[:6], b'\x01CD001')
+        self.assertEqual(pvd[40:72].rstrip(), b'thing-0001-001')
+        self.assertEqual(struct.unpack('<I', pvd[80:84])[0] * iso_sector,
+                         len(self.data))
+        svd = self.data[17 * iso_sector:18 * iso_sector]
+        self.assertEqual(svd[:6], b'\x02CD001')
+        self.assertEqual(svd[88:91], b'%/E')
+        self.assertEqual(self.data[18 * iso_sector:18 * iso_sector + 6],
+                         b'\xffCD001')
+
+    def testFilesOnSectorBoundaries(self):
+        for name, data in self.contents.items():
+            if data:
+                self.assertEqual(self.data.find(data) % iso_sector, 0, name)
+            # Rock Ridge and Joliet names
+            self.assertIn(b'NM' + bytes([5 + len(name), 1, 0]) +
+                          name.encode(), self.data)
+            self.assertIn(name.encode('UTF-16-BE'), self.data)
+        self.assertEqual(len(self.data), (24 + 1 + 1 + 3 + 1 + 1) *
+                         iso_sector)
+
+    def testRead(self):
+        with IsoImage(self.image) as image:
+            self.assertEqual(image.volume_id, 'thing-0001-001')
+            self.assertEqual(image.names(), sorted(self.contents))
+            for name, data in self.contents.items():
+                with image.view(name) as view:
+                    self.assertEqual(bytes(view), data)
+
+    def testReadJoliet(self):
+        with patch(__name__ + '._rock_ridge', return_value=b''):
+            write_iso_image(self.image, 'thing-0001-001', self.dir)
+        with IsoImage(self.image) as image:
+            self.assertEqual(image.names(), sorted(self.contents))
+            with image.view('thing.0001.dar') as view:
+                self.assertEqual(bytes(view),
+                                 self.contents['thing.0001.dar'])
+
+    def testCutShort(self):
+        os.truncate(self.image, 30 * iso_sector)
+        with IsoImage(self.image) as image:
+            with self.assertRaises(OSError):
+                image.view('thing.0001.dar')
+
+    def testLevel2Names(self):
+        self.assertEqual(_iso_names(['thing.0001-0002.p01', 'a-b', 'a_b']),
+                         {'thing.0001-0002.p01': 'THING_0001_0002.P01;1',
+                          'a-b': 'A_B.;1', 'a_b': 'A_B1.;1'})
+
+class TestTimings(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.d = Darbrrb(self.settings, __file__)
+
+    def testNestedSpansCarryIdentifiers(self):
+        with self.d.timed('outer', set_zb=3):
+            with self.d.timed('inner', disc_zb=1) as extra:
+                extra['bytes'] = 10
+        inner, outer = read_timings(self.d._timings_filename())
+        self.assertEqual((inner['phase'], inner['set_zb'], inner['disc_zb'],
+                          inner['bytes']), ('inner', 3, 1, 10))
+        self.assertEqual(outer['phase'], 'outer')
+        self.assertNotIn('disc_zb', outer)
+        self.assertGreaterEqual(outer['seconds'], inner['seconds'])
+
+    def testSpanRecordedOnException(self):
+        with self.assertRaises(ZeroDivisionError):
+            with self.d.timed('failing'):
+                1/0
+        self.assertEqual([s['phase'] for s in
+                          read_timings(self.d._timings_filename())],
+                         ['failing'])
+
+    def testSummary(self):
+        spans = [
+            dict(phase='copy', seconds=2.0, bytes=4*1048576, device='11:0'),
+            dict(phase='copy', seconds=2.0, bytes=4*1048576, device='11:0'),
+            dict(phase='prompt', seconds=30.0),
+        ]
+        summary = summarize_timings(spans).splitlines()
+        self.assertTrue(summary[1].startswith('prompt'))
+        self.assertEqual(summary[2].split()[:3], ['copy', '2', '4.000'])
+        self.assertEqual(summary[-1].split(), ['11:0', 'copy', '8.0', '2.0'])
+
+    def testSummaryOfWhatRanAlongside(self):
+        spans = [
+            dict(phase='master', seconds=1.0, bytes=8*1048576, device='0:40',
+                 alongside=None),
+            dict(phase='master', seconds=4.0, bytes=8*1048576, device='0:40',
+                 alongside='burn'),
+        ]
+        summary = summarize_timings(spans).splitlines()
+        self.assertEqual(summary[-2].split(), ['0:40', 'master', '8.0', '8.0'])
+        self.assertEqual(summary[-1].split(),
+                         ['0:40', 'master+burn', '8.0', '2.0'])
+
+class TestProfiles(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.d = Darbrrb(self.settings, __file__, [('-p', '')])
+
+    def profiles(self):
+        return glob.glob(os.path.join(self.d._profiles_dir(), '*.prof'))
+
+    def testEachRunProfilesItself(self):
+        def hot_spot():
+            return sum(i * i for i in range(20000))
+        for hook in ('_create', '_create', '_extract'):
+            with self.d.profiled(hook):
+                hot_spot()
+        self.assertEqual(len(self.profiles()), 3)
+        # the darbrrbs dar runs are told to profile too
+        self.assertIn('-p', self.d._progargs())
+        summary = summarize_profiles(self.profiles()).splitlines()
+        self.assertTrue(summary[0].startswith('_create: 2 run(s), '))
+        self.assertEqual(summary[1].split()[:2], ['own', 's'])
+        create = summary[:summary.index('')]
+        self.assertTrue(summary[len(create) + 1].startswith(
+            '_extract: 1 run(s), '))
+        hot = [l for l in create if l.endswith('(hot_spot)')]
+        self.assertEqual(len(hot), 1)
+        self.assertEqual(hot[0].split()[2], '2')
+
+    def testCount(self):
+        with self.d.profiled('_create'):
+            sorted(range(100))
+        summary = summarize_profiles(self.profiles(), 1).splitlines()
+        self.assertEqual(len(summary), 3)
+
+    def testNotWithoutTheSwitch(self):
+        d = Darbrrb(self.settings, __file__, [('-v', '')])
+        with d.profiled('_create'):
+            pass
+        self.assertEqual(self.profiles(), [])
+
+    def testCleared(self):
+        with self.d.profiled('_create'):
+            pass
+        self.d.clear_profiles()
+        self.assertEqual(self.profiles(), [])
+
+    def testInMemory(self):
+        fs = MemoryFilesystem()
+        fs.makedirs('/scratch')
+        s = Settings()
+        s.scratch_dir = '/scratch'
+        d = Darbrrb(s, __file__, [('-p', '')], fs=fs)
+        with d.profiled('_extract'):
+            pass
+        self.assertEqual(len(fs.listdir('/scratch/profiles')), 1)
+
+class TestMemoryFilesystem(unittest.TestCase):
+    def setUp(self):
+        self.fs = MemoryFilesystem(capacity_bytes=10 * 1048576)
+        self.fs.makedirs('/scratch/__disc0001')
+        self.fs.cwd = '/scratch'
+
+    def testSizesAndFreeSpace(self):
+        self.fs.make_file('a.001.dar', 3 * 1048576)
+        with self.fs.open('README.txt', 'wt') as f:
+            f.write('hello\n')
+        self.assertEqual(self.fs.getsize('/scratch/a.001.dar'), 3 * 1048576)
+        self.assertEqual(self.fs.getsize('README.txt'), 6)
+        self.assertEqual(self.fs.free_bytes('/scratch'),
+                         7 * 1048576 - 6)
+        self.fs.move('a.001.dar', '__disc0001')
+        self.assertEqual(self.fs.free_bytes('/'), 7 * 1048576 - 6)
+        self.assertEqual(self.fs.listdir('__disc0001'), ['a.001.dar'])
+        with self.assertRaises(OSError) as cm:
+            self.fs.make_file('b.001.dar', 8 * 1048576)
+        self.assertEqual(cm.exception.errno, errno.ENOSPC)
+        self.fs.rmtree('__disc0001')
+        self.assertEqual(self.fs.free_bytes('/'), 10 * 1048576 - 6)
+        self.assertEqual(self.fs.high_water_bytes, 3 * 1048576 + 6)
+
+    def testGlob(self):
+        for name in ('a[1].001.dar', 'a[1].002.dar', 'b.001.dar',
+                     '.hidden.dar'):
+            self.fs.make_file(name, 1)
+        self.fs.make_file('__disc0001/a[1].003.dar', 1)
+        self.assertEqual(sorted(self.fs.glob(glob.escape('a[1]') +
+                                             '.*.dar')),
+                         ['a[1].001.dar', 'a[1].002.dar'])
+        self.assertEqual(self.fs.glob('/scratch/__disc*/*.dar'),
+                         ['/scratch/__disc0001/a[1].003.dar'])
+        self.assertEqual(self.fs.glob('/nowhere/*'), [])
+
+    def testFilesAndErrors(self):
+        with self.fs.open('x.json', 'wt') as f:
+            json.dump({'a': 1}, f)
+        self.fs.append('x.json', b' ')
+        with self.fs.open('x.json') as f:
+            self.assertEqual(json.load(f), {'a': 1})
+        self.fs.copyfile('x.json', 'y.json')
+        self.fs.append('x.json', b' ')
+        self.assertEqual(self.fs.getsize('y.json'),
+                         self.fs.getsize('x.json') - 1)
+        self.fs.replace('y.json', 'x.json')
+        self.assertFalse(self.fs.exists('y.json'))
+        with self.assertRaises(FileNotFoundError):
+            self.fs.open('y.json')
+        with self.assertRaises(FileNotFoundError):
+            self.fs.unlink('y.json')
+        with self.assertRaises(FileExistsError):
+            self.fs.mkdir('__disc0001')
+        with self.assertRaises(FileNotFoundError):
+            self.fs.listdir('__disc0002')
+
+    def testChecksumOfFileWithoutContents(self):
+        self.fs.make_file('a', 3 * 1048576)
+        self.fs.make_file('b', 3 * 1048576)
+        self.fs.make_file('c', 3 * 1048576 + 1)
+        self.assertEqual(self.fs.sha256('a'), self.fs.sha256('b'))
+        self.assertNotEqual(self.fs.sha256('a'), self.fs.sha256('c'))
+        self.assertEqual(self.fs.sha256('a')[0], 3 * 1048576)
+
+    def testCatalog(self):
+        with Catalog('/catalog.sqlite', self.fs) as catalog:
+            backup_id = catalog.begin_backup('b', [], {})
+            catalog.record_slice(backup_id, 'b', 1, 10, None)
+            catalog.export(backup_id, 'exported.sqlite')
+        self.assertGreater(self.fs.getsize('exported.sqlite'), 0)
+        with Catalog('exported.sqlite', self.fs) as catalog:
+            self.assertEqual(catalog.db.execute(
+                'SELECT number FROM slices').fetchall(), [(1,)])
+        self.fs.unlink('exported.sqlite')
+        with Catalog('exported.sqlite', self.fs) as catalog:
+            self.assertEqual(catalog.db.execute(
+                'SELECT number FROM slices').fetchall(), [])
+
+# A whole backup and restore, with everything in memory; see also
+# bench/simulate.py.
+# A whole backup and restore, on a MemoryFilesystem, with parchive stood in
+# for by making the files it would make.
+class SimulatesBackup(unittest.TestCase):
+    data_discs = 3
+    parity_discs = 2
+
+    def simulate(self, slices_per_disc, sets):
+        self.fs = MemoryFilesystem()
+        self.fs.makedirs('/library')
+        s = self.settings = Settings()
+        s.scratch_dir = '/scratch'
+        s.state_dir = '/state'
+        s.media_directory = '/library'
+        s.actually_burn = False
+        s.data_discs = self.data_discs
+        s.parity_discs = self.parity_discs
+        s.slices_per_disc = slices_per_disc
+        s.disc_size_MiB = 2400
+        s.digits = 4
+        self.d = Darbrrb(s, __file__, fs=self.fs)
+        self.slices = int(self.d.geometry.slices_per_set * sets)
+        self.d._run = Mock(side_effect=self.mock__run)
+
+    def mock__run(self, *args):
+        self.assertEqual(args[0], 'parchive')
+        if args[1] == 'r':
+            return
+        parfilename = args[3]
+        self.fs.make_file(parfilename, 96 + 120 * len(args[4:]))
+        for i in range(int(args[1][len('-n'):])):
+            self.fs.make_file('{}p{:02d}'.format(parfilename[:-3], i + 1),
+                              int(self.d.geometry.slice_size_KiB * 1024))
+
+    def back_up(self):
+        slice_bytes = int(self.d.geometry.slice_size_KiB * 1024)
+        self.d.ensure_scratch()
+        self.fs.cwd = self.settings.scratch_dir
+        for n in range(1, self.slices + 1):
+            self.fs.make_file(self.d._slice_name('b', n, 'dar'), slice_bytes)
+            self.d._create('dir', 'b', str(n), 'dar',
+                           'last_slice' if n == self.slices else 'operating')
+
+    def restore(self):
+        self.settings.scratch_dir = '/restore'
+        self.d.ensure_scratch()
+        self.fs.cwd = self.settings.scratch_dir
+        self.d._extract('dir', 'b', '0', 'dar', 'init')
+        for n in range(1, self.slices + 1):
+            self.d._extract('dir', 'b', str(n), 'dar', 'operating')
+
+class TestSimulatedBackup(SimulatesBackup):
+    def setUp(self):
+        self.simulate(slices_per_disc=50, sets=2.5)
+
+    def testBackupAndRestore(self):
+        g = self.d.geometry
+        slice_bytes = int(g.slice_size_KiB * 1024)
+        self.back_up()
+        titles = sorted(self.fs.listdir('/library'))
+        self.assertEqual(len(titles), 3 * g.total_set_count)
+        for title in titles:
+            disc = os.path.join('/library', title)
+            self.assertLessEqual(sum(self.fs.getsize(os.path.join(disc, f))
+                                     for f in self.fs.listdir(disc)),
+                                 g.disc_size_KiB * 1024)
+        self.assertEqual(self.fs.glob('/scratch/*.dar'), [])
+        self.restore()
+        for n in range(1, self.slices + 1):
+            self.assertEqual(self.fs.getsize(self.d._slice_name('b', n,
+                                                                'dar')),
+                             slice_bytes)
+        self.assertEqual(self.d._progress()['slices_fetched'],
+                         self.slices - g.slices_per_group)
+
+    # with no last group kept, the last set is read first, all of it
+    def testRestoreElsewhere(self):
+        groups = math.ceil(self.slices / self.d.geometry.slices_per_group)
+        self.back_up()
+        self.fs.rmtree('/state/last_groups')
+        self.restore()
+        discs = len(self.fs.listdir('/library'))
+        loads = self.d.media.loads
+        self.assertEqual(len(loads), discs)
+        self.assertEqual(loads[0], 'b-0003-001')
+        progress = self.d._progress()
+        self.assertEqual(progress['discs_read'], discs)
+        self.assertEqual(progress['slices_fetched'], self.slices)
+        self.assertEqual(progress['groups_fetched'], groups)
+        self.assertEqual(progress['groups_repaired'], groups)
+
+# The backup measured how much there was to back up, and so numbered its
+# slices with fewer digits than this script, as it comes, would. The restore
+# is with the settings as they come.
+class TestRestoreWithDefaultSettings(SimulatesBackup):
+    def setUp(self):
+        self.simulate(slices_per_disc=10, sets=1.5)
+        self.settings.measure('expected_data_size_GiB', 0.1)
+        self.settings.digits = self.settings._calculate_digits()
+        self.assertEqual(self.settings.digits, 2)
+        self.back_up()
+        s = Settings()
+        for name in ('state_dir', 'media_directory', 'actually_burn',
+                     'data_discs', 'parity_discs', 'slices_per_disc',
+                     'disc_size_MiB'):
+            setattr(s, name, getattr(self.settings, name))
+        self.assertNotEqual(s.digits, 2)
+        self.settings = s
+        self.d = Darbrrb(s, __file__, fs=self.fs)
+        self.d._run = Mock(side_effect=self.mock__run)
+
+    def restore_with_recorded_digits(self):
+        self.settings.digits = self.d.recorded_digits('b')
+        self.assertEqual(self.settings.digits, 2)
+        self.restore()
+        for n in range(1, self.slices + 1):
+            self.assertTrue(self.fs.exists('b.{:02d}.dar'.format(n)))
+
+    def testFromCatalog(self):
+        self.assertEqual(self.d.recorded_digits('b'), 2)
+        # without asking for a disc
+        self.assertEqual(self.d.media.loads, [])
+        self.restore_with_recorded_digits()
+
+    def testFromDisc(self):
+        self.fs.unlink('/state/catalog.sqlite')
+        self.assertEqual(self.d.recorded_digits('b'), 2)
+        self.assertEqual(self.d.media.loads, ['b-0002-001'])
+        self.restore_with_recorded_digits()
+
+# How the work of a backup and a restore grows with the number of slices on
+# a disc and the number of sets: directory listings (and the names in them),
+# copies, moves and opens should grow as the slices do, no faster; parchive
+# should run once for each group, each way; and each disc should be asked
+# for a few times at most, however big the set.
+class TestComplexity(SimulatesBackup):
+    geometries = [(10, 1), (10, 3), (20, 1), (40, 1), (40, 3)]
+
+    def measure(self, slices_per_disc, sets):
+        self.simulate(slices_per_disc, sets)
+        g = self.d.geometry
+        groups = math.ceil(self.slices / g.slices_per_group)
+        with patch.object(self.d, 'wait_for_empty_disc',
+                          wraps=self.d.wait_for_empty_disc) as blanks:
+            self.back_up()
+        backup = dict(self.fs.counts)
+        discs = len(self.fs.listdir('/library'))
+        self.assertEqual(blanks.call_count, discs)
+        self.assertEqual(self.d._run.call_count, groups)
+        self.d._run.reset_mock()
+        self.fs.counts.clear()
+        self.restore()
+        restore = dict(self.fs.counts)
+        self.assertEqual(self.d._run.call_count, groups)
+        loads = self.d.media.loads
+        # the first disc of a set isn't ejected after reading which groups
+        # are in it, only to be asked for again
+        self.assertFalse([a for a, b in zip(loads, loads[1:]) if a == b])
+        # each disc once: the last set's last group was kept
+        self.assertEqual(len(loads), discs)
+        progress = self.d._progress()
+        self.assertEqual(progress['discs_read'], discs)
+        self.assertEqual(progress['groups_fetched'], groups)
+        self.assertEqual(progress['groups_repaired'], groups)
+        return ({name: count / self.slices for name, count in backup.items()},
+                {name: count / self.slices for name, count in restore.items()})
+
+    def testLinear(self):
+        per_slice = [self.measure(*geometry) for geometry in self.geometries]
+        for way in (0, 1):
+            smallest = per_slice[0][way]
+            for geometry, counts in zip(self.geometries[1:], per_slice[1:]):
+                for name in ('listdir', 'listed', 'copy', 'move', 'open'):
+                    with self.subTest(way=('backup', 'restore')[way],
+                                      geometry=geometry, name=name):
+                        self.assertLessEqual(counts[way].get(name, 0),
+                                             1.25 * smallest.get(name, 0))
+
+class TestGeometry(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.settings.data_discs = 4
+        self.settings.parity_discs = 2
+        self.settings.slices_per_disc = 7
+        self.settings.digits = 5
+        self.d = Darbrrb(self.settings, __file__)
+
+    def testMatchesSettings(self):
+        g = self.d.geometry
+        for name in ('total_set_count', 'slices_per_set', 'slice_size_KiB',
+                     'slice_size_MiB', 'disc_size_KiB', 'number_format',
+                     'scratch_free_needed_MiB'):
+            self.assertEqual(getattr(g, name), getattr(self.settings, name))
+
+    def testReadOnly(self):
+        with self.assertRaises(AttributeError):
+            self.d.geometry.data_discs = 9
+        with self.assertRaises(AttributeError):
+            self.d.geometry.something_else = 9
+
+    def testPlace(self):
+        g = self.d.geometry
+        self.assertEqual(g.place(1), (0, 0, 0))
+        self.assertEqual(g.place(4), (0, 3, 0))
+        self.assertEqual(g.place(5), (0, 0, 1))
+        self.assertEqual(g.place(28), (0, 3, 6))
+        self.assertEqual(g.place(29), (1, 0, 7))
+
+    def testPlaceWideGroups(self):
+        self.settings.group_slices_per_disc = 7
+        g = self.d.geometry
+        self.assertEqual(g.slices_per_group, 28)
+        self.assertEqual(g.place(5), (0, 0, 0))
+        self.assertEqual(g.place(28), (0, 3, 0))
+        self.assertEqual(g.place(29), (1, 0, 1))
+
+    def testGroupsMustFillDiscs(self):
+        self.settings.group_slices_per_disc = 2
+        with self.assertRaises(BadGeometry):
+            self.d.geometry
+
+    def testRemadeWhenSettingsChange(self):
+        self.assertEqual(self.d.geometry.slices_per_set, 28)
+        self.settings.slices_per_disc = 8
+        self.assertEqual(self.d.geometry.slices_per_set, 32)
+
+    def testSavedAndLoaded(self):
+        self.d.geometry.save(self.d._geometry_filename())
+        other = Darbrrb(Settings(), __file__)
+        other.settings.scratch_dir = self.settings.scratch_dir
+        other.load_geometry()
+        self.assertEqual(other.geometry.slices_per_set, 28)
+        self.assertEqual(other.geometry.number_format, '{:05}')
+
+    def testTooManySlices(self):
+        self.settings.slices_per_disc = self.settings.disc_size_KiB
+        with self.assertRaises(BadGeometry):
+            self.d.geometry
+
+
 class TestDiscTitle(unittest.TestCase):
     def setUp(self):
         self.settings = Settings()
@@ -974,6 +6143,7 @@ class TestWholeBackup(UsesTempScratchDir):
     data_discs = 4
     parity_discs = 1
     slices_per_disc = 5
+    group_slices_per_disc = 1
     pretend_free_space_MiB = (data_discs + parity_discs) * 25000
 
     def setUp(self):
@@ -982,6 +6152,7 @@ class TestWholeBackup(UsesTempScratchDir):
         self.settings.data_discs = self.data_discs
         self.settings.parity_discs = self.parity_discs
         self.settings.slices_per_disc = self.slices_per_disc
+        self.settings.group_slices_per_disc = self.group_slices_per_disc
         # all tests not written with a small disc size expect a large one.
         self.settings.disc_size_MiB = getattr(self, 'disc_size_MiB', 23841)
         self.settings.burner_device = '/dev/zero'
@@ -1060,12 +6231,10 @@ class TestWholeBackup(UsesTempScratchDir):
                         complete_redundancy_sets + \
                 sett.slices_per_disc * sett.data_discs // 2 + \
                 sett.data_discs // 2
-        # for each complete or partial (at end) set of {data_discs} dar files,
-        # we run parchive once
-        expected_pars_run = sett.slices_per_disc * \
-                        complete_redundancy_sets + \
-                sett.slices_per_disc // 2 + \
-                1
+        # for each complete or partial (at end) group of {slices_per_group}
+        # dar files, we run parchive once
+        expected_pars_run = math.ceil(self.dar_create_slices_count /
+                                      sett.slices_per_group)
         # --- run code
         self.d.dar('-c', bn, '-R', '/fnord')
         max_slice = self.dar_create_slices_count
@@ -1117,11 +6286,13 @@ class TestWholeBackup(UsesTempScratchDir):
                 if redundancy_set < complete_redundancy_sets:
                     # not the last set; should have not only some
                     # files, but a full complement of them
+                    groups_on_b = sett.slices_per_disc // \
+                            sett.group_slices_per_disc
                     if disc_in_set < sett.data_discs:
-                        self.assertEqual(len(par_files_on_b), sett.slices_per_disc)
+                        self.assertEqual(len(par_files_on_b), groups_on_b)
                         self.assertEqual(len(dars_on_b), sett.slices_per_disc)
                     else:
-                        self.assertEqual(len(par_files_on_b), sett.slices_per_disc)
+                        self.assertEqual(len(par_files_on_b), groups_on_b)
                         self.assertEqual(len(par_volumes_on_b), sett.slices_per_disc)
                 disc += 1
             
@@ -1143,6 +6314,99 @@ class TestWholeBackupNineteenPlusSeven(TestWholeBackup):
     slices_per_disc = 31
     pretend_free_space_MiB = (data_discs + parity_discs) * 25000
 
+# Parity groups five slices deep on each disc, so that each disc holds two
+# groups' worth of slices and par files.
+class TestWholeBackupWideGroups(TestWholeBackup):
+    data_discs = 4
+    parity_discs = 2
+    slices_per_disc = 10
+    group_slices_per_disc = 5
+    pretend_free_space_MiB = (data_discs + parity_discs) * 25000
+
+# With an IMAGE_DIR, darbrrb masters the image of each disc, the next one
+# while growisofs burns this one, which it is given to write as it is.
+class TestWholeBackupMasteringAhead(TestWholeBackup):
+    def setUp(self):
+        super().setUp()
+        self.image_dir = os.path.join(self.settings.state_dir, 'images')
+        self.settings.image_dir = self.image_dir
+        # one image at a time, so the next is made while this one burns
+        self.settings.cpu_slots = 1
+        # and not before the one before it is burning, so that what each
+        # image was made alongside doesn't depend on how the threads happen
+        # to run
+        self.burning = []
+        self.burning_changed = threading.Condition()
+        master_image = Darbrrb._master_image
+        def gated_master_image(d, title, directory, image_dir):
+            disc_zb = int(title[-3:]) - 1
+            if disc_zb > 0:
+                before = title[:-3] + '{:03d}'.format(disc_zb)
+                with self.burning_changed:
+                    self.assertTrue(self.burning_changed.wait_for(
+                        lambda: before in self.burning, 30))
+            return master_image(d, title, directory, image_dir)
+        patcher = patch.object(Darbrrb, '_master_image', gated_master_image)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def mock_growisofs(self, *args):
+        self.assertEqual(args[-2], '-Z')
+        device, image = args[-1].split('=', 1)
+        with self.burning_changed:
+            self.burning.append(os.path.basename(image)[:-len('.iso')])
+            self.burning_changed.notify_all()
+        self.assertEqual(device, '/dev/zero')
+        self.assertEqual(os.path.dirname(image), self.image_dir)
+        with IsoImage(image) as iso:
+            self.discs_burned.append(iso.names())
+        # its directory is kept until it has burned
+        disc_zb = (len(self.discs_burned) - 1) % self.settings.total_set_count
+        self.assertEqual(sorted(os.listdir(self.d.disc_dir(disc_zb + 1))),
+                         self.discs_burned[-1])
+        if disc_zb + 1 < self.settings.total_set_count:
+            # the next image is under way; it'd never come if it were made
+            # only after this one burned
+            deadline = time.monotonic() + 30
+            while not os.path.exists(os.path.join(
+                    self.image_dir, os.path.basename(image)[:-len('001.iso')] +
+                    '{:03d}.iso'.format(disc_zb + 2))):
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+    def testImageDirTooSmall(self):
+        with patch.object(Darbrrb, 'scratch_free_MiB',
+                          return_value=self.pretend_free_space_MiB), \
+                patch.object(Darbrrb, 'image_free_MiB', return_value=math.ceil(
+                    self.d.geometry.disc_size_MiB)):
+            with self.assertRaises(NotEnoughScratchSpace) as cm:
+                self.d.ensure_free_space()
+        self.assertEqual(cm.exception.args[0], self.image_dir)
+
+    # after the backup began
+    @patch.object(Darbrrb, '_run')
+    @patch.object(Darbrrb, 'wait_for_empty_disc')
+    def testImageDirFilledUp(self, wfed, _run):
+        _run.side_effect = self.mock__run
+        self.dar_create_slices_count = self.d.geometry.slices_per_set
+        with patch.object(real_filesystem, 'free_bytes',
+                          return_value=1048576):
+            with self.assertRaises(NotEnoughScratchSpace) as cm:
+                self.d.dar('-c', 'whole', '-R', 'dir')
+        self.assertEqual(cm.exception.args[0], self.image_dir)
+        self.assertEqual(self.discs_burned, [])
+
+    def testWholeBackup(self):
+        super().testWholeBackup()
+        self.assertEqual(os.listdir(self.image_dir), [])
+        masters = [s for s in read_timings(self.d._timings_filename())
+                   if s['phase'] == 'master']
+        self.assertEqual(len(masters), len(self.discs_burned))
+        # the first of each set is made while nothing burns
+        self.assertEqual([m.get('alongside') for m in masters],
+                         [None if m['title'].endswith('-001') else 'burn'
+                          for m in masters])
+
 # Really small discs are useful for manual testing, where we want to
 # get an idea of how fast things will run or something, but don't want
 # to waste a lot of space or time doing so at scale.
@@ -1311,13 +6575,11 @@ class TestWholeRestore(UsesTempScratchDir):
         dir = 'dir'
         _run.side_effect = self.mock__run
         _copy.side_effect = shutil.copyfile
-        # we run parchive once to get the last slice. then,
-        #
         # for each complete or partial (at end) set of {data_discs} dar files,
-        # we run parchive once
+        # we run parchive once. The last one is run to get the last slice;
+        # the journal keeps it from being run again when dar gets there.
         sett = self.settings
-        expected_pars_run = (1 +
-                             (sett.slices_per_disc *
+        expected_pars_run = ((sett.slices_per_disc *
                               self.complete_redundancy_sets) +
                              (sett.slices_per_disc // 2 + 1))
         # --- run code
@@ -1340,10 +6602,91 @@ class TestWholeRestore(UsesTempScratchDir):
                           self.settings.data_discs),
                          'unexpected number of pars copied')
         self.assertEqual(len(calls_running('parchive')), expected_pars_run)
+        progress = self.d._progress()
+        self.assertEqual(progress['mode'], 'restore')
+        self.assertEqual(progress['groups_repaired'], expected_pars_run)
+        self.assertEqual(progress['groups_fetched'], expected_pars_run)
+        self.assertEqual(progress['slices_total'],
+                         self.dar_consume_slices_count)
         # not tested so far:
         # * only the files for one set are in the scratch dir at once
 
 
+
+class TestKeptLastGroups(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.settings.last_groups_kept = 2
+        self.d = Darbrrb(self.settings, __file__)
+
+    def kept(self):
+        return sorted(os.listdir(os.path.join(self.settings.state_dir,
+                                              'last_groups')))
+
+    def note(self, title_basename, archive):
+        os.makedirs(self.d._last_group_dir(archive), exist_ok=True)
+        self.d._note_last_group(title_basename, archive)
+
+    def testOnlyTheLastFewBackups(self):
+        self.note('daily_1', 'daily_1')
+        # a parallel backup's archives, and its archives.json, count as one
+        self.note('par', 'par_1')
+        self.note('par', 'par_2')
+        os.makedirs(self.d._last_group_dir('par'))
+        self.assertEqual(self.kept(), ['daily_1', 'kept.json', 'par', 'par_1',
+                                       'par_2'])
+        self.note('daily_2', 'daily_2')
+        self.assertEqual(self.kept(), ['daily_2', 'kept.json', 'par', 'par_1',
+                                       'par_2'])
+        # the same basename again is the most recent
+        self.note('par', 'par_1')
+        self.note('daily_3', 'daily_3')
+        self.assertEqual(self.kept(), ['daily_3', 'kept.json', 'par', 'par_1',
+                                       'par_2'])
+        self.assertEqual(self.d._kept_last_groups(),
+                         [['par', ['par_1', 'par_2']],
+                          ['daily_3', ['daily_3']]])
+
+# The last group kept in the state directory, as a backup would have kept
+# it: dar's catalogue comes from there, and the discs are asked for in order.
+class TestWholeRestoreFromKeptGroup(TestWholeRestore):
+    def setUp(self):
+        super().setUp()
+        last_set = self.complete_redundancy_sets
+        for disc_zb in range(self.settings.total_set_count):
+            title = self.d.disc_title(self.basename, last_set, disc_zb)
+            for f in os.listdir(title):
+                shutil.copyfile(os.path.join(title, f), os.path.join(
+                    self.d.disc_dir(disc_zb + 1), f))
+        catalog = Mock()
+        catalog.slice_sha256.return_value = _sha256_of(os.path.join(
+            self.d.disc_title(self.basename, 0, 0),
+            self.d._slice_name(self.basename, 1, 'dar')))[1]
+        self.d._cache_last_group(catalog, 1, self.basename, self.basename,
+                                 last_set)
+        for d in self.d.disc_dirs():
+            for f in glob.glob(os.path.join(d, '*')):
+                os.unlink(f)
+
+    def testWholeRestore(self):
+        sett = self.settings
+        expected_pars_run = ((sett.slices_per_disc *
+                              self.complete_redundancy_sets) +
+                             (sett.slices_per_disc // 2 + 1))
+        with patch.object(Darbrrb, '_run', side_effect=self.mock__run) as _run:
+            self.d.dar('-x', self.basename, '-R', '/fnord')
+        # set by set, from the first
+        sets_loaded = [t.rsplit('-', 2)[1] for t in self.d.media.loads]
+        self.assertEqual(sets_loaded[0], '0001')
+        self.assertEqual(sets_loaded, sorted(sets_loaded))
+        self.assertEqual(len([c for c in _run.call_args_list
+                              if c[0][0] == 'parchive']), expected_pars_run)
+        progress = self.d._progress()
+        self.assertEqual(progress['groups_repaired'], expected_pars_run)
+        self.assertEqual(progress['slices_total'],
+                         self.dar_consume_slices_count)
+        self.assertEqual(self.d._journal()['cached'], {})
+
 class TestWholeRestoreThreePlusEight(TestWholeRestore):
     data_discs = 3
     parity_discs = 8
@@ -1366,10 +6709,9 @@ class TestPartialRestore(TestWholeRestore):
         # slice. just some toward the end of the first set, and into
         # the second set.
         s = self.settings
-        # the first fetch will do 9% of the slices; make it fetch
-        # twice from the first set
+        # from near the end of the first set
         self.first_slice_dar_requests = int(s.slices_per_set * (1 - 0.14))
-        # and only once from the beginning of the second set
+        # to just past the beginning of the second
         self.last_slice_dar_requests = int(s.slices_per_set * (1 + 0.08))
 
     def mock_dar(self, *args):
@@ -1393,22 +6735,25 @@ class TestPartialRestore(TestWholeRestore):
     def testWholeRestore(self, _run):
         dir = 'dir'
         _run.side_effect = self.mock__run
-        # we run parchive once to get the last slice. then,
-        #
-        # for each complete or partial (at end) set of {data_discs} dar files,
-        # we run parchive once
-        sett = self.settings
-        fsdrzb = self.first_slice_dar_requests - 1
-        lsdrzb = self.last_slice_dar_requests - 1
-        first_slice_fetched_zb = fsdrzb - fsdrzb % sett.data_discs
-        # this simple math below only works because we are certainly
-        # not running into the last parity set; that set can be incomplete.
-        last_slice_fetched_zb = (lsdrzb - lsdrzb % sett.data_discs +
-                                 sett.data_discs - 1)
-        complete_parity_sets = (last_slice_fetched_zb + 1 - 
-                                first_slice_fetched_zb) // sett.data_discs
-        expected_pars_run = (1 + # for the last slice
-                             complete_parity_sets)
+        # we run parchive once for each group of the last set, which is
+        # fetched whole to get the last slice. then, for each set dar asks
+        # of, once for each group from the first asked of to the end of
+        # the set: every disc of a set is read at once.
+        g = self.d.geometry
+        total = self.dar_consume_slices_count
+        def groups(first_zb, last_zb):
+            return (last_zb // g.slices_per_group -
+                    first_zb // g.slices_per_group + 1)
+        last_set_first_zb = (total - 1) // g.slices_per_set * g.slices_per_set
+        expected_pars_run = groups(last_set_first_zb, total - 1)
+        for set_zb in range(
+                self.first_slice_dar_requests // g.slices_per_set,
+                self.last_slice_dar_requests // g.slices_per_set + 1):
+            set_first_zb = set_zb * g.slices_per_set
+            if set_first_zb < last_set_first_zb:
+                expected_pars_run += groups(
+                    max(self.first_slice_dar_requests, set_first_zb),
+                    set_first_zb + g.slices_per_set - 1)
         # --- run code
         self.d.dar('-x', self.basename, '-R', '/fnord', 'some-file')
         # --- assertions
@@ -1423,6 +6768,126 @@ class TestPartialRestore(TestWholeRestore):
         # not tested so far:
         # * only the files for one set are in the scratch dir at once
 
+# Media decay makes a slice unreadable halfway through copying it.
+class TestUnreadableSlice(TestWholeRestore):
+    # TestWholeRestore runs the whole restore; it needn't run again here
+    testWholeRestore = None
+
+    def testUnreadableSliceIsRepaired(self):
+        unreadable = self.d._slice_name(self.basename, 2, 'dar')
+        def copy(source, destination):
+            if os.path.basename(source) == unreadable:
+                with open(destination, 'wt') as f:
+                    f.write('half a sl')
+                raise OSError(5, 'Input/output error')
+            shutil.copyfile(source, destination)
+        with patch.object(Darbrrb, '_copy', side_effect=copy), \
+             patch.object(Darbrrb, '_run') as _run:
+            self.d._fetch_some_slices(self.basename, 0, 0)
+        self.assertFalse(os.path.exists(unreadable))
+        _run.assert_called_with('parchive', 'r', self.d._par_filename(
+            self.basename, 1, self.data_discs))
+
+# The restore dies partway through, and is run again.
+class TestResumedRestore(TestWholeRestore):
+    def testWholeRestore(self):
+        # one group repaired at a time, so which were is known
+        self.d.settings.cpu_slots = 1
+        def dies(*args):
+            if args[0] == 'parchive' and args[2] == self.d._par_filename(
+                    self.basename, 2 * self.data_discs + 1,
+                    3 * self.data_discs):
+                raise subprocess.CalledProcessError(1, args)
+            self.mock__run(*args)
+        with patch.object(Darbrrb, '_run', side_effect=dies), \
+             patch.object(Darbrrb, '_copy', side_effect=shutil.copyfile):
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.d.dar('-x', self.basename, '-R', '/fnord')
+        groups = self.d._journal_groups()
+        repaired = sorted(p for p, entry in groups.items()
+                          if entry['repaired'])
+        # the last set, for dar's catalogue, and the first set's first two;
+        # the one after the third may have started before the failure told
+        g = self.d.geometry
+        total = self.dar_consume_slices_count
+        last_set_first = (total - 1) // g.slices_per_set * g.slices_per_set
+        last_set = [self.d._par_filename(self.basename, a + 1,
+                                         min(a + g.slices_per_group, total))
+                    for a in range(last_set_first, total,
+                                   g.slices_per_group)]
+        first_two = [self.d._par_filename(self.basename, a + 1,
+                                          a + self.data_discs)
+                     for a in (0, self.data_discs)]
+        self.assertLessEqual(set(last_set + first_two), set(repaired))
+        self.assertNotIn(self.d._par_filename(
+            self.basename, 2 * self.data_discs + 1, 3 * self.data_discs),
+            repaired)
+        entry = groups[self.d._par_filename(
+            self.basename, 1, self.data_discs)]
+        first = self.d._slice_name(self.basename, 1, 'dar')
+        self.assertEqual(entry['files'][first][::2], list(_sha256_of(first)))
+        def run_again():
+            with patch.object(Darbrrb, '_run',
+                              side_effect=self.mock__run) as _run, \
+                 patch.object(Darbrrb, '_copy',
+                              side_effect=shutil.copyfile) as _copy:
+                self.d.dar('-x', self.basename, '-R', '/fnord')
+            return (set(os.path.basename(c[0][0])
+                        for c in _copy.call_args_list),
+                    [c[0][2] for c in _run.call_args_list
+                     if c[0][0] == 'parchive'])
+        copied, repairs = run_again()
+        # the first three groups were fetched already, and all but the third
+        # repaired
+        for n in range(1, 3 * self.data_discs + 1):
+            self.assertNotIn(self.d._slice_name(self.basename, n, 'dar'),
+                             copied)
+        self.assertEqual(repairs[0], self.d._par_filename(
+            self.basename, 2 * self.data_discs + 1, 3 * self.data_discs))
+        self.assertFalse(set(repaired) & set(repairs))
+        self.assertEqual(len(repairs), len(set(repairs)))
+        # a slice of a repaired group that has changed since is fetched again
+        second = self.d._slice_name(self.basename, 2, 'dar')
+        with open(second, 'wb') as f:
+            f.write(b'garbage')
+        copied, repairs = run_again()
+        self.assertEqual(sorted(f for f in copied if f.endswith('.dar')),
+                         [self.d._slice_name(self.basename, n, 'dar')
+                          for n in range(1, self.data_discs + 1)])
+        self.assertEqual(repairs, [self.d._par_filename(
+            self.basename, 1, self.data_discs)])
+        with open(second, 'rb') as f, open(os.path.join(
+                self.d.disc_title(self.basename, 0, 1), second), 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+# the discs are images: restore reads straight out of them
+class TestRestoreFromImages(TestWholeRestore):
+    def setUp(self):
+        super().setUp()
+        self.settings.iso_dir = os.path.join(self.settings.scratch_dir,
+                                             'images')
+        os.mkdir(self.settings.iso_dir)
+        for title in os.listdir(self.settings.scratch_dir):
+            if title.startswith(self.basename + '-'):
+                # name them differently from the titles: it's the volume id
+                # that counts
+                write_iso_image(os.path.join(self.settings.iso_dir,
+                                             'x' + title + '.iso'),
+                                title, title)
+                shutil.rmtree(title)
+
+    def testWholeRestore(self):
+        with patch.object(Darbrrb, '_run', side_effect=self.mock__run), \
+             patch.object(Darbrrb, '_copy') as _copy:
+            self.d.dar('-x', self.basename, '-R', '/fnord')
+        self.assertFalse(_copy.called)
+        self.assertIsInstance(self.d.media, IsoMedia)
+        progress = self.d._progress()
+        self.assertEqual(progress['slices_total'],
+                         self.dar_consume_slices_count)
+        self.assertEqual(len(glob.glob('*.dar')),
+                         self.dar_consume_slices_count)
+
 class TestPartialRestoreThreePlusEight(TestPartialRestore):
     data_discs = 3
     parity_discs = 8
@@ -1437,72 +6902,342 @@ class TestPartialRestoreNineteenPlusSeven(TestPartialRestore):
 
 
 
-if __name__ == '__main__':
-    s = Settings()
-    if len(sys.argv) < 2:
-        usage(s)
-        sys.exit(1)
-    opts, remaining = getopt.getopt(sys.argv[1:], 'hvnt', ['help'])
-    loglevel = logging.WARNING
-    testing = False
-    for o, v in opts:
-        if o == '-h' or o == '--help':
-            usage(s)
-            sys.exit(1)
-        elif o == '-v':
-            loglevel -= 10
-        elif o == '-n':
-            s.actually_burn = False
-            # warn user
-            from time import sleep
-            for i in range(25):
-                for j in range(4):
-                    print('not actually burning', end=' * ')
-                print('\n')
-            sleep(5)
-        elif o == '-t':
-            loglevel = logging.DEBUG
-            testing = True
-        else:
-            raise Exception('unknown switch {}'.format(o))
-    # style only influences how format is interpreted, not also how values are
-    # interpolated into log messages. source: Python 3.2
-    # logging/__init__.py:317, LogRecord class, getMessage method.
-    fmt = logging.Formatter(style='{', fmt='darbrrb {process} '
-                        '[{asctime}] {name}: {message}')
-    stream = logging.StreamHandler(sys.stderr)
-    stream.setFormatter(fmt)
-    root_logger = logging.getLogger()
-    root_logger.addHandler(stream)
-    root_logger.setLevel(loglevel)
-    # dar expects its stdin and stdout to be a terminal so we will
-    # make a log file for our messages rather than depend on
-    # redirection
-    logfile = logging.FileHandler('darbrrb.log.{}'.format(os.getpid()))
-    logfile.setFormatter(fmt)
-    root_logger.addHandler(logfile)
-    log = logging.getLogger('__main__'.format(os.getpid()))
-    log.debug('called with args %r', sys.argv)
-    if testing:
-        # strip off switches: they are not for unittest.main
-        sys.argv = [sys.argv[0]] + remaining
-        sys.exit(unittest.main())
-    d = Darbrrb(s, __file__, opts)
-    try:
-        if remaining[0] == 'dar':
-            os.environ['DARBRRB_ORIGINAL_ARGV'] = base64.b64encode(
-                pickle.dumps(sys.argv, protocol=0)).decode('UTF-8')
-            d.ensure_scratch()
-            d.dar(*remaining[1:])
-        elif remaining[0] == '_create':
-            d._create(*remaining[1:])
-        elif remaining[0] == '_extract':
-            d._extract(*remaining[1:])
-        elif remaining[0] == '_list':
-            d._list(*remaining[1:])
+class TestChain(UsesTempScratchDir):
+    def setUp(self):
+        super().setUp()
+        self.settings.data_discs = 2
+        self.settings.parity_discs = 1
+        self.d = Darbrrb(self.settings, __file__)
+        self.args = ('-c', 'photos', '-R', '/home/photos')
+
+    def back_up(self, kind, created, sets=1):
+        args, chain = self.d.start_chain_member(self.args, kind)
+        chain[-1]['created'] = created
+        with open(os.path.join(self.settings.scratch_dir,
+                               'sets_burned.txt'), 'wt') as f:
+            print(sets, file=f)
+        self.d.finish_chain_member('photos', chain)
+        return args
+
+    def testFullThenIncrementalThenDifferential(self):
+        args = self.back_up('full', '2026-01-01T00:00:00', sets=2)
+        catalogue = os.path.join(self.d._chain_dir('photos'),
+                                 'photos_catalogue')
+        self.assertEqual(args, ['-c', 'photos', '-R', '/home/photos',
+                                '-@', catalogue])
+        args = self.back_up('incremental', '2026-01-08T00:00:00')
+        self.assertEqual(args[:2], ['-c', 'photos_002'])
+        self.assertEqual(args[-2:], ['-A', catalogue])
+        args = self.back_up('incremental', '2026-01-15T00:00:00')
+        self.assertEqual(args[-2:], ['-A', catalogue.replace(
+            'photos_catalogue', 'photos_002_catalogue')])
+        args = self.back_up('differential', '2026-01-22T00:00:00')
+        self.assertEqual(args[:2], ['-c', 'photos_004'])
+        self.assertEqual(args[-2:], ['-A', catalogue])
+        chain = self.d.load_chain('photos')
+        self.assertEqual(len(chain[0]['discs']), 6)
+        self.assertEqual(chain[0]['discs'][-1], 'photos-0002-003')
+        def needed(when):
+            return [m['basename']
+                    for m in self.d.chain_for_restore(chain, when)]
+        self.assertEqual(needed('2026-01-16T00:00:00'),
+                         ['photos', 'photos_002', 'photos_003'])
+        self.assertEqual(needed(None), ['photos', 'photos_004'])
+        self.assertEqual(needed('2026-01-01T00:00:00'), ['photos'])
+        with self.assertRaises(NoChain):
+            needed('2025-12-31T00:00:00')
+        self.assertIn('photos_002-0001-001',
+                      self.d.chain_restore_instructions(
+                          chain, '2026-01-10T00:00:00'))
+
+    def testNewFullBackupStartsNewChain(self):
+        self.back_up('full', '2026-01-01T00:00:00')
+        self.back_up('incremental', '2026-01-08T00:00:00')
+        self.back_up('full', '2026-02-01T00:00:00')
+        self.assertEqual(len(self.d.load_chain('photos')), 1)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.d._chain_dir('photos'),
+            'chain-until-2026-02-01T00:00:00.json')))
+
+    def testIncrementalNeedsFull(self):
+        with self.assertRaises(NoChain):
+            self.d.start_chain_member(self.args, 'incremental')
+
+
+@patch.object(Darbrrb, '_run')
+@patch.object(Darbrrb, 'wait_for_empty_disc')
+class TestParallelArchives(UsesTempScratchDir):
+    data_discs = 3
+    parity_discs = 2
+    slices_per_disc = 4
+    pretend_free_space_MiB = (data_discs + parity_discs) * 25000
+    group_slices_per_disc = 1
+    tiered = False
+    slice_counts = {'par_1': 17, 'par_2': 9}
+
+    def setUp(self):
+        super().setUp()
+        if self.tiered:
+            self.settings.staging_dir = tempfile.mkdtemp(
+                'darbrrb_test_staging', dir=self.old_tempfile_tempdir)
+        self.settings.data_discs = self.data_discs
+        self.settings.parity_discs = self.parity_discs
+        self.settings.slices_per_disc = self.slices_per_disc
+        self.settings.group_slices_per_disc = self.group_slices_per_disc
+        self.settings.digits = 4
+        self.settings.actually_burn = False
+        with patch.object(Darbrrb, 'scratch_free_MiB',
+                          return_value=self.pretend_free_space_MiB), \
+                patch.object(Darbrrb, 'staging_free_MiB',
+                             return_value=self.pretend_free_space_MiB):
+            self.d = Darbrrb(self.settings, __file__)
+            self.d.ensure_scratch()
+            self.cwd = os.getcwd()
+            os.chdir(self.settings.scratch_dir)
+        self.d.record_archives('par', sorted(self.slice_counts))
+        self.parchive_repairs = []
+
+    def tearDown(self):
+        super().tearDown()
+        os.chdir(self.cwd)
+        if self.tiered:
+            shutil.rmtree(self.settings.staging_dir)
+
+    def mock__run(self, *args):
+        if args[0] == 'parchive' and args[2] == 'a':
+            bn, numbers, par = args[3].split('.')
+            n1, n2 = map(int, numbers.split('-'))
+            self.touch_par_files(bn, n1, n2, int(args[1].lstrip('-n')))
+        elif args[0] == 'parchive' and args[1] == 'r':
+            self.parchive_repairs.append(args[2])
+        elif args[0] == 'dar' and args[1] == '-x':
+            self.d._extract('dir', args[2], '0', 'dar', 'init')
+            for n in range(self.slice_counts[args[2]]):
+                self.d._extract('dir', args[2], str(n + 1), 'dar',
+                                'operating')
         else:
-            raise Exception("unknown subcommand", remaining)
-        log.debug('execution ended without exception')
-    except Exception as e:
-        log.exception('execution ended abnormally')
-        raise
+            raise Exception('unknown command run under test', args)
+
+    # the dars take turns making slices
+    def make_backup(self):
+        made = dict.fromkeys(self.slice_counts, 0)
+        while made != self.slice_counts:
+            for bn, count in sorted(self.slice_counts.items()):
+                if made[bn] < count:
+                    made[bn] += 1
+                    self.touch_dar_file(bn, made[bn])
+                    self.d._create('dir', bn, str(made[bn]), 'dar',
+                                   'last_slice' if made[bn] == count
+                                   else 'operating')
+
+    def testBackup(self, wfed, _run):
+        _run.side_effect = self.mock__run
+        self.make_backup()
+        total_slices = sum(self.slice_counts.values())
+        sets = math.ceil(total_slices / self.settings.slices_per_set)
+        titles = sorted(glob.glob('par-*'))
+        self.assertEqual(titles, [self.d.disc_title('par', s, d)
+                                  for s in range(sets)
+                                  for d in range(self.settings.total_set_count)])
+        burned_dars = sorted(os.path.basename(f)
+                             for f in glob.glob(os.path.join('par-*', '*.dar')))
+        self.assertEqual(burned_dars, sorted(self.dars_created))
+        first_set_disc = os.listdir(titles[0])
+        for bn in self.slice_counts:
+            self.assertTrue(any(f.startswith(bn + '.') and f.endswith('.dar')
+                                for f in first_set_disc))
+        with open(os.path.join(titles[-1], 'archives.json')) as f:
+            archives = json.load(f)
+        self.assertEqual(len(archives['sets']), sets)
+        for bn, count in self.slice_counts.items():
+            self.assertEqual(min(r[bn][0] for r in archives['sets']
+                                 if bn in r), 1)
+            self.assertEqual(max(r[bn][1] for r in archives['sets']
+                                 if bn in r), count)
+        self.assertIn('archives.json', self.d.readme('par_1'))
+        for title in titles:
+            files = os.listdir(title)
+            self.assertLessEqual(
+                len([f for f in files if f.endswith('.dar') or
+                     parity_volume_re.match(f)]),
+                self.slices_per_disc)
+        volumes = [int(c[0][1].lstrip('-n')) for c in _run.call_args_list
+                   if c[0][0] == 'parchive' and c[0][2] == 'a']
+        self.assertEqual(max(volumes),
+                         self.parity_discs * self.group_slices_per_disc)
+
+    def testRestore(self, wfed, _run):
+        _run.side_effect = self.mock__run
+        self.make_backup()
+        for f in glob.glob('*.par') + ['archives.json']:
+            os.unlink(f)
+        self.d.restore_in_parallel(('-x', 'par', '-R', '/fnord'))
+        for bn, count in self.slice_counts.items():
+            for n in range(1, count + 1):
+                self.assertTrue(os.path.exists(
+                    self.d._slice_name(bn, n, 'dar')), (bn, n))
+            width = self.settings.slices_per_group
+            groups = set(self.d._par_filename(bn, a + 1,
+                                              min(a + width, count))
+                         for a in range(0, count, width))
+            self.assertEqual(set(p for p in self.parchive_repairs
+                                 if p.startswith(bn + '.')), groups)
+
+    # the last group of each archive, and archives.json, are kept in the
+    # state directory, so no disc of the last set is needed to start
+    def testRestoreStartsWithFirstSet(self, wfed, _run):
+        _run.side_effect = self.mock__run
+        self.make_backup()
+        for f in glob.glob('*.par') + ['archives.json']:
+            os.unlink(f)
+        self.d.restore_in_parallel(('-x', 'par', '-R', '/fnord'))
+        self.assertEqual(self.d.media.loads[0], self.d.disc_title('par', 0, 0))
+        journal = self.d._journal()
+        self.assertEqual(journal.get('cached'), {})
+
+    def testRestoreWithoutKeptGroups(self, wfed, _run):
+        _run.side_effect = self.mock__run
+        self.make_backup()
+        for f in glob.glob('*.par') + ['archives.json']:
+            os.unlink(f)
+        shutil.rmtree(os.path.join(self.settings.state_dir, 'last_groups'))
+        self.d.restore_in_parallel(('-x', 'par', '-R', '/fnord'))
+        sets = math.ceil(sum(self.slice_counts.values()) /
+                         self.settings.slices_per_set)
+        self.assertEqual(self.d.media.loads[0],
+                         self.d.disc_title('par', sets - 1, 0))
+
+    def testKeptGroupWithoutChecksum(self, wfed, _run):
+        _run.side_effect = self.mock__run
+        self.make_backup()
+        for f in glob.glob('*.par') + ['archives.json']:
+            os.unlink(f)
+        kept = os.path.join(self.d._last_group_dir('par_1'),
+                            'last_group.json')
+        with open(kept) as f:
+            cached = json.load(f)
+        cached['first_slice_sha256'] = None
+        with open(kept, 'wt') as f:
+            json.dump(cached, f)
+        self.d.restore_in_parallel(('-x', 'par', '-R', '/fnord'))
+        sets = math.ceil(sum(self.slice_counts.values()) /
+                         self.settings.slices_per_set)
+        # par_1's last group is fetched from the discs instead
+        self.assertEqual(self.d.media.loads[0],
+                         self.d.disc_title('par', sets - 1, 0))
+
+    def testNoGroupsKept(self, wfed, _run):
+        self.settings.last_groups_kept = 0
+        _run.side_effect = self.mock__run
+        self.make_backup()
+        self.assertEqual(os.listdir(os.path.join(self.settings.state_dir,
+                                                 'last_groups')),
+                         ['kept.json'])
+
+    def testKeptGroupOfAnotherBackup(self, wfed, _run):
+        _run.side_effect = self.mock__run
+        self.make_backup()
+        for f in glob.glob('*.par') + ['archives.json']:
+            os.unlink(f)
+        kept = os.path.join(self.d._last_group_dir('par_1'),
+                            'last_group.json')
+        with open(kept) as f:
+            cached = json.load(f)
+        cached['first_slice_sha256'] = '0' * 64
+        with open(kept, 'wt') as f:
+            json.dump(cached, f)
+        with self.assertRaises(WrongBackup):
+            self.d.restore_in_parallel(('-x', 'par', '-R', '/fnord'))
+
+# Parity groups two slices deep on each disc: groups of six slices, each
+# with four parity volumes.
+class TestParallelArchivesWideGroups(TestParallelArchives):
+    group_slices_per_disc = 2
+
+# The discs put together in a staging directory of their own. No mover is
+# started, so groups wait in the outbox until the hook drains it itself.
+class TestParallelArchivesTiered(TestParallelArchives):
+    tiered = True
+
+    def setUp(self):
+        super().setUp()
+        self.real_start_mover = Darbrrb._start_mover
+        start_mover = patch.object(Darbrrb, '_start_mover')
+        self.start_mover = start_mover.start()
+        self.addCleanup(start_mover.stop)
+
+    def testGroupsWaitInOutbox(self):
+        waiting = []
+        real_move = self.d._move
+        def move(source, destination):
+            waiting.append(len(self.d._outbox_files('*.dar')))
+            real_move(source, destination)
+        with patch.object(Darbrrb, '_run', side_effect=self.mock__run), \
+                patch.object(self.d, '_move', side_effect=move):
+            self.make_backup()
+        self.assertTrue(self.start_mover.called)
+        self.assertLessEqual(max(waiting), self.settings.slices_per_group *
+                             self.settings.hot_groups)
+        self.assertEqual(self.d._outbox_files(), [])
+        for d in self.d.disc_dirs():
+            self.assertTrue(d.startswith(self.settings.staging_dir))
+            self.assertEqual(os.listdir(d), [])
+
+    def testFreeSpaceOfEachTier(self):
+        g = self.d.geometry
+        with patch.object(Darbrrb, 'scratch_free_MiB',
+                          return_value=g.hot_free_needed_MiB(
+                              self.settings.hot_groups)), \
+                patch.object(Darbrrb, 'staging_free_MiB',
+                             return_value=g.scratch_free_needed_MiB):
+            self.d.ensure_free_space()
+        with patch.object(Darbrrb, 'scratch_free_MiB',
+                          return_value=g.scratch_free_needed_MiB), \
+                patch.object(Darbrrb, 'staging_free_MiB',
+                             return_value=g.scratch_free_needed_MiB - 1):
+            with self.assertRaises(NotEnoughScratchSpace) as cm:
+                self.d.ensure_free_space()
+        self.assertEqual(cm.exception.args[0], self.settings.staging_dir)
+
+    def testMoverDrainsOutbox(self):
+        for disc in (1, 4):
+            self.touch(os.path.join(self.d.outbox_dir(disc), 'x.{}'.format(
+                disc)))
+        self.d.drain_outbox()
+        self.assertEqual(self.d._outbox_files(), [])
+        self.assertEqual(os.listdir(self.d.disc_dir(4)), ['x.4'])
+
+    def testMoverIsTheHook(self):
+        self.d.progopts = [('-n', ''), ('-v', ''), ('-o', '/isos')]
+        with patch('subprocess.Popen') as popen:
+            self.real_start_mover(self.d)
+        self.assertEqual(popen.call_args[0][0],
+                         [sys.executable, self.d._hook_filename(), '-v',
+                          '_move_staged'])
+        self.assertEqual(popen.call_args[1]['cwd'], self.settings.scratch_dir)
+
+    # the hook dar would run, in a process of its own, as dar would run it
+    def testMoverRuns(self):
+        for name in ('scratch_dir', 'staging_dir', 'state_dir'):
+            self.settings.measure(name, getattr(self.settings, name))
+        self.d._copy_self(os.path.join(self.settings.scratch_dir,
+                                       os.path.basename(__file__)))
+        self.d._compile_hook()
+        for disc in (1, 4):
+            self.touch(os.path.join(self.d.outbox_dir(disc), 'x.{}'.format(
+                disc)))
+        movers = []
+        real_popen = subprocess.Popen
+        def popen(*args, **kwargs):
+            movers.append(real_popen(*args, **kwargs))
+            return movers[-1]
+        with patch('subprocess.Popen', side_effect=popen):
+            self.real_start_mover(self.d)
+        self.assertEqual(movers[0].wait(30), 0)
+        self.assertEqual(self.d._outbox_files(), [])
+        self.assertEqual(os.listdir(self.d.disc_dir(4)), ['x.4'])
+        self.assertEqual(read_timings(self.d._timings_filename())[-1]['phase'],
+                         'mover')
+
+if __name__ == '__main__':
+    main(__file__)